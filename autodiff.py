@@ -1,23 +1,94 @@
+import collections
+import concurrent.futures
+import functools
+import gc
+import json
+import sys
+import threading
+import time
+import weakref
+
 import numpy as np
 
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# Bumped whenever the inputs or op of any node are (re)assigned, so compiled
+# execution plans can cheaply tell that the graph may have changed.
+_graph_version = 0
+
 class Node(object):
     """Node in a computation graph."""
+    # Nodes are created in large numbers, so they carry no __dict__.
+    __slots__ = ("_inputs", "_op", "const_attr", "matmul_attr_trans_A", "matmul_attr_trans_B",
+                 "_name", "__weakref__")
+
     def __init__(self):
         """Constructor, new node is indirectly created by Op object __call__ method.
             
             Instance variables
             ------------------
-            self.inputs: the list of input nodes.
+            self.inputs: the tuple of input nodes.
             self.op: the associated op object, 
                 e.g. add_op object if this node is created by adding two other nodes.
             self.const_attr: the add or multiply constant,
                 e.g. self.const_attr=5 if this node is created by x+5.
-            self.name: node name for debugging purposes.
+            self.matmul_attr_trans_A, self.matmul_attr_trans_B: whether a matmul
+                node transposes its first/second input.
+            self.name: node name for debugging purposes. Unless set explicitly
+                (e.g. by Variable), it is built from the input names on demand.
         """
-        self.inputs = []
-        self.op = None
+        self._inputs = ()
+        self._op = None
         self.const_attr = None
-        self.name = ""
+        self.matmul_attr_trans_A = False
+        self.matmul_attr_trans_B = False
+        self._name = None
+
+    @property
+    def inputs(self):
+        return self._inputs
+
+    @inputs.setter
+    def inputs(self, inputs):
+        """Inputs are stored as a tuple so that every change goes through this setter."""
+        global _graph_version
+        _graph_version += 1
+        self._inputs = tuple(inputs)
+
+    @property
+    def op(self):
+        return self._op
+
+    @op.setter
+    def op(self, op):
+        global _graph_version
+        _graph_version += 1
+        self._op = op
+
+    @property
+    def name(self):
+        """Explicit name if one was set, otherwise derived from the op and input names.
+
+        Derived names are not stored, since they grow with the depth of the graph.
+        """
+        if self._name is not None:
+            return self._name
+        names = {}
+        for node in find_topo_sort([self]):
+            if node._name is not None:
+                names[node] = node._name
+            elif node._op is None:
+                names[node] = ""
+            else:
+                names[node] = node._op.format_name(node, [names[i] for i in node._inputs])
+        return names[self]
+
+    @name.setter
+    def name(self, name):
+        self._name = name
 
     def __add__(self, other):
         """Adding two nodes return a new node."""
@@ -79,8 +150,30 @@ def Variable(name):
     placeholder_node.name = name
     return placeholder_node
 
+def Parameter(name, value):
+    """Stateful variable, whose value is stored in the graph instead of being fed.
+        e.g. w = Parameter(name = "w", value = np.zeros(3))
+
+    The value is copied into a float array, node.const_attr, which optimizer
+    nodes (see Optimizer.minimize) update in place when an Executor runs them.
+    """
+    parameter_node = parameter_op(value)
+    parameter_node.name = name
+    return parameter_node
+
 class Op(object):
     """Op represents operations performed on nodes."""
+    # whether the order of the inputs does not matter
+    commutative = False
+    # whether the output has the broadcast shape of the inputs (and const_attr)
+    # and their promoted dtype, and compute accepts an out= array to write it to
+    elementwise = False
+    # whether compute may return one of its inputs or a view of one
+    may_alias_inputs = True
+    # whether compute modifies state stored in the graph (e.g. parameter values),
+    # such steps run after every other step of an execution plan
+    updates_state = False
+
     def __call__(self):
         """Create a new node and associate the op object with the node.
         
@@ -92,6 +185,10 @@ class Op(object):
         new_node.op = self
         return new_node
 
+    def format_name(self, node, input_names):
+        """Given the names of the input nodes, return the name of node."""
+        return "%s(%s)" % (type(self).__name__, ",".join(input_names))
+
     def compute(self, node, input_vals):
         """Given values of input nodes, compute the output value.
 
@@ -120,82 +217,209 @@ class Op(object):
         """
         raise NotImplementedError
 
+    def jvp(self, node, input_tangents):
+        """Given tangents of input nodes, return the tangent of node (forward mode).
+
+        Parameters
+        ----------
+        node: node whose tangent is built.
+        input_tangents: tangent nodes of input nodes, None for inputs whose
+            tangent is zero (at least one is not None).
+
+        Returns
+        -------
+        A tangent node of the shape of node, or None if the tangent is zero.
+        """
+        raise NotImplementedError
+
+    def batched_compute(self, node, input_vals, batched, out=None):
+        """Like compute, with input_vals[i] carrying a leading batch axis if batched[i].
+
+        Returns the output value, with a leading batch axis if batched_output(batched).
+        Element-wise ops insert unit axes after the batch axis so that values
+        broadcast as they would without it.
+        """
+        if self.elementwise:
+            input_vals = _align_batched(node, input_vals, batched)
+            if out is None:
+                return self.compute(node, input_vals)
+            return self.compute(node, input_vals, out=out)
+        raise NotImplementedError
+
+    def batched_output(self, batched):
+        """Whether the output has a batch axis when the inputs with batched[i] do."""
+        return any(batched)
+
+    def infer_shape(self, node, input_shapes):
+        """Given shapes of input nodes, return the shape of the output value.
+
+        Parameters
+        ----------
+        node: node whose shape is inferred.
+        input_shapes: shape tuples of the values of input nodes.
+
+        Returns
+        -------
+        The output shape, or None if it cannot be known before the node is computed.
+        Incompatible input shapes fail with an AssertionError.
+        """
+        if self.elementwise:
+            return _broadcast_shape(node, input_shapes)
+        return None
+
+    def infer_dtype(self, node, input_dtypes):
+        """Given dtypes of input nodes, return the dtype of the output value, or None if unknown."""
+        if self.elementwise:
+            return _promoted_dtype(node, input_dtypes)
+        return None
+
 class AddOp(Op):
     """Op to element-wise add two nodes."""
+    commutative = True
+    elementwise = True
+
     def __call__(self, node_A, node_B):
         new_node = Op.__call__(self)
         new_node.inputs = [node_A, node_B]
-        new_node.name = "(%s+%s)" % (node_A.name, node_B.name)
         return new_node
 
-    def compute(self, node, input_vals):
+    def format_name(self, node, input_names):
+        return "(%s+%s)" % (input_names[0], input_names[1])
+
+    def compute(self, node, input_vals, out=None):
         """Given values of two input nodes, return result of element-wise addition."""
         assert len(input_vals) == 2
-        return input_vals[0] + input_vals[1]
+        return np.add(input_vals[0], input_vals[1], out=out)
 
     def gradient(self, node, output_grad):
         """Given gradient of add node, return gradient contributions to each input."""
-        return [output_grad, output_grad]
+        return [sum_to_op(output_grad, node.inputs[0]), sum_to_op(output_grad, node.inputs[1])]
+
+    def jvp(self, node, input_tangents):
+        return _sum_tangents(node, input_tangents)
+
+class AddNOp(Op):
+    """Op to element-wise add any number of nodes."""
+    commutative = True
+    elementwise = True
+
+    def __call__(self, node_list):
+        assert len(node_list) >= 2
+        new_node = Op.__call__(self)
+        new_node.inputs = node_list
+        return new_node
+
+    def format_name(self, node, input_names):
+        return "(%s)" % "+".join(input_names)
+
+    def compute(self, node, input_vals, out=None):
+        """Sum all input values, accumulating into a single output array."""
+        if out is not None:
+            num_aliases = sum(val is out for val in input_vals)
+            if num_aliases > 1:
+                # every read of out has to come before it is written
+                np.copyto(out, self.compute(node, input_vals))
+                return out
+            # an input that shares its buffer with out has to be consumed first
+            input_vals = sorted(input_vals, key=lambda val: val is not out)
+        # The first addition allocates (or fills) the output, so no other input is overwritten.
+        total = np.add(input_vals[0], input_vals[1], out=out)
+        for val in input_vals[2:]:
+            total = _apply_inplace(np.add, total, val)
+        return total
+
+    def gradient(self, node, output_grad):
+        return [sum_to_op(output_grad, input_node) for input_node in node.inputs]
+
+    def jvp(self, node, input_tangents):
+        return _sum_tangents(node, input_tangents)
 
 class AddByConstOp(Op):
     """Op to element-wise add a nodes by a constant."""
+    elementwise = True
+
     def __call__(self, node_A, const_val):
         new_node = Op.__call__(self)
         new_node.const_attr = const_val
         new_node.inputs = [node_A]
-        new_node.name = "(%s+%s)" % (node_A.name, str(const_val))
         return new_node
 
-    def compute(self, node, input_vals):
+    def format_name(self, node, input_names):
+        return "(%s+%s)" % (input_names[0], str(node.const_attr))
+
+    def compute(self, node, input_vals, out=None):
         """Given values of input node, return result of element-wise addition."""
         assert len(input_vals) == 1
-        return input_vals[0] + node.const_attr
+        return np.add(input_vals[0], node.const_attr, out=out)
 
     def gradient(self, node, output_grad):
         """Given gradient of add node, return gradient contribution to input."""
         return [output_grad]
 
+    def jvp(self, node, input_tangents):
+        return _const_broadcast_tangent(node, input_tangents[0])
+
 class MulOp(Op):
     """Op to element-wise multiply two nodes."""
+    commutative = True
+    elementwise = True
+
     def __call__(self, node_A, node_B):
         new_node = Op.__call__(self)
         new_node.inputs = [node_A, node_B]
-        new_node.name = "(%s*%s)" % (node_A.name, node_B.name)
         return new_node
 
-    def compute(self, node, input_vals):
+    def format_name(self, node, input_names):
+        return "(%s*%s)" % (input_names[0], input_names[1])
+
+    def compute(self, node, input_vals, out=None):
         """Given values of two input nodes, return result of element-wise multiplication."""
         """TODO: Your code here"""
         assert len(input_vals) == 2
-        return input_vals[0] * input_vals[1]
+        return np.multiply(input_vals[0], input_vals[1], out=out)
 
     def gradient(self, node, output_grad):
         """Given gradient of multiply node, return gradient contributions to each input."""
         """TODO: Your code here"""
-        return [node.inputs[1] * output_grad, node.inputs[0] * output_grad]
+        return [sum_to_op(node.inputs[1] * output_grad, node.inputs[0]),
+                sum_to_op(node.inputs[0] * output_grad, node.inputs[1])]
+
+    def jvp(self, node, input_tangents):
+        t_A, t_B = input_tangents
+        return _sum_tangents(node, [None if t_A is None else t_A * node.inputs[1],
+                                    None if t_B is None else node.inputs[0] * t_B], broadcast=False)
 
 class MulByConstOp(Op):
     """Op to element-wise multiply a nodes by a constant."""
+    elementwise = True
+
     def __call__(self, node_A, const_val):
         new_node = Op.__call__(self)
         new_node.const_attr = const_val
         new_node.inputs = [node_A]
-        new_node.name = "(%s*%s)" % (node_A.name, str(const_val))
         return new_node
 
-    def compute(self, node, input_vals):
+    def format_name(self, node, input_names):
+        return "(%s*%s)" % (input_names[0], str(node.const_attr))
+
+    def compute(self, node, input_vals, out=None):
         """Given values of input node, return result of element-wise multiplication."""
         """TODO: Your code here"""
         assert len(input_vals) == 1
-        return input_vals[0] * node.const_attr
+        return np.multiply(input_vals[0], node.const_attr, out=out)
 
     def gradient(self, node, output_grad):
         """Given gradient of multiplication node, return gradient contribution to input."""
         """TODO: Your code here"""
         return [node.const_attr * output_grad]
 
+    def jvp(self, node, input_tangents):
+        return input_tangents[0] * node.const_attr
+
 class MatMulOp(Op):
     """Op to matrix multiply two nodes."""
+    may_alias_inputs = False
+
     def __call__(self, node_A, node_B, trans_A=False, trans_B=False):
         """Create a new node that is the result a matrix multiple of two input nodes.
 
@@ -214,9 +438,11 @@ class MatMulOp(Op):
         new_node.matmul_attr_trans_A = trans_A
         new_node.matmul_attr_trans_B = trans_B
         new_node.inputs = [node_A, node_B]
-        new_node.name = "MatMul(%s,%s,%s,%s)" % (node_A.name, node_B.name, str(trans_A), str(trans_B))
         return new_node
 
+    def format_name(self, node, input_names):
+        return "MatMul(%s,%s,%s,%s)" % (input_names[0], input_names[1], str(node.matmul_attr_trans_A), str(node.matmul_attr_trans_B))
+
     def compute(self, node, input_vals):
         """Given values of input nodes, return result of matrix multiplication."""
         """TODO: Your code here"""
@@ -227,6 +453,28 @@ class MatMulOp(Op):
         else:
             return np.dot(input_vals[0], input_vals[1])
 
+    def batched_compute(self, node, input_vals, batched, out=None):
+        """Batched matrix (or vector) products through np.matmul broadcasting."""
+        A, B = input_vals
+        ndim_A = np.ndim(A) - batched[0]
+        ndim_B = np.ndim(B) - batched[1]
+        assert ndim_A in (1, 2) and ndim_B in (1, 2), "batched MatMul supports vectors and matrices"
+        if node.matmul_attr_trans_A and ndim_A == 2:
+            A = np.swapaxes(A, -1, -2)
+        elif node.matmul_attr_trans_B and ndim_B == 2:
+            B = np.swapaxes(B, -1, -2)
+        # vectors become 1xn and nx1 matrices, whose unit axes are dropped again
+        if ndim_A == 1:
+            A = np.expand_dims(A, -2)
+        if ndim_B == 1:
+            B = np.expand_dims(B, -1)
+        C = np.matmul(A, B)
+        if ndim_B == 1:
+            C = C[..., 0]
+        if ndim_A == 1:
+            C = C[..., 0, :] if ndim_B == 2 else C[..., 0]
+        return C
+
 
     def gradient(self, node, output_grad):
         """Given gradient of multiply node, return gradient contributions to each input.
@@ -238,6 +486,30 @@ class MatMulOp(Op):
         dB = matmul_op(node.inputs[0], output_grad, True, False)
         return [dA,dB]
 
+    def jvp(self, node, input_tangents):
+        t_A, t_B = input_tangents
+        trans_A, trans_B = node.matmul_attr_trans_A, node.matmul_attr_trans_B
+        return _sum_tangents(node, [None if t_A is None else matmul_op(t_A, node.inputs[1], trans_A, trans_B),
+                                    None if t_B is None else matmul_op(node.inputs[0], t_B, trans_A, trans_B)],
+                             broadcast=False)
+
+    def infer_shape(self, node, input_shapes):
+        """Output shape of np.dot, checking that the contracted dimensions agree."""
+        shape_A, shape_B = input_shapes
+        if node.matmul_attr_trans_A:
+            shape_A = shape_A[::-1]
+        elif node.matmul_attr_trans_B:
+            shape_B = shape_B[::-1]
+        if not shape_A or not shape_B:
+            return shape_A or shape_B
+        inner_B = shape_B[0] if len(shape_B) == 1 else shape_B[-2]
+        assert shape_A[-1] == inner_B, "MatMul of shapes %s and %s (trans_A=%s, trans_B=%s) is not aligned" % (
+            input_shapes[0], input_shapes[1], node.matmul_attr_trans_A, node.matmul_attr_trans_B)
+        return shape_A[:-1] + shape_B[:-2] + shape_B[-1:] if len(shape_B) > 1 else shape_A[:-1]
+
+    def infer_dtype(self, node, input_dtypes):
+        return np.result_type(*input_dtypes)
+
 class PlaceholderOp(Op):
     """Op to feed value to a nodes."""
     def __call__(self):
@@ -245,6 +517,9 @@ class PlaceholderOp(Op):
         new_node = Op.__call__(self)
         return new_node
 
+    def format_name(self, node, input_names):
+        return ""
+
     def compute(self, node, input_vals):
         """No compute function since node value is fed directly in Executor."""
         assert False, "placeholder values provided by feed_dict"
@@ -253,174 +528,915 @@ class PlaceholderOp(Op):
         """No gradient function since node has no inputs."""
         return None
 
+class ParameterOp(Op):
+    """Op of a stateful variable, whose value is stored in const_attr."""
+    def __call__(self, value):
+        new_node = Op.__call__(self)
+        value = np.asarray(value)
+        new_node.const_attr = np.array(value, dtype=np.result_type(value, 1.0))
+        return new_node
+
+    def format_name(self, node, input_names):
+        return ""
+
+    def compute(self, node, input_vals):
+        """Return the stored value itself, so in-place updates are seen by the next run."""
+        assert len(input_vals) == 0
+        return node.const_attr
+
+    def gradient(self, node, output_grad):
+        """No gradient function since node has no inputs."""
+        return None
+
+    def jvp(self, node, input_tangents):
+        return None
+
+    def infer_shape(self, node, input_shapes):
+        return node.const_attr.shape
+
+    def infer_dtype(self, node, input_dtypes):
+        return node.const_attr.dtype
+
 class ZerosLikeOp(Op):
     """Op that represents a constant np.zeros_like."""
+    may_alias_inputs = False
+
     def __call__(self, node_A):
         """Creates a node that represents a np.zeros array of same shape as node_A."""
         new_node = Op.__call__(self)
         new_node.inputs = [node_A]
-        new_node.name = "Zeroslike(%s)" % node_A.name
         return new_node
 
+    def format_name(self, node, input_names):
+        return "Zeroslike(%s)" % input_names[0]
+
     def compute(self, node, input_vals):
-        """Returns zeros_like of the same shape as input."""
-        assert(isinstance(input_vals[0], np.ndarray))
-        return np.zeros(input_vals[0].shape)
+        """Returns zeros_like of the same shape as input, in its dtype if that is a float."""
+        return np.zeros(np.shape(input_vals[0]), dtype=_float_or_float64(np.result_type(input_vals[0])))
+
+    def batched_compute(self, node, input_vals, batched, out=None):
+        """All elements of the batch have the same shape, so the output is not batched."""
+        val = input_vals[0]
+        return np.zeros(np.shape(val)[1:], dtype=_float_or_float64(np.result_type(val)))
+
+    def batched_output(self, batched):
+        return False
 
     def gradient(self, node, output_grad):
         return [zeroslike_op(node.inputs[0])]
 
+    def jvp(self, node, input_tangents):
+        return None
+
+    def infer_shape(self, node, input_shapes):
+        return input_shapes[0]
+
+    def infer_dtype(self, node, input_dtypes):
+        return _float_or_float64(input_dtypes[0])
+
 class OnesLikeOp(Op):
     """Op that represents a constant np.ones_like."""
+    may_alias_inputs = False
+
     def __call__(self, node_A):
         """Creates a node that represents a np.ones array of same shape as node_A."""
         new_node = Op.__call__(self)
         new_node.inputs = [node_A]
-        new_node.name = "Oneslike(%s)" % node_A.name
         return new_node
 
+    def format_name(self, node, input_names):
+        return "Oneslike(%s)" % input_names[0]
+
+    def compute(self, node, input_vals):
+        """Returns ones_like of the same shape as input, in its dtype if that is a float."""
+        return np.ones(np.shape(input_vals[0]), dtype=_float_or_float64(np.result_type(input_vals[0])))
+
+    def batched_compute(self, node, input_vals, batched, out=None):
+        """All elements of the batch have the same shape, so the output is not batched."""
+        val = input_vals[0]
+        return np.ones(np.shape(val)[1:], dtype=_float_or_float64(np.result_type(val)))
+
+    def batched_output(self, batched):
+        return False
+
+    def gradient(self, node, output_grad):
+        return [zeroslike_op(node.inputs[0])]
+
+    def jvp(self, node, input_tangents):
+        return None
+
+    def infer_shape(self, node, input_shapes):
+        return input_shapes[0]
+
+    def infer_dtype(self, node, input_dtypes):
+        return _float_or_float64(input_dtypes[0])
+
+class EyeLikeOp(Op):
+    """Op that represents the identity over the elements of a node, stacked along a leading axis."""
+    may_alias_inputs = False
+
+    def __call__(self, node_A):
+        """Creates a node whose value for node_A of shape s has shape (size,) + s,
+        with element i the one-hot array of the i-th element in C order."""
+        new_node = Op.__call__(self)
+        new_node.inputs = [node_A]
+        return new_node
+
+    def format_name(self, node, input_names):
+        return "Eyelike(%s)" % input_names[0]
+
     def compute(self, node, input_vals):
-        """Returns ones_like of the same shape as input."""
-        assert(isinstance(input_vals[0], np.ndarray))
-        return np.ones(input_vals[0].shape)
+        shape = np.shape(input_vals[0])
+        size = int(np.prod(shape))
+        return np.eye(size, dtype=_float_or_float64(np.result_type(input_vals[0]))).reshape((size,) + shape)
 
     def gradient(self, node, output_grad):
         return [zeroslike_op(node.inputs[0])]
 
+    def jvp(self, node, input_tangents):
+        return None
+
+    def infer_shape(self, node, input_shapes):
+        return (int(np.prod(input_shapes[0])),) + tuple(input_shapes[0])
+
+    def infer_dtype(self, node, input_dtypes):
+        return _float_or_float64(input_dtypes[0])
+
+class ReduceSumOp(Op):
+    """Op to sum a node over the given axes."""
+    may_alias_inputs = False
+
+    def __init__(self, accumulate_dtype=None):
+        """accumulate_dtype: dtype to accumulate lower precision floats in, the input dtype if None."""
+        self.accumulate_dtype = accumulate_dtype
+
+    def __call__(self, node_A, axis=None, keepdims=False):
+        """Creates a node that represents np.sum(node_A, axis=axis, keepdims=keepdims).
+
+        The reduction is stored as const_attr = (axis, keepdims).
+        """
+        new_node = Op.__call__(self)
+        new_node.const_attr = (_normalize_axis(axis), keepdims)
+        new_node.inputs = [node_A]
+        return new_node
+
+    def format_name(self, node, input_names):
+        return "ReduceSum(%s,%s)" % (input_names[0], str(node.const_attr[0]))
+
+    def compute(self, node, input_vals):
+        axis, keepdims = node.const_attr
+        return _reduce(np.sum, input_vals[0], self.accumulate_dtype, axis=axis, keepdims=keepdims)
+
+    def batched_compute(self, node, input_vals, batched, out=None):
+        axis, keepdims = node.const_attr
+        axis = _batched_axis(axis, np.ndim(input_vals[0]) - 1)
+        return _reduce(np.sum, input_vals[0], self.accumulate_dtype, axis=axis, keepdims=keepdims)
+
+    def gradient(self, node, output_grad):
+        axis, keepdims = node.const_attr
+        return [broadcast_to_op(output_grad, node.inputs[0], None if keepdims else axis)]
+
+    def jvp(self, node, input_tangents):
+        axis, keepdims = node.const_attr
+        return reduce_sum_op(input_tangents[0], axis, keepdims)
+
+    def infer_shape(self, node, input_shapes):
+        axis, keepdims = node.const_attr
+        return _reduced_shape(input_shapes[0], axis, keepdims)
+
+    def infer_dtype(self, node, input_dtypes):
+        return _sum_dtype(input_dtypes[0])
+
+class ReduceMeanOp(Op):
+    """Op to average a node over the given axes."""
+    may_alias_inputs = False
+
+    def __init__(self, accumulate_dtype=None):
+        """accumulate_dtype: dtype to accumulate lower precision floats in, the input dtype if None."""
+        self.accumulate_dtype = accumulate_dtype
+
+    def __call__(self, node_A, axis=None, keepdims=False):
+        """Creates a node that represents np.mean(node_A, axis=axis, keepdims=keepdims).
+
+        The reduction is stored as const_attr = (axis, keepdims).
+        """
+        new_node = Op.__call__(self)
+        new_node.const_attr = (_normalize_axis(axis), keepdims)
+        new_node.inputs = [node_A]
+        return new_node
+
+    def format_name(self, node, input_names):
+        return "ReduceMean(%s,%s)" % (input_names[0], str(node.const_attr[0]))
+
+    def compute(self, node, input_vals):
+        axis, keepdims = node.const_attr
+        return _reduce(np.mean, input_vals[0], self.accumulate_dtype, axis=axis, keepdims=keepdims)
+
+    def batched_compute(self, node, input_vals, batched, out=None):
+        axis, keepdims = node.const_attr
+        axis = _batched_axis(axis, np.ndim(input_vals[0]) - 1)
+        return _reduce(np.mean, input_vals[0], self.accumulate_dtype, axis=axis, keepdims=keepdims)
+
+    def gradient(self, node, output_grad):
+        axis, keepdims = node.const_attr
+        return [broadcast_to_op(output_grad, node.inputs[0], None if keepdims else axis, mean=True)]
+
+    def jvp(self, node, input_tangents):
+        axis, keepdims = node.const_attr
+        return reduce_mean_op(input_tangents[0], axis, keepdims)
+
+    def infer_shape(self, node, input_shapes):
+        axis, keepdims = node.const_attr
+        return _reduced_shape(input_shapes[0], axis, keepdims)
+
+    def infer_dtype(self, node, input_dtypes):
+        return np.result_type(input_dtypes[0], 1.0)
+
+class BroadcastToOp(Op):
+    """Op to broadcast a node to the shape of another node."""
+    def __call__(self, node_A, node_B, axis=None, mean=False):
+        """Creates a node that represents node_A broadcast to the shape of node_B.
+
+        Parameters
+        ----------
+        node_A: node to broadcast.
+        node_B: node whose shape is the output shape.
+        axis: axes to insert into node_A before broadcasting, e.g. the axes a
+            reduce_sum_op without keepdims removed.
+        mean: whether to divide by the number of output elements each element
+            of node_A is copied to (the adjoint of reduce_mean_op).
+
+        The options are stored as const_attr = (axis, mean).
+        """
+        new_node = Op.__call__(self)
+        new_node.const_attr = (_normalize_axis(axis), mean)
+        new_node.inputs = [node_A, node_B]
+        return new_node
+
+    def format_name(self, node, input_names):
+        return "BroadcastTo(%s,%s)" % (input_names[0], input_names[1])
+
+    def compute(self, node, input_vals):
+        """Returns a read-only broadcast view; no dataset-sized array is materialized."""
+        val, target = input_vals
+        axis, mean = node.const_attr
+        return _broadcast_to(val, np.shape(target), axis, mean)
+
+    def batched_compute(self, node, input_vals, batched, out=None):
+        val, target = input_vals
+        shape = np.shape(target)[1:] if batched[1] else np.shape(target)
+        axis, mean = node.const_attr
+        if not batched[0]:
+            return _broadcast_to(val, shape, axis, mean)
+        if axis is not None:
+            val = np.expand_dims(val, _batched_axis(axis, np.ndim(val) - 1))
+        val = _align_batched_val(val, len(shape))
+        batch_size = np.shape(val)[0]
+        # the mean scale of the whole batch is that of one element
+        return _broadcast_to(val, (batch_size,) + shape, None, mean)
+
+    def batched_output(self, batched):
+        return batched[0]
+
+    def gradient(self, node, output_grad):
+        axis, mean = node.const_attr
+        return [sum_to_op(output_grad, node.inputs[0], axis, mean), zeroslike_op(node.inputs[1])]
+
+    def jvp(self, node, input_tangents):
+        if input_tangents[0] is None:
+            return None
+        axis, mean = node.const_attr
+        return broadcast_to_op(input_tangents[0], node.inputs[1], axis, mean)
+
+    def infer_shape(self, node, input_shapes):
+        shape, target = input_shapes
+        axis, mean = node.const_attr
+        if axis is not None:
+            shape = _expanded_shape(shape, axis)
+        assert shape is None or _broadcasts_to(shape, target), "cannot broadcast shape %s to %s" % (shape, target)
+        return target
+
+    def infer_dtype(self, node, input_dtypes):
+        axis, mean = node.const_attr
+        return np.result_type(input_dtypes[0], 1.0) if mean else input_dtypes[0]
+
+class SumToOp(Op):
+    """Op to sum a node down to the shape of another node, undoing broadcasting."""
+    def __init__(self, accumulate_dtype=None):
+        """accumulate_dtype: dtype to accumulate lower precision floats in, the input dtype if None."""
+        self.accumulate_dtype = accumulate_dtype
+
+    def __call__(self, node_A, node_B, axis=None, mean=False):
+        """Creates a node that represents node_A summed to the shape of node_B.
+
+        node_B's shape must broadcast to node_A's shape (after inserting axis).
+        This is the adjoint of broadcast_to_op with the same arguments, which is
+        used to give each input of a broadcasting op a gradient of its own shape.
+        """
+        new_node = Op.__call__(self)
+        new_node.const_attr = (_normalize_axis(axis), mean)
+        new_node.inputs = [node_A, node_B]
+        return new_node
+
+    def format_name(self, node, input_names):
+        return "SumTo(%s,%s)" % (input_names[0], input_names[1])
+
+    def compute(self, node, input_vals):
+        val, target = input_vals
+        return self._sum(node, val, np.shape(target))
+
+    def batched_compute(self, node, input_vals, batched, out=None):
+        val, target = input_vals
+        shape = np.shape(target)[1:] if batched[1] else np.shape(target)
+        return self._sum(node, val, shape, 1 if batched[0] else 0)
+
+    def _sum(self, node, val, shape, batch_dims=0):
+        """Sum val to shape, keeping the first batch_dims axes."""
+        axis, mean = node.const_attr
+        if mean:
+            # a Python float, so that it does not promote float32 values
+            scale = float(np.prod(shape) * np.prod(np.shape(val)[:batch_dims]) / np.size(val))
+        if axis is not None:
+            if batch_dims:
+                axis = _batched_axis(axis, np.ndim(val) - 1)
+            val = _reduce(np.sum, val, self.accumulate_dtype, axis=axis)
+        val = _sum_to(val, shape, self.accumulate_dtype, batch_dims)
+        if mean:
+            val = val * scale
+        return val
+
+    def batched_output(self, batched):
+        return batched[0]
+
+    def gradient(self, node, output_grad):
+        axis, mean = node.const_attr
+        return [broadcast_to_op(output_grad, node.inputs[0], axis, mean), zeroslike_op(node.inputs[1])]
+
+    def jvp(self, node, input_tangents):
+        if input_tangents[0] is None:
+            return None
+        axis, mean = node.const_attr
+        return sum_to_op(input_tangents[0], node.inputs[1], axis, mean)
+
+    def infer_shape(self, node, input_shapes):
+        shape, target = input_shapes
+        axis, mean = node.const_attr
+        if axis is not None:
+            shape = _reduced_shape(shape, axis, False)
+        if shape is None or len(shape) < len(target):
+            return shape
+        assert _broadcasts_to(target, shape), "cannot sum shape %s to %s" % (shape, target)
+        return target
+
+    def infer_dtype(self, node, input_dtypes):
+        axis, mean = node.const_attr
+        dtype = _sum_dtype(input_dtypes[0])
+        return np.result_type(dtype, 1.0) if mean else dtype
+
 ### additional operators
 
 
 class SubOp(Op):
     """Op to element-wise subtract two nodes."""
+    elementwise = True
+
     def __call__(self, node_A, node_B):
         new_node = Op.__call__(self)
         new_node.inputs = [node_A, node_B]
-        new_node.name = "(%s - %s)" % (node_A.name, node_B.name)
         return new_node
 
-    def compute(self, node, input_vals):
+    def format_name(self, node, input_names):
+        return "(%s - %s)" % (input_names[0], input_names[1])
+
+    def compute(self, node, input_vals, out=None):
         assert len(input_vals) == 2
-        return input_vals[0] - input_vals[1]
+        return np.subtract(input_vals[0], input_vals[1], out=out)
 
     def gradient(self, node, output_grad):
-        return [output_grad, -1*output_grad]
+        return [sum_to_op(output_grad, node.inputs[0]), sum_to_op(-1*output_grad, node.inputs[1])]
+
+    def jvp(self, node, input_tangents):
+        t_A, t_B = input_tangents
+        return _sum_tangents(node, [t_A, None if t_B is None else -1 * t_B])
 
 class SubByConstOp(Op):
     """Op to element-wise subtract a nodes by a constant."""
+    elementwise = True
+
     def __call__(self, node_A, const_val):
         new_node = Op.__call__(self)
         new_node.const_attr = const_val
         new_node.inputs = [node_A]
-        new_node.name = "(%s - %s)" % (node_A.name, str(const_val))
         return new_node
 
-    def compute(self, node, input_vals):
+    def format_name(self, node, input_names):
+        return "(%s - %s)" % (input_names[0], str(node.const_attr))
+
+    def compute(self, node, input_vals, out=None):
         assert len(input_vals) == 1
-        return input_vals[0] - node.const_attr
+        return np.subtract(input_vals[0], node.const_attr, out=out)
 
     def gradient(self, node, output_grad):
         return [output_grad]
 
+    def jvp(self, node, input_tangents):
+        return _const_broadcast_tangent(node, input_tangents[0])
+
 class SubByConstOp_1(Op):
     """Op to element-wise subtract constant by a node."""
+    elementwise = True
+
     def __call__(self, node_A, const_val):
         new_node = Op.__call__(self)
         new_node.const_attr = const_val
         new_node.inputs = [node_A]
-        new_node.name = "(%s - %s)" % (str(const_val), node_A.name)
         return new_node
 
-    def compute(self, node, input_vals):
+    def format_name(self, node, input_names):
+        return "(%s - %s)" % (str(node.const_attr), input_names[0])
+
+    def compute(self, node, input_vals, out=None):
         assert len(input_vals) == 1
-        return node.const_attr - input_vals[0]
+        return np.subtract(node.const_attr, input_vals[0], out=out)
 
     def gradient(self, node, output_grad):
         return [-1*output_grad]
 
+    def jvp(self, node, input_tangents):
+        return _const_broadcast_tangent(node, -1 * input_tangents[0])
+
 class DivOp(Op):
     """Op to element-wise divide two nodes."""
+    elementwise = True
+
     def __call__(self, node_A, node_B):
         new_node = Op.__call__(self)
         new_node.inputs = [node_A, node_B]
-        new_node.name = "(%s / %s)" % (node_A.name, node_B.name)
         return new_node
 
-    def compute(self, node, input_vals):
-        return input_vals[0] / input_vals[1]
+    def format_name(self, node, input_names):
+        return "(%s / %s)" % (input_names[0], input_names[1])
+
+    def compute(self, node, input_vals, out=None):
+        return np.divide(input_vals[0], input_vals[1], out=out)
 
     def gradient(self, node, output_grad):
-        return [1/node.inputs[1] * output_grad, (-1) * (node.inputs[0]/(node.inputs[1]*node.inputs[1])) * output_grad]
+        return [sum_to_op(1/node.inputs[1] * output_grad, node.inputs[0]),
+                sum_to_op((-1) * (node.inputs[0]/(node.inputs[1]*node.inputs[1])) * output_grad, node.inputs[1])]
+
+    def jvp(self, node, input_tangents):
+        t_A, t_B = input_tangents
+        return _sum_tangents(node, [None if t_A is None else t_A / node.inputs[1],
+                                    None if t_B is None else (-1) * node * t_B / node.inputs[1]],
+                             broadcast=False)
+
+    def infer_dtype(self, node, input_dtypes):
+        return np.result_type(_promoted_dtype(node, input_dtypes), 1.0)
 
 class DivByConstOp(Op):
     """Op to element-wise divide a node by a constant."""
+    elementwise = True
+
     def __call__(self, node_A, const_val):
         new_node = Op.__call__(self)
         new_node.const_attr = const_val
         new_node.inputs = [node_A]
-        new_node.name = "(%s / %s)" % (node_A.name, str(const_val))
         return new_node
 
-    def compute(self, node, input_vals):
-        return input_vals[0] / node.const_attr
+    def format_name(self, node, input_names):
+        return "(%s / %s)" % (input_names[0], str(node.const_attr))
+
+    def compute(self, node, input_vals, out=None):
+        return np.divide(input_vals[0], node.const_attr, out=out)
 
     def gradient(self, node, output_grad):
         return [output_grad / node.const_attr]
 
+    def jvp(self, node, input_tangents):
+        return input_tangents[0] / node.const_attr
+
+    def infer_dtype(self, node, input_dtypes):
+        return np.result_type(_promoted_dtype(node, input_dtypes), 1.0)
+
 class DivByConstOp_1(Op):
     """Op to element-wise divide a constant by a node."""
+    elementwise = True
+
     def __call__(self, node_A, const_val):
         new_node = Op.__call__(self)
         new_node.const_attr = const_val
         new_node.inputs = [node_A]
-        new_node.name = "(%s / %s)" % (str(const_val), node_A.name)
         return new_node
 
-    def compute(self, node, input_vals):
-        temp = input_vals[0] + 0.00000000001 
-        return node.const_attr / temp
+    def format_name(self, node, input_names):
+        return "(%s / %s)" % (str(node.const_attr), input_names[0])
+
+    def compute(self, node, input_vals, out=None):
+        temp = np.add(input_vals[0], 0.00000000001, out=out)
+        return np.divide(node.const_attr, temp, out=out)
 
     def gradient(self, node, output_grad):
         return [-1 * node.const_attr/(node.inputs[0] * node.inputs[0]) * output_grad]
 
+    def jvp(self, node, input_tangents):
+        return div_op_byconst(node.inputs[0] * node.inputs[0], -1 * node.const_attr) * input_tangents[0]
+
+    def infer_dtype(self, node, input_dtypes):
+        return np.result_type(_promoted_dtype(node, input_dtypes), 1.0)
+
 class ExpOp(Op):
     """exponent(x)"""
+    elementwise = True
+
     def __call__(self, node_A):
         new_node = Op.__call__(self)
         new_node.inputs = [node_A]
-        new_node.name = "exp ^ (%s)" % (node_A.name)
         return new_node
 
-    def compute(self, node, input_vals):
-        return np.exp(input_vals[0])
+    def format_name(self, node, input_names):
+        return "exp ^ (%s)" % (input_names[0])
+
+    def compute(self, node, input_vals, out=None):
+        return np.exp(input_vals[0], out=out)
 
     def gradient(self, node, output_grad):
         return [exp_op(node.inputs[0])*output_grad]
 
+    def jvp(self, node, input_tangents):
+        return node * input_tangents[0]
+
+    def infer_dtype(self, node, input_dtypes):
+        return np.result_type(_promoted_dtype(node, input_dtypes), np.float16)
+
 class LogOp(Op):
     """logarithm(x)"""
+    elementwise = True
+
     def __call__(self, node_A):
         new_node = Op.__call__(self)
         new_node.inputs = [node_A]
-        new_node.name = "log (%s)" % (node_A.name)
         return new_node
 
-    def compute(self, node, input_vals):
-        temp = input_vals[0] + 0.0000000001
-        temp = abs(temp)
-        return np.log(temp)
+    def format_name(self, node, input_names):
+        return "log (%s)" % (input_names[0])
+
+    def compute(self, node, input_vals, out=None):
+        temp = np.add(input_vals[0], 0.0000000001, out=out)
+        temp = np.abs(temp, out=out)
+        return np.log(temp, out=out)
 
     def gradient(self, node, output_grad):
         return [(1/node.inputs[0])*output_grad]
 
+    def jvp(self, node, input_tangents):
+        return input_tangents[0] / node.inputs[0]
+
+    def infer_dtype(self, node, input_dtypes):
+        return np.result_type(_promoted_dtype(node, input_dtypes), 1.0)
+
+class SigmoidOp(Op):
+    """sigmoid(x) = 1 / (1 + exp(-x))"""
+    elementwise = True
+
+    def __call__(self, node_A):
+        new_node = Op.__call__(self)
+        new_node.inputs = [node_A]
+        return new_node
+
+    def format_name(self, node, input_names):
+        return "sigmoid (%s)" % (input_names[0])
+
+    def compute(self, node, input_vals, out=None):
+        return _sigmoid(input_vals[0], out)
+
+    def gradient(self, node, output_grad):
+        return [output_grad * (node * (1 - node))]
+
+    def jvp(self, node, input_tangents):
+        return input_tangents[0] * (node * (1 - node))
+
+    def infer_dtype(self, node, input_dtypes):
+        return np.result_type(_promoted_dtype(node, input_dtypes), 1.0)
+
+class SigmoidCrossEntropyOp(Op):
+    """Element-wise binary cross-entropy of sigmoid(logits) against labels.
+
+    Equal to -(labels * log(sigmoid(logits)) + (1 - labels) * log(1 - sigmoid(logits))),
+    computed without overflow or log(0) for logits of any magnitude.
+    """
+    may_alias_inputs = False
+
+    def __call__(self, logits, labels):
+        new_node = Op.__call__(self)
+        new_node.inputs = [logits, labels]
+        return new_node
+
+    def format_name(self, node, input_names):
+        return "SigmoidCrossEntropy(%s,%s)" % (input_names[0], input_names[1])
+
+    def compute(self, node, input_vals):
+        logits, labels = input_vals
+        # max(x, 0) - x * z + log(1 + exp(-|x|))
+        loss = np.negative(np.abs(logits))
+        if isinstance(loss, np.ndarray) and loss.dtype.kind == "f":
+            np.exp(loss, out=loss)
+            np.log1p(loss, out=loss)
+        else:
+            loss = np.log1p(np.exp(loss))
+        loss = _apply_inplace(np.add, loss, np.maximum(logits, 0))
+        return _apply_inplace(np.subtract, loss, logits * labels)
+
+    def batched_compute(self, node, input_vals, batched, out=None):
+        return self.compute(node, _align_batched(node, input_vals, batched))
+
+    def gradient(self, node, output_grad):
+        logits, labels = node.inputs
+        return [sum_to_op((sigmoid_op(logits) - labels) * output_grad, logits),
+                sum_to_op(-1 * logits * output_grad, labels)]
+
+    def jvp(self, node, input_tangents):
+        logits, labels = node.inputs
+        t_logits, t_labels = input_tangents
+        return _sum_tangents(node, [None if t_logits is None else (sigmoid_op(logits) - labels) * t_logits,
+                                    None if t_labels is None else -1 * logits * t_labels], broadcast=False)
+
+    def infer_shape(self, node, input_shapes):
+        return _broadcast_shape(node, input_shapes)
+
+    def infer_dtype(self, node, input_dtypes):
+        return np.result_type(*input_dtypes, np.float16)
+
+class BatchLikeOp(Op):
+    """Op giving node_A the batch axis of node_B, see vmap.
+
+    Unbatched it is the identity of node_A. With only node_B batched, node_A
+    is repeated (as a read-only broadcast view) for every element of the batch.
+    """
+    def __call__(self, node_A, node_B):
+        new_node = Op.__call__(self)
+        new_node.inputs = [node_A, node_B]
+        return new_node
+
+    def format_name(self, node, input_names):
+        return "BatchLike(%s,%s)" % (input_names[0], input_names[1])
+
+    def compute(self, node, input_vals):
+        return input_vals[0]
+
+    def batched_compute(self, node, input_vals, batched, out=None):
+        val = input_vals[0]
+        if batched[0] or not batched[1]:
+            return val
+        return np.broadcast_to(val, np.shape(input_vals[1])[:1] + np.shape(val))
+
+    def gradient(self, node, output_grad):
+        return [output_grad, zeroslike_op(node.inputs[1])]
+
+    def jvp(self, node, input_tangents):
+        return input_tangents[0]
+
+    def infer_shape(self, node, input_shapes):
+        return input_shapes[0]
+
+    def infer_dtype(self, node, input_dtypes):
+        return input_dtypes[0]
+
+class ApplyUpdatesOp(Op):
+    """Op updating parameter values in place with their gradients, see Optimizer."""
+    may_alias_inputs = False
+    updates_state = True
+
+    def __call__(self, param_list, grad_list, optimizer):
+        """The node's inputs are the parameters followed by their gradients.
+
+        const_attr holds the optimizer and its per-parameter state, allocated
+        here once from the current parameter values.
+        """
+        assert len(param_list) == len(grad_list)
+        assert all(param.op is parameter_op for param in param_list), "only Parameter nodes can be updated"
+        new_node = Op.__call__(self)
+        new_node.inputs = list(param_list) + list(grad_list)
+        new_node.const_attr = _OptimizerSlots(optimizer, [optimizer.init_state(param.const_attr)
+                                                          for param in param_list])
+        return new_node
+
+    def compute(self, node, input_vals):
+        """Update the parameter values, returns None."""
+        slots = node.const_attr
+        num_params = len(input_vals) // 2
+        slots.step += 1
+        for param_val, grad_val, state in zip(input_vals[:num_params], input_vals[num_params:], slots.states):
+            slots.optimizer.update(param_val, grad_val, state, slots.step)
+        return None
+
+    def gradient(self, node, output_grad):
+        raise NotImplementedError("parameter updates are not differentiable")
+
+    def jvp(self, node, input_tangents):
+        raise NotImplementedError("parameter updates are not differentiable")
+
+class _OptimizerSlots(object):
+    """Optimizer of an ApplyUpdatesOp node, its state per parameter and the number of updates."""
+    def __init__(self, optimizer, states):
+        self.optimizer = optimizer
+        self.states = states
+        self.step = 0
+
+class FusedElementwiseOp(Op):
+    """Op to compute a group of element-wise nodes as a single kernel.
+
+    The group is stored as const_attr = a _FusedProgram. The kernel is a
+    sequence of ufunc calls computing in place into as few arrays as possible.
+    Programs built with use_numexpr are one numexpr evaluation instead, if
+    numexpr is installed and supports every op of the group, the output has
+    at least _numexpr_min_size elements, and the inputs all have its float32
+    or float64 dtype: numexpr computes other dtypes in float64, where numpy
+    may compute in a smaller float (exp of int8 gives float16).
+    """
+    elementwise = True
+    may_alias_inputs = False
+
+    def __call__(self, node_list, program):
+        new_node = Op.__call__(self)
+        new_node.const_attr = program
+        new_node.inputs = node_list
+        return new_node
+
+    def format_name(self, node, input_names):
+        return "Fused[%s]" % node.const_attr.format_name(input_names)
+
+    def compute(self, node, input_vals, out=None):
+        program = node.const_attr
+        if program.expression is not None and numexpr is not None:
+            shape, dtype = _elementwise_result_type(node, input_vals)
+            # scalar and non-float outputs have no known result type
+            if (dtype is not None and shape is not None and dtype in _numexpr_dtypes
+                    and np.prod(shape) >= _numexpr_min_size
+                    and all(np.result_type(val) == dtype for val in input_vals)
+                    and (out is None or out.dtype == dtype)):
+                if out is None:
+                    out = np.empty(shape, dtype)
+                local_dict = dict(zip(program.input_names, input_vals))
+                local_dict.update(program.constants)
+                return numexpr.evaluate(program.expression, local_dict=local_dict, out=out, casting="unsafe")
+        return program.run(input_vals, out)
+
+    def gradient(self, node, output_grad):
+        """Fusion runs on graphs whose gradients are already built."""
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        return node.const_attr.infer(input_shapes, "infer_shape")
+
+    def infer_dtype(self, node, input_dtypes):
+        return node.const_attr.infer(input_dtypes, "infer_dtype")
+
+class _FusedProgram(object):
+    """Element-wise nodes computed by one node of FusedElementwiseOp.
+
+    Registers 0..num_inputs-1 hold the values of the fused node's inputs and
+    register num_inputs+i the value of steps[i] = (node, input registers);
+    the last register is the output. expression is the numexpr expression of
+    the steps if use_numexpr is set and numexpr supports them, else None.
+    """
+    def __init__(self, steps, num_inputs, use_numexpr=False):
+        self.steps = steps
+        self.num_inputs = num_inputs
+        # registers that are no longer needed after each step
+        last_use = {}
+        for index, (_, input_regs) in enumerate(steps):
+            for reg in input_regs:
+                last_use[reg] = index
+        self.dead_after = [[] for _ in steps]
+        for reg, index in last_use.items():
+            self.dead_after[index].append(reg)
+        self.input_names = ["x%d" % i for i in range(num_inputs)]
+        self.constants = {}
+        self.expression = self._numexpr_expression() if use_numexpr else None
+
+    def format_name(self, input_names):
+        names = list(input_names)
+        for node, input_regs in self.steps:
+            names.append(node.op.format_name(node, [names[reg] for reg in input_regs]))
+        return names[-1]
+
+    def infer(self, input_vals, method):
+        """Output shape or dtype from those of the inputs, with op.<method> of each step."""
+        vals = list(input_vals)
+        for node, input_regs in self.steps:
+            vals.append(getattr(node.op, method)(node, [vals[reg] for reg in input_regs]))
+        return vals[-1]
+
+    def run(self, input_vals, out=None):
+        """Compute the steps with ufuncs, writing each step over a dying temporary when possible."""
+        vals = list(input_vals)
+        # temporaries allocated by this run; inputs are never written
+        temps = set()
+        last = len(self.steps) - 1
+        for index, (node, input_regs) in enumerate(self.steps):
+            args = [vals[reg] for reg in input_regs]
+            buf = out if index == last else None
+            if buf is None:
+                shape, dtype = _elementwise_result_type(node, args)
+                if dtype is not None:
+                    for reg in self.dead_after[index]:
+                        val = vals[reg]
+                        if reg in temps and val.shape == shape and val.dtype == dtype:
+                            buf = val
+                            break
+            if buf is None:
+                result = node.op.compute(node, args)
+                if type(result) is np.ndarray and not any(result is arg for arg in args):
+                    temps.add(len(vals))
+            else:
+                result = node.op.compute(node, args, out=buf)
+                temps.add(len(vals))
+            vals.append(result)
+            for reg in self.dead_after[index]:
+                vals[reg] = None
+        return vals[-1]
+
+    def _numexpr_expression(self):
+        """The steps as one numexpr expression over input_names, or None if an op is not supported."""
+        exprs = list(self.input_names)
+        for node, input_regs in self.steps:
+            if node.op is add_n_op:
+                exprs.append("(%s)" % " + ".join(exprs[reg] for reg in input_regs))
+                continue
+            template = _numexpr_templates.get(node.op)
+            if template is None:
+                return None
+            const = node.const_attr
+            if const is not None:
+                if np.ndim(const) == 0 and np.isrealobj(const):
+                    const = repr(float(const))
+                else:
+                    name = "c%d" % len(self.constants)
+                    self.constants[name] = const
+                    const = name
+            exprs.append(template.format(*[exprs[reg] for reg in input_regs], c=const))
+            if len(exprs[-1]) > _numexpr_max_length:
+                return None
+        if self.num_inputs + len(self.constants) > _numexpr_max_operands:
+            return None
+        return exprs[-1]
+
+class BatchedOp(Op):
+    """Op to compute another op on inputs of which some carry a leading batch axis.
+
+    Nodes of BatchedOp are created by batch_graph, with batched[i] telling
+    whether the i-th input is batched. They share the const and matmul
+    attributes of the nodes they replace and compute through op.batched_compute.
+    """
+    def __init__(self, op, batched):
+        self.op = op
+        self.batched = batched
+        self.elementwise = op.elementwise
+        self.may_alias_inputs = op.may_alias_inputs
+
+    def format_name(self, node, input_names):
+        return "Batched%s" % self.op.format_name(node, input_names)
+
+    def compute(self, node, input_vals, out=None):
+        if out is None:
+            return self.op.batched_compute(node, input_vals, self.batched)
+        return self.op.batched_compute(node, input_vals, self.batched, out=out)
+
+    def gradient(self, node, output_grad):
+        """Differentiate before batching instead: gradient graphs can be batched."""
+        raise NotImplementedError
+
+    def infer_shape(self, node, input_shapes):
+        if not self.elementwise:
+            return None
+        ndim = max(len(shape) - b for shape, b in zip(input_shapes, self.batched))
+        if node.const_attr is not None:
+            ndim = max(ndim, np.ndim(node.const_attr))
+        input_shapes = [shape[:1] + (1,) * (ndim + 1 - len(shape)) + shape[1:] if b else shape
+                        for shape, b in zip(input_shapes, self.batched)]
+        return self.op.infer_shape(node, input_shapes)
+
+    def infer_dtype(self, node, input_dtypes):
+        return self.op.infer_dtype(node, input_dtypes)
+
 # Create global singletons of operators.
 add_op = AddOp()
+add_n_op = AddNOp()
 mul_op = MulOp()
 add_byconst_op = AddByConstOp()
 mul_byconst_op = MulByConstOp()
 matmul_op = MatMulOp()
 placeholder_op = PlaceholderOp()
+parameter_op = ParameterOp()
+apply_updates_op = ApplyUpdatesOp()
+batch_like_op = BatchLikeOp()
 oneslike_op = OnesLikeOp()
+eyelike_op = EyeLikeOp()
 zeroslike_op = ZerosLikeOp()
+reduce_sum_op = ReduceSumOp()
+reduce_mean_op = ReduceMeanOp()
+broadcast_to_op = BroadcastToOp()
+sum_to_op = SumToOp()
 
 # additional
 
@@ -432,16 +1448,357 @@ div_byconst_op = DivByConstOp()
 div_op_byconst = DivByConstOp_1()
 exp_op = ExpOp()
 log_op = LogOp()
+sigmoid_op = SigmoidOp()
+sigmoid_cross_entropy_op = SigmoidCrossEntropyOp()
+fused_elementwise_op = FusedElementwiseOp()
+
+# numexpr equivalents of element-wise ops for FusedElementwiseOp, given the
+# expressions of the inputs and of const_attr as {c}.
+_numexpr_templates = {
+    add_op: "({0} + {1})",
+    mul_op: "({0} * {1})",
+    sub_op: "({0} - {1})",
+    div_op: "({0} / {1})",
+    add_byconst_op: "({0} + {c})",
+    mul_byconst_op: "({0} * {c})",
+    sub_byconst_op: "({0} - {c})",
+    sub_op_byconst: "({c} - {0})",
+    div_byconst_op: "({0} / {c})",
+    div_op_byconst: "({c} / ({0} + 1e-11))",
+    exp_op: "exp({0})",
+    log_op: "log(abs({0} + 1e-10))",
+    sigmoid_op: "(0.5 * (tanh(0.5 * {0}) + 1))",
+}
+# Internal nodes used more than once are repeated in the expression, so it is
+# bounded, and so is the number of arrays numexpr takes.
+_numexpr_max_length = 10000
+_numexpr_max_operands = 32
+# Smaller outputs are computed by the ufunc sequence, which has less overhead
+# per call, and so are outputs of other dtypes.
+_numexpr_min_size = 2 ** 16
+_numexpr_dtypes = (np.dtype(np.float32), np.dtype(np.float64))
+
+# Executor(num_workers=...) runs serially when no fed value has this many elements,
+# since dispatching to threads then costs more than the ops themselves
+_parallel_min_size = 2 ** 16
+
+_batched_ops = {}
+
+def _batched_op(op, batched):
+    """The BatchedOp computing op with the inputs with batched[i] carrying a batch axis."""
+    key = (op, batched)
+    if key not in _batched_ops:
+        _batched_ops[key] = BatchedOp(op, batched)
+    return _batched_ops[key]
+
+_accumulating_ops = {}
+
+def _accumulating_op(op, accumulate_dtype):
+    """Variant of a reduction op singleton accumulating in accumulate_dtype."""
+    key = (op, accumulate_dtype)
+    if key not in _accumulating_ops:
+        _accumulating_ops[key] = type(op)(accumulate_dtype)
+    return _accumulating_ops[key]
+
+# Dtype policies of Executor: the dtype values are computed in, and the
+# dtype reductions accumulate in.
+dtype_policies = {
+    "float32": (np.dtype(np.float32), None),
+    "float64": (np.dtype(np.float64), None),
+    "mixed": (np.dtype(np.float32), np.dtype(np.float64)),
+}
+
+_by_const_ops = (add_byconst_op, mul_byconst_op, sub_byconst_op, sub_op_byconst, div_byconst_op, div_op_byconst)
+
+class _ExecutionPlan(object):
+    """Flat, index-based schedule compiled from a topological sort.
+
+    Every node that has to be computed or fed gets an integer slot; running the
+    plan is a replay of steps (compute, node, input slots, output slot).
+    """
+    def __init__(self, eval_node_list, feed_nodes, optimize=False, dtype=None, fuse=False):
+        topo_order = _find_needed_topo_sort(eval_node_list, feed_nodes)
+        # Snapshot of the graph structure the plan was compiled from.
+        self.structure = [(node, node.inputs, node.op) for node in topo_order]
+        self.version = _graph_version
+
+        self.optimization_report = None
+        if optimize:
+            passes = None if optimize is True else optimize
+            eval_node_list, self.optimization_report = optimize_graph(eval_node_list, feed_nodes, passes)
+        if dtype is not None:
+            eval_node_list = apply_dtype_policy(eval_node_list, feed_nodes, dtype)
+        if fuse:
+            eval_node_list = fuse_elementwise(eval_node_list, feed_nodes, use_numexpr=fuse == "numexpr")
+        if optimize or dtype is not None or fuse:
+            topo_order = _find_needed_topo_sort(eval_node_list, feed_nodes)
+        # State updates run last, so every other step reads the values from before them.
+        updates = [node for node in topo_order if node.op.updates_state]
+        if updates:
+            update_set = set(updates)
+            assert not any(i in update_set for node in topo_order if node not in update_set for i in node.inputs), \
+                "only state updates can consume the output of a state update"
+            topo_order = [node for node in topo_order if node not in update_set] + updates
+
+        node_to_slot = {node: i for i, node in enumerate(topo_order)}
+        self.num_slots = len(topo_order)
+        self.feed_slots = [(node, node_to_slot[node]) for node in topo_order if node in feed_nodes]
+        self.steps = [(node.op.compute, node, tuple(node_to_slot[i] for i in node.inputs), node_to_slot[node])
+                      for node in topo_order if node not in feed_nodes]
+        self.output_slots = [node_to_slot[node] for node in eval_node_list]
+
+        # Liveness: the slots whose value is no longer needed after each step.
+        # Fed values and outputs belong to the caller and are never released.
+        last_use = {}
+        for index, (_, _, input_slots, _) in enumerate(self.steps):
+            for slot in input_slots:
+                last_use[slot] = index
+        protected = set(self.output_slots)
+        protected.update(slot for _, slot in self.feed_slots)
+        self.dead_after = [[] for _ in self.steps]
+        for slot, index in last_use.items():
+            if slot not in protected:
+                self.dead_after[index].append(slot)
+
+        # Steps (compute, node, input slots, output slot, out buffer) specialized
+        # by Executor(static_shapes=True) for feeds with the shapes and dtypes
+        # in static_signature, and the buffers they compute into.
+        self.static_signature = None
+        self.static_steps = None
+        self.static_buffers = None
+        # see elementwise_result_types
+        self._result_types_signature = None
+        self._result_types = None
+
+        # Dependencies between steps for parallel runs: the steps consuming the
+        # output of each step, and the number of distinct steps each one waits for.
+        step_of_slot = {output_slot: index for index, (_, _, _, output_slot) in enumerate(self.steps)}
+        self.consumers = [[] for _ in self.steps]
+        self.num_dependencies = []
+        for index, (_, _, input_slots, _) in enumerate(self.steps):
+            producers = set(step_of_slot[slot] for slot in input_slots if slot in step_of_slot)
+            for producer in producers:
+                self.consumers[producer].append(index)
+            self.num_dependencies.append(len(producers))
+
+    def specialize(self, feed_dict, reuse_buffers=False):
+        """Specialize the steps for the shapes and dtypes of the values in feed_dict.
+
+        Shapes and dtypes are inferred for every step before anything is computed,
+        so shape errors surface here. Element-wise steps with a float output then
+        get a buffer allocated ahead of time to compute into; with reuse_buffers,
+        a step takes over the buffer of a value that is dead by then. Steps of
+        oneslike_op and zeroslike_op are folded into read-only broadcast constants.
+
+        Returns the bytes of fed values and step outputs of known size held
+        without and with the allocated buffers, like Executor.memory_report.
+        """
+        topo_order = [node for _, node, _, _ in self.steps]
+        shapes = _infer(topo_order, {node: np.shape(feed_dict[node]) for node, _ in self.feed_slots}, "infer_shape")
+        dtypes = _infer(topo_order, {node: np.result_type(feed_dict[node]) for node, _ in self.feed_slots},
+                        "infer_dtype")
+
+        # A value may share memory with any other value in its alias group, i.e.
+        # with the inputs of steps that can return (views of) their inputs, so a
+        # buffer is only free once the whole group is dead.
+        group = list(range(self.num_slots))
+        def find(slot):
+            while group[slot] != slot:
+                group[slot] = group[group[slot]]
+                slot = group[slot]
+            return slot
+        for _, node, input_slots, output_slot in self.steps:
+            if not node.op.elementwise and node.op.may_alias_inputs:
+                for slot in input_slots:
+                    group[find(slot)] = find(output_slot)
+        group_end = {}
+        protected = set(self.output_slots)
+        protected.update(slot for _, slot in self.feed_slots)
+        for index, dead_slots in enumerate(self.dead_after):
+            for slot in dead_slots:
+                root = find(slot)
+                group_end[root] = max(group_end.get(root, index), index)
+        for slot in protected:
+            group_end[find(slot)] = len(self.steps)
+        release_after = [[] for _ in self.steps]
+        for root, index in group_end.items():
+            if index < len(self.steps):
+                release_after[index].append(root)
+
+        naive_bytes = planned_bytes = sum(_allocated_nbytes(feed_dict[node]) for node, _ in self.feed_slots)
+        steps = []
+        buffers = []
+        owned = {}
+        pool = {}
+        for index, (compute, node, input_slots, output_slot) in enumerate(self.steps):
+            shape, dtype = shapes[node], dtypes[node]
+            nbytes = 0 if shape is None or dtype is None else int(np.prod(shape)) * dtype.itemsize
+            naive_bytes += nbytes
+            out = None
+            if shape is not None and node.op in (oneslike_op, zeroslike_op):
+                value = np.broadcast_to(np.array(1.0 if node.op is oneslike_op else 0.0, dtype=dtype), shape)
+                compute = functools.partial(_constant_compute, value)
+            elif node.op.elementwise and shape and dtype is not None and dtype.kind == "f":
+                if pool.get((shape, dtype)):
+                    out = pool[(shape, dtype)].pop()
+                else:
+                    out = np.empty(shape, dtype)
+                    buffers.append(out)
+                    planned_bytes += nbytes
+                owned.setdefault(find(output_slot), []).append(out)
+            else:
+                planned_bytes += nbytes
+            steps.append((compute, node, input_slots, output_slot, out))
+            if reuse_buffers:
+                for root in release_after[index]:
+                    for buf in owned.pop(root, ()):
+                        pool.setdefault((buf.shape, buf.dtype), []).append(buf)
+
+        self.static_signature = _feed_signature(self, feed_dict)
+        self.static_steps = steps
+        self.static_buffers = buffers
+        return naive_bytes, planned_bytes
+
+    def elementwise_result_types(self, feed_dict):
+        """Per step, the _elementwise_result_type of an element-wise step for the
+        shapes and dtypes of the values in feed_dict, (None, None) for other steps,
+        or None where inference cannot tell before the step is computed.
+
+        Inferred once per signature of the feeds and reused by the following runs.
+        """
+        signature = _feed_signature(self, feed_dict)
+        if self._result_types_signature != signature:
+            topo_order = [node for _, node, _, _ in self.steps]
+            shapes = _infer(topo_order, {node: np.shape(feed_dict[node]) for node, _ in self.feed_slots},
+                            "infer_shape")
+            dtypes = _infer(topo_order, {node: np.result_type(feed_dict[node]) for node, _ in self.feed_slots},
+                            "infer_dtype")
+            result_types = []
+            for node in topo_order:
+                shape, dtype = shapes[node], dtypes[node]
+                if not node.op.elementwise:
+                    result_types.append((None, None))
+                elif shape is None or dtype is None:
+                    result_types.append(None)
+                elif dtype.kind != "f" or shape == ():
+                    result_types.append((None, None))
+                else:
+                    result_types.append((shape, dtype))
+            self._result_types = result_types
+            self._result_types_signature = signature
+        return self._result_types
+
+    def is_valid(self):
+        """Return whether the graph reachable from the outputs is unchanged since compilation."""
+        if self.version == _graph_version:
+            return True
+        for node, inputs, op in self.structure:
+            if node.inputs is not inputs or node.op is not op:
+                return False
+        self.version = _graph_version
+        return True
 
 class Executor:
     """Executor computes values for a given subset of nodes in a computation graph.""" 
-    def __init__(self, eval_node_list):
+    # compiled plans kept, the least recently used is dropped first
+    max_plans = 8
+
+    def __init__(self, eval_node_list, optimize=False, memory_plan=False, static_shapes=False, dtype=None,
+                 fuse=False, num_workers=None, profiler=None):
         """
         Parameters
         ----------
         eval_node_list: list of nodes whose values need to be computed.
+        optimize: whether to run graph optimization passes when compiling.
+            True runs default_graph_passes, a list runs those passes instead.
+            The user's graph is never modified.
+        memory_plan: whether to release intermediate values after their last
+            consumer and recycle their buffers through the out= argument of
+            element-wise ops. Each run then stores its planned peak memory and
+            the peak without planning in memory_report.
+        static_shapes: whether to specialize the plan for the shapes and
+            dtypes in feed_dict. They are propagated with infer_shapes before
+            the first run and whenever they change, so shape errors surface
+            before anything is computed; element-wise nodes then get output
+            buffers allocated ahead of time (shared following memory_plan)
+            that every run computes into, and oneslike_op/zeroslike_op nodes
+            become read-only constants. Arrays returned by run are overwritten
+            by the following run, so copy any that have to outlive it.
+        dtype: dtype policy, one of the keys of dtype_policies or None.
+            "float32" and "float64" convert numeric fed values, array
+            constants and Parameter values (in place, for good) to that
+            dtype, so every node is computed in it;
+            "mixed" computes in float32 but accumulates reduce_sum_op,
+            reduce_mean_op and sum_to_op in float64. With None, values
+            have whatever dtype numpy gives them.
+        fuse: whether to compute groups of connected element-wise nodes as
+            single kernels (see fuse_elementwise), after the other passes.
+            "numexpr" also evaluates large float32/float64 kernels with
+            numexpr, which pays off with many cores.
+        num_workers: number of threads computing independent nodes at the
+            same time, or None to compute one node after the other. NumPy
+            releases the GIL in large ufuncs and matmuls, so branches of the
+            graph that do not depend on each other overlap. Runs whose fed
+            values all have fewer than _parallel_min_size elements stay
+            serial. Cannot be combined with memory_plan, which recycles
+            buffers in the serial order. The threads are started on the
+            first parallel run and stopped by close (or with the executor
+            as a context manager), or when the executor is garbage collected.
+        profiler: Profiler recording every computed node, or None. It can
+            also be set or removed later through the profiler attribute;
+            without one, runs are not instrumented at all.
         """
         self.eval_node_list = eval_node_list
+        self.optimize = optimize
+        self.memory_plan = memory_plan
+        self.static_shapes = static_shapes
+        assert dtype is None or dtype in dtype_policies, "unknown dtype policy %s" % dtype
+        self.dtype = dtype
+        assert fuse in (False, True, "numexpr"), "fuse is a bool or \"numexpr\""
+        self.fuse = fuse
+        assert num_workers is None or num_workers > 0, "num_workers has to be positive"
+        assert num_workers is None or not memory_plan, "memory_plan needs a serial schedule"
+        self.num_workers = num_workers
+        self._pool = None
+        self._pool_finalizer = None
+        self.profiler = profiler
+        self.memory_report = None
+        # compiled plans keyed by the set of nodes in feed_dict, least recently used first
+        self._plans = collections.OrderedDict()
+        # nodes removed by each optimization pass in the latest compilation
+        self.optimization_report = None
+
+    def compile(self, feed_nodes):
+        """Return the execution plan for the given fed nodes, compiling it if necessary.
+
+        The plan is cached and reused until the graph reachable from eval_node_list changes.
+        The max_plans most recently used sets of fed nodes keep their plans.
+        """
+        feed_nodes = frozenset(feed_nodes)
+        plan = self._plans.get(feed_nodes)
+        if plan is None or not plan.is_valid():
+            plan = _ExecutionPlan(self.eval_node_list, feed_nodes, self.optimize, self.dtype, self.fuse)
+            self._plans[feed_nodes] = plan
+            self.optimization_report = plan.optimization_report
+        self._plans.move_to_end(feed_nodes)
+        while len(self._plans) > self.max_plans:
+            self._plans.popitem(last=False)
+        return plan
+
+    def close(self):
+        """Stop the worker threads of num_workers, if started. Later parallel runs start new ones."""
+        if self._pool is None:
+            return
+        self._pool_finalizer.detach()
+        self._pool.shutdown()
+        self._pool = None
+        self._pool_finalizer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def run(self, feed_dict):
         """Computes values of nodes in eval_node_list given computation graph.
@@ -453,68 +1810,1280 @@ class Executor:
         -------
         A list of values for nodes in eval_node_list. 
         """
-        node_to_val_map = dict(feed_dict)
-    
-        # Traverse graph in topological sort order and compute values for all nodes.
-        topo_order = find_topo_sort(self.eval_node_list)
-     
-        """TODO: Your code here"""
-       
-        for t in topo_order:
-            inp = []
-            if t in node_to_val_map.keys():
-                pass
-            else:
-                for input_nodes in t.inputs:
-                    inp.append(node_to_val_map[input_nodes])
-                node_to_val_map[t] = t.op.compute(t, inp)
+        plan = self.compile(feed_dict)
+        if self.dtype is not None:
+            feed_dict = _cast_feeds(feed_dict, dtype_policies[self.dtype][0])
+        if self.static_shapes:
+            return self._run_static(plan, feed_dict)
+        steps = plan.steps if self.profiler is None else self.profiler.instrument(plan.steps)
+        if self.memory_plan:
+            return self._run_memory_planned(plan, steps, feed_dict)
+        vals = [None] * plan.num_slots
+        for node, slot in plan.feed_slots:
+            vals[slot] = feed_dict[node]
+        if self._runs_parallel(feed_dict):
+            self._run_parallel(plan, steps, vals)
+            return [vals[i] for i in plan.output_slots]
+        for compute, node, input_slots, output_slot in steps:
+            vals[output_slot] = compute(node, [vals[i] for i in input_slots])
         # Collect node values.
-        node_val_results = [node_to_val_map[node] for node in self.eval_node_list]
-        return node_val_results
+        return [vals[i] for i in plan.output_slots]
+
+    def _run_static(self, plan, feed_dict):
+        """Run the plan specialized for the feed shapes, computing into its preallocated buffers."""
+        if (_feed_signature(plan, feed_dict) != plan.static_signature
+                or _feeds_alias_buffers(feed_dict, plan.static_buffers)):
+            naive_bytes, planned_bytes = plan.specialize(feed_dict, self.memory_plan)
+            if self.memory_plan:
+                self.memory_report = {"naive_peak_bytes": naive_bytes, "planned_peak_bytes": planned_bytes,
+                                      "reused_buffers": sum(out is not None for *_, out in plan.static_steps)
+                                      - len(plan.static_buffers)}
+        steps = plan.static_steps if self.profiler is None else self.profiler.instrument(plan.static_steps)
+        vals = [None] * plan.num_slots
+        for node, slot in plan.feed_slots:
+            vals[slot] = feed_dict[node]
+        if self._runs_parallel(feed_dict):
+            self._run_parallel(plan, steps, vals)
+            return [vals[i] for i in plan.output_slots]
+        for step in steps:
+            _run_step(step, vals)
+        return [vals[i] for i in plan.output_slots]
+
+    def _runs_parallel(self, feed_dict):
+        return (self.num_workers is not None and self.num_workers > 1
+                and any(np.size(val) >= _parallel_min_size for val in feed_dict.values()))
+
+    def _run_parallel(self, plan, steps, vals):
+        """Run steps (plan.steps or plan.static_steps) on the thread pool, each as soon as its inputs are computed.
+
+        Only the calling thread touches the dependency counts: it dispatches
+        every ready step, then waits for any of them to finish. State updates
+        run afterwards on the calling thread, in plan order.
+        """
+        if self._pool is None:
+            pool = concurrent.futures.ThreadPoolExecutor(self.num_workers)
+            self._pool_finalizer = weakref.finalize(self, pool.shutdown, wait=False)
+            self._pool = pool
+        remaining = list(plan.num_dependencies)
+        updates = [index for index, step in enumerate(steps) if step[1].op.updates_state]
+        update_set = set(updates)
+        ready = [index for index, count in enumerate(remaining) if count == 0 and index not in update_set]
+        running = {}
+        try:
+            while ready or running:
+                if len(ready) == 1 and not running:
+                    # nothing to overlap with, skip the round trip through the pool
+                    finished = [ready.pop()]
+                    _run_step(steps[finished[0]], vals)
+                else:
+                    for index in ready:
+                        running[self._pool.submit(_run_step, steps[index], vals)] = index
+                    ready = []
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    finished = []
+                    for future in done:
+                        future.result()
+                        finished.append(running.pop(future))
+                for index in finished:
+                    for consumer in plan.consumers[index]:
+                        remaining[consumer] -= 1
+                        if remaining[consumer] == 0 and consumer not in update_set:
+                            ready.append(consumer)
+        finally:
+            # let steps still in flight finish before the caller sees an error
+            concurrent.futures.wait(running)
+        for index in updates:
+            _run_step(steps[index], vals)
+
+    def _run_memory_planned(self, plan, steps, feed_dict):
+        """Run steps (plan.steps, or an instrumented copy), freeing values after their last use and reusing their buffers.
+
+        A buffer is only overwritten when nothing but the executor refers to it,
+        which is checked with its reference count, so values that are aliased,
+        viewed, fed or returned are never clobbered.
+        """
+        vals = [None] * plan.num_slots
+        naive_bytes = 0
+        for node, slot in plan.feed_slots:
+            vals[slot] = feed_dict[node]
+            naive_bytes += _allocated_nbytes(vals[slot])
+        live_bytes = peak_bytes = naive_bytes
+        num_reused = 0
+        result_types = plan.elementwise_result_types(feed_dict)
+        # released buffers by (shape, dtype)
+        pool = {}
+        for index, (compute, node, input_slots, output_slot) in enumerate(steps):
+            dead_slots = plan.dead_after[index]
+            input_vals = [vals[i] for i in input_slots]
+            out = None
+            if node.op.elementwise:
+                shape, dtype = result_types[index] or _elementwise_result_type(node, input_vals)
+                if dtype is not None:
+                    # Prefer writing over an input that dies here, else recycle a released buffer.
+                    # An input read more than once is not offered, since the later reads
+                    # could see the output already written over it.
+                    for slot in dead_slots:
+                        buf = vals[slot]
+                        if (type(buf) is np.ndarray and buf.shape == shape and buf.dtype == dtype
+                                and buf.base is None and buf.flags.writeable
+                                and input_slots.count(slot) == 1 and sys.getrefcount(buf) == 4):
+                            out = buf
+                            break
+                    buf = None
+                    if out is None and pool.get((shape, dtype)):
+                        out = pool[(shape, dtype)].pop()
+            if out is None:
+                result = compute(node, input_vals)
+                allocated = _allocated_nbytes(result, input_vals)
+                naive_bytes += allocated
+                live_bytes += allocated
+            else:
+                result = compute(node, input_vals, out=out)
+                naive_bytes += out.nbytes
+                num_reused += 1
+            vals[output_slot] = result
+            peak_bytes = max(peak_bytes, live_bytes)
+            input_vals = out = result = None
+            for slot in dead_slots:
+                buf = vals[slot]
+                vals[slot] = None
+                if type(buf) is np.ndarray and buf.base is None and sys.getrefcount(buf) == 2:
+                    if buf.flags.writeable:
+                        pool.setdefault((buf.shape, buf.dtype), []).append(buf)
+                    else:
+                        live_bytes -= buf.nbytes
+                buf = None
+        self.memory_report = {"naive_peak_bytes": naive_bytes, "planned_peak_bytes": peak_bytes,
+                              "reused_buffers": num_reused}
+        return [vals[i] for i in plan.output_slots]
+
+class Profiler(object):
+    """Records the time, allocations and output of every node an Executor computes.
+
+    Attach it with Executor(..., profiler=Profiler()) or executor.profiler.
+    Per node and per op type it keeps the number of calls, the wall time and
+    the bytes newly allocated for outputs (nothing for outputs written to
+    preallocated buffers, views, or inputs passed through), with the shape and
+    dtype of the latest output. Every call is also kept as an event for
+    chrome_trace.
+    """
+    # instrumented step lists kept, the most recently used first out
+    max_instrumented = 16
 
-def gradients(output_node, node_list):
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        """Forget everything recorded so far."""
+        # node -> [calls, nanoseconds, bytes allocated, shape, dtype]
+        self.node_stats = {}
+        # (node, thread id, start, end) in perf_counter_ns
+        self.events = []
+        # id of a list of steps -> (the steps, their instrumented copy), least recently used first
+        self._instrumented = collections.OrderedDict()
+
+    def instrument(self, steps):
+        """Return a copy of the steps of an execution plan whose computes are recorded."""
+        key = id(steps)
+        entry = self._instrumented.get(key)
+        if entry is not None and entry[0] is steps:
+            self._instrumented.move_to_end(key)
+            return entry[1]
+        entry = (steps, [(self._timed(step[0]),) + tuple(step[1:]) for step in steps])
+        self._instrumented[key] = entry
+        self._instrumented.move_to_end(key)
+        while len(self._instrumented) > self.max_instrumented:
+            self._instrumented.popitem(last=False)
+        return entry[1]
+
+    def _timed(self, compute):
+        node_stats = self.node_stats
+        events = self.events
+        def timed_compute(node, input_vals, out=None):
+            start = time.perf_counter_ns()
+            if out is None:
+                val = compute(node, input_vals)
+            else:
+                val = compute(node, input_vals, out=out)
+            end = time.perf_counter_ns()
+            stats = node_stats.get(node)
+            if stats is None:
+                stats = node_stats[node] = [0, 0, 0, None, None]
+            stats[0] += 1
+            stats[1] += end - start
+            if out is None:
+                stats[2] += _allocated_nbytes(val, input_vals)
+            if val is not None:
+                stats[3] = np.shape(val)
+                stats[4] = np.result_type(val)
+            events.append((node, threading.get_ident(), start, end))
+            return val
+        return timed_compute
+
+    def op_stats(self):
+        """Totals per op type: a dict from op class name to [calls, nanoseconds, bytes allocated]."""
+        totals = {}
+        for node, (calls, nanoseconds, nbytes, _, _) in self.node_stats.items():
+            total = totals.setdefault(_op_type_name(node.op), [0, 0, 0])
+            total[0] += calls
+            total[1] += nanoseconds
+            total[2] += nbytes
+        return totals
+
+    def report(self, top=10, by="node"):
+        """Return a table of the top nodes (or op types with by="op") by total time, as a string."""
+        assert by in ("node", "op"), "by is node or op"
+        if by == "op":
+            rows = sorted(self.op_stats().items(), key=lambda item: -item[1][1])[:top]
+            lines = ["%-24s %8s %12s %12s" % ("op", "calls", "time (ms)", "alloc (KB)")]
+            for name, (calls, nanoseconds, nbytes) in rows:
+                lines.append("%-24s %8d %12.3f %12.1f" % (name, calls, nanoseconds / 1e6, nbytes / 1024.0))
+            return "\n".join(lines)
+        rows = sorted(self.node_stats.items(), key=lambda item: -item[1][1])[:top]
+        lines = ["%-40s %8s %12s %12s  %s" % ("node", "calls", "time (ms)", "alloc (KB)", "output")]
+        for node, (calls, nanoseconds, nbytes, shape, dtype) in rows:
+            output = "None" if shape is None else "%s %s" % (dtype, shape)
+            lines.append("%-40s %8d %12.3f %12.1f  %s" % (_short_name(node, 40), calls, nanoseconds / 1e6,
+                                                          nbytes / 1024.0, output))
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        """Return the recorded calls in the Chrome trace event format (chrome://tracing, Perfetto)."""
+        trace_events = []
+        for node, thread, start, end in self.events:
+            stats = self.node_stats[node]
+            trace_events.append({"name": node._name or _op_type_name(node.op), "cat": _op_type_name(node.op),
+                                 "ph": "X", "ts": start / 1e3, "dur": (end - start) / 1e3, "pid": 0, "tid": thread,
+                                 "args": {"node": id(node), "shape": str(stats[3]), "dtype": str(stats[4])}})
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def save_chrome_trace(self, path):
+        """Write chrome_trace() to a JSON file."""
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+def gradients(output_node, node_list, output_grad=None):
     """Take gradient of output node with respect to each node in node_list.
 
     Parameters
     ----------
     output_node: output node that we are taking derivative of.
     node_list: list of nodes that we are taking derivative wrt.
+    output_grad: node of the cotangent (seed) to propagate back from
+        output_node, oneslike_op(output_node) if None.
 
     Returns
     -------
     A list of gradient values, one for each node in node_list respectively.
+    Nodes that output_node does not depend on get zeroslike_op(node).
 
     """
 
+    # Only nodes on a path from output_node to a node in node_list take part
+    # in backprop; gradients flowing into other branches (e.g. labels) are dropped.
+    wrt_nodes = set(node_list)
+    topo_order = find_topo_sort([output_node])
+    on_path = set()
+    for node in topo_order:
+        if node in wrt_nodes or any(input_node in on_path for input_node in node.inputs):
+            on_path.add(node)
+
     # a map from node to a list of gradient contributions from each output node
     node_to_output_grads_list = {}
     # Special note on initializing gradient of output_node as oneslike_op(output_node):
     # We are really taking a derivative of the scalar reduce_sum(output_node)
     # instead of the vector output_node. But this is the common case for loss function.
-    node_to_output_grads_list[output_node] = [oneslike_op(output_node)]
+    if output_node in on_path:
+        if output_grad is None:
+            output_grad = oneslike_op(output_node)
+        node_to_output_grads_list[output_node] = [output_grad]
     # a map from node to the gradient of that node
     node_to_output_grad = {}
     # Traverse graph in reverse topological order given the output_node that we are taking gradient wrt.
-    reverse_topo_order = reversed(find_topo_sort([output_node]))
-    """TODO: Your code here"""
-    node_to_output_grad[output_node] = node_to_output_grads_list[output_node][0]
-    for t in reverse_topo_order:
-        upstream_gradient = node_to_output_grad[t]
-        backprop_gradient = t.op.gradient(t, upstream_gradient)
-        count = 0
-        for i in t.inputs:
-            if i in node_to_output_grad:
-               node_to_output_grad[i] += backprop_gradient[count]
-            else:
-                node_to_output_grad[i] = backprop_gradient[count]
-            count += 1
-           
-
+    for node in reversed(topo_order):
+        if node not in on_path:
+            continue
+        # All consumers of node come later in topological order, so every
+        # contribution has been collected by now; sum them with one add_n node.
+        output_grad = sum_node_list(node_to_output_grads_list[node])
+        node_to_output_grad[node] = output_grad
+        if node.inputs and any(input_node in on_path for input_node in node.inputs):
+            input_grads = node.op.gradient(node, output_grad)
+            for input_node, input_grad in zip(node.inputs, input_grads):
+                if input_node in on_path:
+                    node_to_output_grads_list.setdefault(input_node, []).append(input_grad)
 
     # Collect results for gradients requested.
-    grad_node_list = [node_to_output_grad[node] for node in node_list]
+    grad_node_list = [node_to_output_grad[node] if node in node_to_output_grad else zeroslike_op(node)
+                      for node in node_list]
     return grad_node_list
 
+class GradientCache(object):
+    """LRU memo of gradient graphs, keyed on the output node and the gradient seed.
+
+    Asking again for gradients of the same output returns the nodes built the
+    first time, so a loss that is differentiated over and over (e.g. once per
+    run of a hyperparameter sweep) gets a single gradient graph. Every entry
+    remembers the set of nodes it has gradients for, and any subset of that set
+    is served from it. When a request adds new nodes, the entry is rebuilt for
+    the union of old and new ones, so both are served afterwards.
+
+    An entry is dropped when the graph reachable from its output has been
+    rewired since it was built (the check of _ExecutionPlan.is_valid).
+    """
+    def __init__(self, maxsize=128):
+        """
+        Parameters
+        ----------
+        maxsize: number of (output, seed) entries to keep, the least recently
+            used entry is evicted first.
+        """
+        assert maxsize > 0, "maxsize has to be positive"
+        self.maxsize = maxsize
+        # (output_node, output_grad) -> _GradientCacheEntry, least recently used first
+        self._entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def gradients(self, output_node, node_list, output_grad=None):
+        """Same as the module function gradients, but memoized."""
+        key = (output_node, output_grad)
+        entry = self._entries.get(key)
+        if entry is not None and not entry.is_valid():
+            del self._entries[key]
+            entry = None
+        if entry is not None and all(node in entry.grads for node in node_list):
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return [entry.grads[node] for node in node_list]
+
+        self.misses += 1
+        wrt_list = list(node_list) if entry is None else list(entry.grads)
+        wrt_list.extend(node for node in node_list if node not in wrt_list)
+        grad_node_list = gradients(output_node, wrt_list, output_grad)
+        self._entries[key] = entry = _GradientCacheEntry(output_node, output_grad, wrt_list, grad_node_list)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return [entry.grads[node] for node in node_list]
+
+    def stats(self):
+        """Return a dict with the hits, misses, evictions and current size."""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "size": len(self)}
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+class _GradientCacheEntry(object):
+    """Gradient nodes of one output, with a snapshot of the graph they were built from."""
+    def __init__(self, output_node, output_grad, wrt_list, grad_node_list):
+        roots = [output_node] if output_grad is None else [output_node, output_grad]
+        self.structure = [(node, node.inputs, node.op) for node in find_topo_sort(roots)]
+        self.version = _graph_version
+        self.grads = dict(zip(wrt_list, grad_node_list))
+
+    # graph changes are detected the same way as for execution plans
+    is_valid = _ExecutionPlan.is_valid
+
+# memo used by cached_gradients
+gradient_cache = GradientCache()
+
+def cached_gradients(output_node, node_list, output_grad=None):
+    """gradients through the module-level gradient_cache, see GradientCache."""
+    return gradient_cache.gradients(output_node, node_list, output_grad)
+
+class Optimizer(object):
+    """Base class of optimizers that update Parameter nodes inside Executor.run.
+
+    Subclasses allocate per-parameter state once in init_state and change the
+    parameter value in place in update, using the state arrays as scratch
+    space, so a training step allocates no arrays for the update.
+    Hyperparameters are plain attributes and can be changed between runs.
+    """
+    def minimize(self, loss, param_list):
+        """Return a node that, when run, takes one step on param_list to decrease loss.
+
+        The node's value is None; run it together with the loss, e.g.
+        Executor([loss, update]). It is computed after every other node, so
+        the loss is computed with the parameter values before the update.
+        """
+        return apply_updates_op(param_list, gradients(loss, param_list), self)
+
+    def init_state(self, param_val):
+        """Return the state kept for a parameter with value param_val."""
+        return {"scratch": np.zeros_like(param_val)}
+
+    def update(self, param_val, grad_val, state, step):
+        """Update param_val in place given its gradient, state and the 1-based step number."""
+        raise NotImplementedError
+
+class SGD(Optimizer):
+    """param -= learning_rate * grad"""
+    def __init__(self, learning_rate=0.01):
+        self.learning_rate = learning_rate
+
+    def update(self, param_val, grad_val, state, step):
+        scratch = state["scratch"]
+        np.multiply(grad_val, self.learning_rate, out=scratch)
+        np.subtract(param_val, scratch, out=param_val)
+
+class Momentum(Optimizer):
+    """velocity = momentum * velocity + grad; param -= learning_rate * velocity"""
+    def __init__(self, learning_rate=0.01, momentum=0.9):
+        self.learning_rate = learning_rate
+        self.momentum = momentum
+
+    def init_state(self, param_val):
+        return {"scratch": np.zeros_like(param_val), "velocity": np.zeros_like(param_val)}
+
+    def update(self, param_val, grad_val, state, step):
+        velocity, scratch = state["velocity"], state["scratch"]
+        np.multiply(velocity, self.momentum, out=velocity)
+        np.add(velocity, grad_val, out=velocity)
+        np.multiply(velocity, self.learning_rate, out=scratch)
+        np.subtract(param_val, scratch, out=param_val)
+
+class Adam(Optimizer):
+    """Adam (Kingma and Ba), with bias-corrected first and second moment estimates."""
+    def __init__(self, learning_rate=0.001, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        self.learning_rate = learning_rate
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+
+    def init_state(self, param_val):
+        return {"scratch": np.zeros_like(param_val), "m": np.zeros_like(param_val), "v": np.zeros_like(param_val)}
+
+    def update(self, param_val, grad_val, state, step):
+        m, v, scratch = state["m"], state["v"], state["scratch"]
+        # m = beta1 * m + (1 - beta1) * grad
+        np.multiply(m, self.beta1, out=m)
+        np.multiply(grad_val, 1 - self.beta1, out=scratch)
+        np.add(m, scratch, out=m)
+        # v = beta2 * v + (1 - beta2) * grad^2
+        np.multiply(v, self.beta2, out=v)
+        np.multiply(grad_val, grad_val, out=scratch)
+        np.multiply(scratch, 1 - self.beta2, out=scratch)
+        np.add(v, scratch, out=v)
+        # param -= step_size * m / (sqrt(v) + epsilon), the bias corrections folded into step_size
+        step_size = self.learning_rate * (1 - self.beta2 ** step) ** 0.5 / (1 - self.beta1 ** step)
+        np.sqrt(v, out=scratch)
+        np.add(scratch, self.epsilon, out=scratch)
+        np.divide(m, scratch, out=scratch)
+        np.multiply(scratch, step_size, out=scratch)
+        np.subtract(param_val, scratch, out=param_val)
+
+def jvp(output_nodes, input_node, tangent_node, vectorized=False):
+    """Build the forward-mode derivatives of output nodes along a tangent of input_node.
+
+    Parameters
+    ----------
+    output_nodes: list of nodes to differentiate.
+    input_node: node that the tangent is a perturbation of, or a list of nodes.
+    tangent_node: node whose value is the tangent (direction) of input_node,
+        or a list with one tangent node per input node.
+    vectorized: whether the value of tangent_node stacks many tangents along a
+        leading axis, e.g. the rows of an identity for the columns of a Jacobian.
+        The tangent graph is then batched over that axis, so all directions
+        are pushed through in one run.
+
+    Returns
+    -------
+    A list of tangent nodes, the Jacobian-vector products of output_nodes
+    (with the leading axis of tangent_node if vectorized). Outputs that do not
+    depend on input_node get an unbatched zeroslike_op tangent.
+    """
+    if isinstance(input_node, Node):
+        input_node, tangent_node = [input_node], [tangent_node]
+    node_to_tangent = dict(zip(input_node, tangent_node))
+    for node in find_topo_sort(output_nodes):
+        if node in node_to_tangent or not node.inputs:
+            continue
+        input_tangents = [node_to_tangent.get(i) for i in node.inputs]
+        if any(tangent is not None for tangent in input_tangents):
+            tangent = node.op.jvp(node, input_tangents)
+            if tangent is not None:
+                node_to_tangent[node] = tangent
+    tangent_nodes = [node_to_tangent.get(node) for node in output_nodes]
+    if vectorized:
+        batched_nodes = batch_graph([t for t in tangent_nodes if t is not None], tangent_node)
+        batched_nodes.reverse()
+        tangent_nodes = [None if t is None else batched_nodes.pop() for t in tangent_nodes]
+    return [zeroslike_op(node) if tangent is None else tangent
+            for node, tangent in zip(output_nodes, tangent_nodes)]
+
+def jacobian(output_node, node_list):
+    """Build the Jacobians of output_node with respect to each node in node_list.
+
+    A single reverse-mode graph is built from a placeholder cotangent and then
+    batched over a stacked identity seed (eyelike_op(output_node)), so one run
+    propagates the cotangents of all output elements at once.
+
+    Returns
+    -------
+    A list of nodes, one per node in node_list, of shape (output size,) + shape
+    of the node: row i is the gradient of the i-th element of output_node in C order.
+    Nodes that output_node does not depend on get rows of zeros.
+    """
+    seed = placeholder_op()
+    grad_node_list = gradients(output_node, node_list, seed)
+    batched_grad_node_list, is_batched = _batch_graph(grad_node_list, [seed])
+    batch_like = _batched_op(batch_like_op, (False, True))
+    for i, node in enumerate(batched_grad_node_list):
+        if not is_batched[i]:
+            # a zeroslike_op gradient, repeated for every row
+            batched_grad_node_list[i] = batch_like_op(node, seed)
+            batched_grad_node_list[i].op = batch_like
+    # the placeholder only stands in for the rows of the identity
+    stacked_seed = eyelike_op(output_node)
+    return _replace_nodes(batched_grad_node_list, {seed: stacked_seed})
+
+def hvp(output_node, node_list, vector_list, vectorized=False):
+    """Build the Hessian-vector products of the scalar output_node.
+
+    Forward mode over reverse mode: the tangent of the gradients of output_node
+    with respect to node_list along vector_list.
+
+    Parameters
+    ----------
+    output_node: scalar node, e.g. a loss.
+    node_list: list of nodes that the Hessian is taken with respect to.
+    vector_list: list of nodes, one per node in node_list, whose values are the
+        vector to multiply with the Hessian, split the same way as node_list.
+    vectorized: whether the values in vector_list stack many vectors along a
+        leading axis, see jvp.
+
+    Returns
+    -------
+    A list of nodes, one per node in node_list: the blocks of the product.
+    """
+    return jvp(gradients(output_node, node_list), node_list, vector_list, vectorized)
+
+def batch_graph(node_list, batched_nodes):
+    """Rewrite the graph ending in node_list for values of batched_nodes with a leading batch axis.
+
+    Every node that depends on a batched node is replaced by a node of
+    BatchedOp computing all elements of the batch at once; other nodes are kept.
+    Returns the list of nodes replacing node_list.
+    """
+    return _batch_graph(node_list, batched_nodes)[0]
+
+def vmap(node_list, batched_nodes):
+    """Vectorize the graph ending in node_list over a leading batch axis of batched_nodes.
+
+    The values fed for batched_nodes (placeholders or parameters) stack K
+    values each, e.g. the weights of K models of an ensemble, and every output
+    gets a leading axis of length K with the outputs for each of them.
+    Element-wise ops broadcast the batch axis, reductions skip it and
+    matmul_op becomes a batched matmul, so all K evaluations take one run of
+    the rewritten graph. Outputs that do not depend on batched_nodes are
+    repeated along the batch axis.
+
+    Differentiate first and vmap the gradient nodes, the batched graph is
+    not differentiable:
+
+        grads = gradients(loss, [w, b])
+        loss_k, grad_w_k, grad_b_k = vmap([loss] + grads, [w, b])
+
+    Returns the list of nodes replacing node_list.
+    """
+    batched_nodes = list(batched_nodes)
+    assert batched_nodes, "nothing to batch over"
+    batched_node_list, is_batched = _batch_graph(node_list, batched_nodes)
+    batch_like = _batched_op(batch_like_op, (False, True))
+    for i, node in enumerate(batched_node_list):
+        if not is_batched[i]:
+            batched_node_list[i] = batch_like_op(node, batched_nodes[0])
+            batched_node_list[i].op = batch_like
+    return batched_node_list
+
+def _batch_graph(node_list, batched_nodes):
+    """batch_graph, also returning whether each of the returned nodes is batched."""
+    batched_nodes = set(batched_nodes)
+    replacement = {}
+    is_batched = {}
+    for node in find_topo_sort(node_list):
+        if node in batched_nodes or not node.inputs:
+            replacement[node] = node
+            is_batched[node] = node in batched_nodes
+            continue
+        inputs = [replacement[i] for i in node.inputs]
+        batched = tuple(is_batched[i] for i in node.inputs)
+        if any(batched):
+            new_node = _copy_node(node, inputs)
+            new_node.op = _batched_op(node.op, batched)
+            is_batched[node] = node.op.batched_output(batched)
+        else:
+            new_node = _clone_with_inputs(node, inputs)
+            is_batched[node] = False
+        replacement[node] = new_node
+    return [replacement[node] for node in node_list], [is_batched[node] for node in node_list]
+
+##############################
+######## Graph Passes ######## 
+##############################
+
+def infer_shapes(node_list, feed_shapes):
+    """Propagate shapes from the fed nodes through the graph ending in node_list.
+
+    Parameters
+    ----------
+    node_list: list of output nodes.
+    feed_shapes: dict mapping fed nodes (usually placeholders) to the shapes of their values.
+
+    Returns
+    -------
+    A dict mapping each node needed for node_list to its shape, or to None if its
+    shape depends on a node that is not fed. Incompatible shapes, e.g. of a
+    matmul_op, fail with an AssertionError before anything is computed.
+    """
+    shapes = {node: tuple(shape) for node, shape in feed_shapes.items()}
+    return _infer(_find_needed_topo_sort(node_list, feed_shapes), shapes, "infer_shape")
+
+def infer_dtypes(node_list, feed_dtypes):
+    """Propagate dtypes from the fed nodes through the graph ending in node_list.
+
+    Same as infer_shapes, with feed_dtypes mapping fed nodes to dtypes.
+    """
+    dtypes = {node: np.dtype(dtype) for node, dtype in feed_dtypes.items()}
+    return _infer(_find_needed_topo_sort(node_list, feed_dtypes), dtypes, "infer_dtype")
+
+def apply_dtype_policy(node_list, feed_nodes, policy):
+    """Rewrite the graph ending in node_list to compute in the dtype of a policy in dtype_policies.
+
+    Float-promoting array constants of by-const ops are converted to the compute
+    dtype (Python scalars already adopt the dtype of the array they meet), and
+    with an accumulation dtype the reduction ops are replaced by variants that
+    accumulate in it. Fed values have to be converted by the caller.
+    Parameter values and the optimizer states of their updates are kept across
+    runs, so they are converted to the compute dtype in place.
+    Returns a list of nodes equivalent to node_list.
+    """
+    dtype, accumulate_dtype = dtype_policies[policy]
+    replacement = {}
+    for node in find_topo_sort(node_list):
+        if node.op is parameter_op and node.const_attr.dtype.kind == "f" and node.const_attr.dtype != dtype:
+            node.const_attr = node.const_attr.astype(dtype)
+        elif node.op is apply_updates_op:
+            for state in node.const_attr.states:
+                for key, val in state.items():
+                    if isinstance(val, np.ndarray) and val.dtype.kind == "f" and val.dtype != dtype:
+                        state[key] = val.astype(dtype)
+        if node in feed_nodes or not node.inputs:
+            replacement[node] = node
+            continue
+        inputs = [replacement[i] for i in node.inputs]
+        const = node.const_attr
+        cast_const = (node.op in _by_const_ops and isinstance(const, (np.ndarray, np.generic))
+                      and const.dtype != dtype and const.dtype.kind in "biuf")
+        accumulate = accumulate_dtype is not None and node.op in (reduce_sum_op, reduce_mean_op, sum_to_op)
+        if cast_const or accumulate:
+            new_node = _copy_node(node, inputs)
+            if cast_const:
+                new_node.const_attr = np.asarray(const, dtype=dtype)
+            if accumulate:
+                new_node.op = _accumulating_op(node.op, accumulate_dtype)
+        else:
+            new_node = _clone_with_inputs(node, inputs)
+        replacement[node] = new_node
+    return [replacement[node] for node in node_list]
+
+def _infer(topo_order, known, method):
+    """Complete known, a map from node to shape or dtype, with op.<method> over topo_order."""
+    for node in topo_order:
+        if node in known:
+            continue
+        input_vals = [known.get(i) for i in node.inputs]
+        if any(val is None for val in input_vals):
+            known[node] = None
+        else:
+            known[node] = getattr(node.op, method)(node, input_vals)
+    return known
+
+def optimize_graph(node_list, feed_nodes=(), passes=None):
+    """Rewrite the graph ending in node_list into a cheaper equivalent one.
+
+    Parameters
+    ----------
+    node_list: list of output nodes.
+    feed_nodes: nodes whose values will be fed; they are treated as opaque leaves.
+    passes: list of passes to run in order, default_graph_passes if None.
+        A pass is a function (node_list, feed_nodes) -> new node_list.
+
+    Returns
+    -------
+    The list of optimized output nodes, one for each node in node_list, and a report
+    dict mapping each pass name to the number of nodes it removed.
+    The given graph is left unmodified.
+    """
+    if passes is None:
+        passes = default_graph_passes
+    feed_nodes = frozenset(feed_nodes)
+    report = {}
+    num_nodes = len(_find_needed_topo_sort(node_list, feed_nodes))
+    for graph_pass in passes:
+        node_list = graph_pass(node_list, feed_nodes)
+        new_num_nodes = len(_find_needed_topo_sort(node_list, feed_nodes))
+        report[graph_pass.__name__] = report.get(graph_pass.__name__, 0) + num_nodes - new_num_nodes
+        num_nodes = new_num_nodes
+    return node_list, report
+
+def eliminate_common_subexpressions(node_list, feed_nodes=()):
+    """Merge structurally identical nodes so that each is computed a single time.
+
+    Nodes are hash-consed on their op, their (already merged) inputs and their
+    const/matmul attributes; inputs of commutative ops are compared as a set.
+    Returns a list of nodes equivalent to node_list.
+    """
+    replacement = {}
+    canonical = {}
+    for node in find_topo_sort(node_list):
+        if node in feed_nodes or not node.inputs:
+            replacement[node] = node
+            continue
+        inputs = tuple(replacement[i] for i in node.inputs)
+        key_inputs = tuple(sorted(inputs, key=id)) if node.op.commutative else inputs
+        key = (node.op, key_inputs, _attr_key(node.const_attr),
+               node.matmul_attr_trans_A, node.matmul_attr_trans_B)
+        if key not in canonical:
+            canonical[key] = _clone_with_inputs(node, inputs)
+        replacement[node] = canonical[key]
+    return [replacement[node] for node in node_list]
+
+def simplify_graph(node_list, feed_nodes=()):
+    """Fold constant subtrees and apply algebraic simplifications.
+
+    - x - c becomes x + (-c), x / c becomes x * (1/c) if c is a power of two
+      (so the product is exact), and chains of by-const ops are merged into
+      one op, e.g. (x*2)*3 -> x*6 and ((-1)*x)+c -> c-x.
+    - x * 1 and x + 0 are removed when this keeps the dtype of the result,
+      e.g. not for an integer x and a float 1.0.
+    - Constant subtrees built from oneslike_op/zeroslike_op, e.g.
+      (-1)*oneslike(y), are folded into a single "fill" of the shape of y, and
+      element-wise ops between a node and such a fill become by-const ops.
+      Only scalar constants are rewritten, as arrays may broadcast the node.
+      This requires knowing that the fill does not broadcast the other
+      operand, which is proven structurally from the element-wise ops between them.
+    - zeroslike contributions are dropped from add_n when another input is
+      floating point, and sum_to_op or broadcast_to_op between nodes of the same shape are removed.
+
+    Returns a list of nodes equivalent to node_list.
+    """
+    replacement = {}
+    shape_rep = {}
+    lowest_dtypes = {node: np.dtype(bool) for node in feed_nodes}
+    for node in find_topo_sort(node_list):
+        if node in feed_nodes or not node.inputs:
+            replacement[node] = node
+            _lowest_dtype(node, lowest_dtypes)
+            continue
+        new_node = _clone_with_inputs(node, [replacement[i] for i in node.inputs])
+        simplified = _simplify_node(new_node, shape_rep, lowest_dtypes)
+        while simplified is not new_node:
+            new_node = simplified
+            simplified = _simplify_node(new_node, shape_rep, lowest_dtypes)
+        replacement[node] = new_node
+        _lowest_dtype(new_node, lowest_dtypes)
+    return [replacement[node] for node in node_list]
+
+def _shape_rep(node, shape_rep):
+    """Return a set of nodes whose broadcast shape is the shape of node.
+
+    Element-wise ops take the union of their inputs' sets, so two nodes with
+    the same set (or a subset, for broadcasting) are known to agree in shape.
+    """
+    rep = shape_rep.get(node)
+    if rep is not None:
+        return rep
+    op = node.op
+    if not node.inputs:
+        rep = frozenset([node])
+    elif op in (oneslike_op, zeroslike_op, exp_op, log_op, sigmoid_op) or (
+            op in _by_const_ops and np.ndim(node.const_attr) == 0):
+        rep = _shape_rep(node.inputs[0], shape_rep)
+    elif op in (add_op, mul_op, sub_op, div_op, add_n_op, sigmoid_cross_entropy_op):
+        rep = frozenset().union(*[_shape_rep(i, shape_rep) for i in node.inputs])
+    elif op in (broadcast_to_op, sum_to_op):
+        rep = _shape_rep(node.inputs[1], shape_rep)
+    else:
+        rep = frozenset([node])
+    shape_rep[node] = rep
+    return rep
+
+def _lowest_dtype(node, lowest_dtypes):
+    """Return the dtype of node when every fed value is bool, or None if unknown.
+
+    bool is the lowest dtype and numpy promotion never lowers the kind of a
+    dtype, so a floating point result here is floating point for any feed.
+    The dtypes of the inputs of node have to be in lowest_dtypes already.
+    """
+    if node in lowest_dtypes:
+        return lowest_dtypes[node]
+    if node.op is placeholder_op:
+        dtype = np.dtype(bool)
+    else:
+        input_dtypes = [lowest_dtypes.get(i) for i in node.inputs]
+        if any(dtype is None for dtype in input_dtypes):
+            dtype = None
+        else:
+            dtype = node.op.infer_dtype(node, input_dtypes)
+    lowest_dtypes[node] = dtype
+    return dtype
+
+def _is_float(node, lowest_dtypes):
+    dtype = _lowest_dtype(node, lowest_dtypes)
+    return dtype is not None and dtype.kind in "fc"
+
+def _fill_keeps_dtype(source, node, lowest_dtypes):
+    """Whether a fill of the shape of source, of dtype _float_or_float64 of
+    source, never promotes node beyond what a Python float does.
+
+    True when node is source itself, possibly through by-const ops with a
+    Python float, which give _float_or_float64 of their input, or when source
+    is a float node that node is computed from: numpy never lowers a float
+    dtype, so node is at least as wide.
+    """
+    while node is not source and node.op in _by_const_ops and type(node.const_attr) is float:
+        node = node.inputs[0]
+    if source is node:
+        return True
+    if not _is_float(source, lowest_dtypes):
+        return False
+    seen = set([node])
+    pending = [node]
+    while pending and len(seen) < _fill_search_limit:
+        current = pending.pop()
+        op = current.op.op if isinstance(current.op, BatchedOp) else current.op
+        # sum_to_op, broadcast_to_op and batch_like_op take only the shape of their second input
+        inputs = current.inputs[:1] if op in (sum_to_op, broadcast_to_op, batch_like_op) else current.inputs
+        for input_node in inputs:
+            if input_node is source:
+                return True
+            if input_node not in seen:
+                seen.add(input_node)
+                pending.append(input_node)
+    return False
+
+# nodes visited by _fill_keeps_dtype looking for the source of a fill
+_fill_search_limit = 64
+
+def _as_fill(node):
+    """If node is a constant fill of the shape of some node y, return (y, fill value)."""
+    if node.op is oneslike_op:
+        return node.inputs[0], 1.0
+    if node.op is zeroslike_op:
+        return node.inputs[0], 0.0
+    if node.op is mul_byconst_op and node.inputs[0].op is oneslike_op and _is_scalar(node.const_attr):
+        # the fill is floating point, so is its value
+        return node.inputs[0].inputs[0], node.const_attr * 1.0
+    return None
+
+def _make_fill(ref, value):
+    if value == 1:
+        return oneslike_op(ref)
+    if value == 0:
+        return zeroslike_op(ref)
+    return mul_byconst_op(oneslike_op(ref), value)
+
+def _is_scalar(value):
+    """Whether value is a numeric scalar, which leaves the shape of the array it meets unchanged."""
+    return np.ndim(value) == 0 and np.issubdtype(np.result_type(value), np.number)
+
+def _is_power_of_two(value):
+    """Whether value is a Python int or float power of two (or its negative) with an exact reciprocal."""
+    if type(value) not in (int, float) or value == 0 or not np.isfinite(value):
+        return False
+    mantissa, exponent = np.frexp(value)
+    return abs(mantissa) == 0.5 and -1021 <= exponent <= 1024
+
+def _is_const(value, expected):
+    return np.ndim(value) == 0 and value == expected
+
+def _is_identity(x, c, expected, lowest_dtypes):
+    """Whether a by-const op of x and c equal to expected gives x, with the dtype of x.
+
+    Python scalars adopt the dtype of the array they meet, as long as a float
+    does not meet an integer array or a number a bool array.
+    """
+    dtype = _lowest_dtype(x, lowest_dtypes)
+    return (type(c) in (int, float) and c == expected and dtype is not None
+            and (dtype.kind in "fc" or (dtype.kind in "iu" and type(c) is int)))
+
+def _simplify_node(node, shape_rep, lowest_dtypes):
+    """Return a cheaper node equivalent to node, or node itself."""
+    op = node.op
+    if op in _by_const_ops:
+        x = node.inputs[0]
+        c = node.const_attr
+        if not _is_scalar(c):
+            return node
+        merge = x.op in _by_const_ops and _is_scalar(x.const_attr)
+        if op is sub_byconst_op:
+            return add_byconst_op(x, -c)
+        if op is div_byconst_op and _is_power_of_two(c):
+            return mul_byconst_op(x, 1.0 / c)
+        if op is mul_byconst_op:
+            if _is_identity(x, c, 1, lowest_dtypes):
+                return x
+            if merge and x.op is mul_byconst_op:
+                return mul_byconst_op(x.inputs[0], x.const_attr * c)
+            if merge and _is_const(c, -1) and x.op is sub_op_byconst:
+                return add_byconst_op(x.inputs[0], -x.const_attr)
+            fill = _as_fill(x)
+            if fill is not None and x.op is not oneslike_op:
+                return _make_fill(fill[0], fill[1] * c)
+        if op is add_byconst_op:
+            if _is_identity(x, c, 0, lowest_dtypes):
+                return x
+            if merge and x.op is add_byconst_op:
+                return add_byconst_op(x.inputs[0], x.const_attr + c)
+            if merge and x.op is sub_op_byconst:
+                return sub_op_byconst(x.inputs[0], x.const_attr + c)
+            if merge and x.op is mul_byconst_op and _is_const(x.const_attr, -1):
+                return sub_op_byconst(x.inputs[0], c)
+            fill = _as_fill(x)
+            if fill is not None:
+                return _make_fill(fill[0], fill[1] + c)
+        if op is sub_op_byconst and merge:
+            if x.op is add_byconst_op:
+                return sub_op_byconst(x.inputs[0], c - x.const_attr)
+            if x.op is mul_byconst_op and _is_const(x.const_attr, -1):
+                return add_byconst_op(x.inputs[0], c)
+        return node
+
+    if op in (add_op, mul_op, sub_op, div_op):
+        a, b = node.inputs
+        fill = _as_fill(b)
+        if (fill is not None and _shape_rep(fill[0], shape_rep) <= _shape_rep(a, shape_rep)
+                and _fill_keeps_dtype(fill[0], a, lowest_dtypes)):
+            value = fill[1]
+            if op is add_op:
+                return add_byconst_op(a, value)
+            if op is mul_op:
+                return mul_byconst_op(a, value)
+            if op is sub_op:
+                return add_byconst_op(a, -value)
+            if value != 0:
+                return div_byconst_op(a, value)
+        fill = _as_fill(a)
+        if (fill is not None and _shape_rep(fill[0], shape_rep) <= _shape_rep(b, shape_rep)
+                and _fill_keeps_dtype(fill[0], b, lowest_dtypes)):
+            value = fill[1]
+            if op is add_op:
+                return add_byconst_op(b, value)
+            if op is mul_op:
+                return mul_byconst_op(b, value)
+            if op is sub_op:
+                return sub_op_byconst(b, value)
+        return node
+
+    if op in (sum_to_op, broadcast_to_op) and node.const_attr == (None, False):
+        # nothing to sum or broadcast when the shapes already agree
+        a, b = node.inputs
+        rep_a, rep_b = _shape_rep(a, shape_rep), _shape_rep(b, shape_rep)
+        if (rep_a <= rep_b) if op is sum_to_op else (rep_b <= rep_a):
+            return a
+        return node
+
+    if op is add_n_op:
+        kept = [i for i in node.inputs if i.op is not zeroslike_op]
+        kept_rep = frozenset().union(*[_shape_rep(i, shape_rep) for i in kept])
+        # zeros that may broadcast or promote the sum of the other inputs stay
+        kept += [i for i in node.inputs if i.op is zeroslike_op and (
+            not _shape_rep(i, shape_rep) <= kept_rep
+            or not any(_is_float(k, lowest_dtypes) and _fill_keeps_dtype(i.inputs[0], k, lowest_dtypes)
+                       for k in kept))]
+        if len(kept) == len(node.inputs):
+            return node
+        return sum_node_list(kept)
+    return node
+
+def fuse_elementwise(node_list, feed_nodes=(), use_numexpr=False):
+    """Replace groups of connected element-wise nodes with single fused_elementwise_op nodes.
+
+    A node joins the group of its consumers when it is element-wise, all of
+    its consumers are in that group and it is not in node_list, so every group
+    has a single output and its intermediate values need not be stored.
+    With use_numexpr, large float groups are evaluated by numexpr, see
+    FusedElementwiseOp.
+    Returns a list of nodes equivalent to node_list.
+    """
+    topo_order = _find_needed_topo_sort(node_list, feed_nodes)
+    consumers = {}
+    for node in topo_order:
+        if node not in feed_nodes:
+            for input_node in node.inputs:
+                consumers.setdefault(input_node, []).append(node)
+    outputs = set(node_list)
+    group = {}
+    for node in reversed(topo_order):
+        if node in feed_nodes or not node.inputs or not node.op.elementwise:
+            continue
+        roots = set(group.get(c) for c in consumers.get(node, ()))
+        if node not in outputs and len(roots) == 1 and None not in roots:
+            group[node] = roots.pop()
+        else:
+            group[node] = node
+    members = {}
+    for node in topo_order:
+        if node in group:
+            members.setdefault(group[node], []).append(node)
+
+    replacement = {}
+    for node in topo_order:
+        if node in feed_nodes or not node.inputs:
+            replacement[node] = node
+        elif node not in group or len(members[group[node]]) == 1:
+            replacement[node] = _clone_with_inputs(node, [replacement[i] for i in node.inputs])
+        elif group[node] is node:
+            group_nodes = members[node]
+            in_group = set(group_nodes)
+            inputs = []
+            for member in group_nodes:
+                for input_node in member.inputs:
+                    if input_node not in in_group and input_node not in inputs:
+                        inputs.append(input_node)
+            register = {input_node: i for i, input_node in enumerate(inputs)}
+            steps = []
+            for member in group_nodes:
+                steps.append((member, tuple(register[i] for i in member.inputs)))
+                register[member] = len(register)
+            program = _FusedProgram(tuple(steps), len(inputs), use_numexpr)
+            replacement[node] = fused_elementwise_op([replacement[i] for i in inputs], program)
+    return [replacement[node] for node in node_list]
+
+default_graph_passes = [eliminate_common_subexpressions, simplify_graph, eliminate_common_subexpressions]
+
+##############################
+####### Serialization ######## 
+##############################
+
+# kinds of const_attr in a saved graph
+_CONST_NONE, _CONST_FLOAT, _CONST_INT, _CONST_BOOL, _CONST_AXIS, _CONST_ARRAY, _CONST_SCALAR = range(7)
+
+def save_graph(file, node_list):
+    """Save the graph ending in node_list to file (a path or file object) as an uncompressed .npz.
+
+    The graph is stored as flat arrays over its nodes in topological order,
+    without pickling:
+
+        op_table: descriptor of every distinct op, e.g. "mul_op",
+            "reduce_sum_op@float64" or "batched(matmul_op,10)".
+        ops: int32 index into op_table per node.
+        input_offsets, inputs: the inputs of node i are the int32 node
+            indices inputs[input_offsets[i]:input_offsets[i + 1]].
+        flags: per node, bit 0 matmul_attr_trans_A and bit 1 matmul_attr_trans_B.
+        const_kinds, const_index: how const_attr is stored and where, in
+            const_floats, const_ints (ints, bools and (axis, flag) pairs) or
+            the array const_array_<index>, 0-d for numpy scalars so that
+            they keep their dtype.
+        names, name_index: explicit node names, -1 for nodes without one.
+        outputs: indices of the nodes of node_list.
+
+    Fused kernels (Executor(fuse=True) builds them at compile time) and
+    optimizer updates cannot be saved.
+    """
+    topo_order = find_topo_sort(node_list)
+    node_index = {node: i for i, node in enumerate(topo_order)}
+    op_names = _op_names()
+    # index into op_table by op
+    op_ids = {}
+    op_table = []
+    ops = []
+    input_offsets = [0]
+    inputs = []
+    flags = [0] * len(topo_order)
+    const_kinds = [_CONST_NONE] * len(topo_order)
+    const_index = [0] * len(topo_order)
+    const_floats = []
+    const_ints = []
+    arrays = {}
+    names = []
+    name_index = [-1] * len(topo_order)
+    for i, node in enumerate(topo_order):
+        op_id = op_ids.get(node.op)
+        if op_id is None:
+            assert node.op not in (fused_elementwise_op, apply_updates_op), "cannot save nodes of %s" % node.op
+            op_id = op_ids[node.op] = len(op_table)
+            op_table.append(_op_descriptor(node.op, op_names))
+        ops.append(op_id)
+        inputs.extend(map(node_index.__getitem__, node._inputs))
+        input_offsets.append(len(inputs))
+        if node.matmul_attr_trans_A or node.matmul_attr_trans_B:
+            flags[i] = node.matmul_attr_trans_A | node.matmul_attr_trans_B << 1
+        if node._name is not None:
+            name_index[i] = len(names)
+            names.append(node._name)
+        const = node.const_attr
+        if const is None:
+            continue
+        if isinstance(const, np.generic):
+            # numpy scalars keep their dtype, which promotes unlike Python numbers
+            const_kinds[i], const_index[i] = _CONST_SCALAR, len(arrays)
+            arrays["const_array_%d" % len(arrays)] = np.asarray(const)
+        elif isinstance(const, bool):
+            const_kinds[i], const_index[i] = _CONST_BOOL, len(const_ints)
+            const_ints.append(int(const))
+        elif isinstance(const, int):
+            const_kinds[i], const_index[i] = _CONST_INT, len(const_ints)
+            const_ints.append(int(const))
+        elif isinstance(const, float):
+            const_kinds[i], const_index[i] = _CONST_FLOAT, len(const_floats)
+            const_floats.append(float(const))
+        elif isinstance(const, np.ndarray):
+            const_kinds[i], const_index[i] = _CONST_ARRAY, len(arrays)
+            arrays["const_array_%d" % len(arrays)] = const
+        else:
+            # (axis, flag) of reductions and broadcasts: flag, then -1 for
+            # axis None, -2 and the axis for an int, or n and n axes for a tuple
+            assert isinstance(const, tuple) and len(const) == 2, "cannot save const_attr %r" % (const,)
+            axis, flag = const
+            const_kinds[i], const_index[i] = _CONST_AXIS, len(const_ints)
+            const_ints.append(int(flag))
+            if axis is None:
+                const_ints.append(-1)
+            elif isinstance(axis, int):
+                const_ints.extend((-2, axis))
+            else:
+                const_ints.append(len(axis))
+                const_ints.extend(axis)
+    np.savez(file, op_table=np.array(op_table, dtype=np.str_), ops=np.array(ops, dtype=np.int32),
+             input_offsets=np.array(input_offsets, dtype=np.int64), inputs=np.array(inputs, dtype=np.int32),
+             flags=np.array(flags, dtype=np.uint8), const_kinds=np.array(const_kinds, dtype=np.int8),
+             const_index=np.array(const_index, dtype=np.int32),
+             const_floats=np.array(const_floats, dtype=np.float64), const_ints=np.array(const_ints, dtype=np.int64),
+             names=np.array(names, dtype=np.str_), name_index=np.array(name_index, dtype=np.int32),
+             outputs=np.array([node_index[node] for node in node_list], dtype=np.int32), **arrays)
+
+def load_graph(file):
+    """Load a graph saved by save_graph.
+
+    Returns
+    -------
+    The list of nodes replacing the node_list it was saved with, and a dict
+    from explicit node names (e.g. of Variable nodes, to feed them) to nodes.
+    """
+    global _graph_version
+    with np.load(file, allow_pickle=False) as data:
+        op_names = {name: op for op, name in _op_names().items()}
+        op_table = [_parse_op_descriptor(descriptor, op_names) for descriptor in data["op_table"].tolist()]
+        ops = data["ops"].tolist()
+        input_offsets = data["input_offsets"]
+        inputs = data["inputs"]
+        flags = data["flags"]
+        const_kinds = data["const_kinds"]
+        const_index = data["const_index"]
+        const_floats = data["const_floats"].tolist()
+        const_ints = data["const_ints"].tolist()
+        names = data["names"].tolist()
+        name_index = data["name_index"]
+        outputs = data["outputs"].tolist()
+
+        # Nodes are filled in directly rather than through the property setters,
+        # which would bump _graph_version once per node, and the cyclic garbage
+        # collector is paused since none of the new objects can be garbage.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            nodes = []
+            new_node = Node.__new__
+            for op in map(op_table.__getitem__, ops):
+                node = new_node(Node)
+                node._op = op
+                node._inputs = ()
+                node.const_attr = None
+                node.matmul_attr_trans_A = False
+                node.matmul_attr_trans_B = False
+                node._name = None
+                nodes.append(node)
+            # The input tuples of all nodes with the same (small) number of
+            # inputs are built with one gather per input position.
+            node_array = np.empty(len(nodes), dtype=object)
+            node_array[:] = nodes
+            num_inputs = np.diff(input_offsets)
+            for k in np.unique(num_inputs).tolist():
+                if k == 0:
+                    continue
+                index = np.flatnonzero(num_inputs == k)
+                starts = input_offsets[index]
+                if k > len(index):
+                    for i, start in zip(index.tolist(), starts.tolist()):
+                        nodes[i]._inputs = tuple(node_array[inputs[start:start + k]].tolist())
+                    continue
+                columns = [node_array[inputs[starts + j]].tolist() for j in range(k)]
+                for node, node_inputs in zip(node_array[index].tolist(), zip(*columns)):
+                    node._inputs = node_inputs
+        finally:
+            if gc_enabled:
+                gc.enable()
+        _graph_version += 1
+        flagged = np.flatnonzero(flags)
+        for i, flag in zip(flagged.tolist(), flags[flagged].tolist()):
+            nodes[i].matmul_attr_trans_A = bool(flag & 1)
+            nodes[i].matmul_attr_trans_B = bool(flag & 2)
+        named_nodes = {}
+        named = np.flatnonzero(name_index >= 0)
+        for i, index in zip(named.tolist(), name_index[named].tolist()):
+            nodes[i]._name = names[index]
+            named_nodes[names[index]] = nodes[i]
+        with_const = np.flatnonzero(const_kinds)
+        for i, kind, index in zip(with_const.tolist(), const_kinds[with_const].tolist(),
+                                  const_index[with_const].tolist()):
+            if kind == _CONST_FLOAT:
+                const = const_floats[index]
+            elif kind == _CONST_INT:
+                const = const_ints[index]
+            elif kind == _CONST_BOOL:
+                const = bool(const_ints[index])
+            elif kind == _CONST_ARRAY:
+                const = data["const_array_%d" % index]
+            elif kind == _CONST_SCALAR:
+                const = data["const_array_%d" % index][()]
+            else:
+                flag, num_axes = const_ints[index:index + 2]
+                if num_axes == -1:
+                    axis = None
+                elif num_axes == -2:
+                    axis = const_ints[index + 2]
+                else:
+                    axis = tuple(const_ints[index + 2:index + 2 + num_axes])
+                const = (axis, bool(flag))
+            nodes[i].const_attr = const
+    return [nodes[i] for i in outputs], named_nodes
+
+def _op_names():
+    """Map from the op singletons of this module to their names."""
+    return {op: name for name, op in globals().items() if isinstance(op, Op) and not name.startswith("_")}
+
+def _op_descriptor(op, op_names):
+    """String naming op in a saved graph, see save_graph."""
+    if op in op_names:
+        return op_names[op]
+    if isinstance(op, BatchedOp):
+        return "batched(%s,%s)" % (_op_descriptor(op.op, op_names), "".join("1" if b else "0" for b in op.batched))
+    accumulate_dtype = getattr(op, "accumulate_dtype", None)
+    for singleton, name in op_names.items():
+        if accumulate_dtype is not None and type(singleton) is type(op):
+            return "%s@%s" % (name, np.dtype(accumulate_dtype).name)
+    assert False, "cannot save nodes of %s" % type(op).__name__
+
+def _parse_op_descriptor(descriptor, op_names):
+    """Op named by a descriptor of _op_descriptor."""
+    if descriptor.startswith("batched("):
+        inner, batched = descriptor[len("batched("):-1].rsplit(",", 1)
+        return _batched_op(_parse_op_descriptor(inner, op_names), tuple(b == "1" for b in batched))
+    if "@" in descriptor:
+        name, accumulate_dtype = descriptor.split("@")
+        return _accumulating_op(op_names[name], np.dtype(accumulate_dtype))
+    return op_names[descriptor]
+
 ##############################
 ####### Helper Methods ####### 
 ##############################
@@ -527,6 +3096,8 @@ def find_topo_sort(node_list):
     after all its predecessors are traversed due to post-order DFS, we get a topological
     sort.
 
+    The traversal keeps an explicit stack instead of recursing, so it runs in
+    linear time and memory and is not bounded by the Python recursion limit.
     """
     visited = set()
     topo_order = []
@@ -535,16 +3106,305 @@ def find_topo_sort(node_list):
     return topo_order
 
 def topo_sort_dfs(node, visited, topo_order):
-    """Post-order DFS"""
+    """Post-order DFS using an explicit stack of (node, iterator over its inputs)."""
     if node in visited:
         return
     visited.add(node)
-    for n in node.inputs:
-        topo_sort_dfs(n, visited, topo_order)
-    topo_order.append(node)
+    stack = [(node, iter(node.inputs))]
+    while stack:
+        current, inputs = stack[-1]
+        for n in inputs:
+            if n not in visited:
+                visited.add(n)
+                stack.append((n, iter(n.inputs)))
+                break
+        else:
+            stack.pop()
+            topo_order.append(current)
+
+def _apply_inplace(ufunc, total, val):
+    """Return ufunc(total, val), writing into total when it is an array that can hold the result.
+
+    Only use on a total that was allocated by the caller."""
+    if (isinstance(total, np.ndarray) and np.result_type(total, val) == total.dtype
+            and np.broadcast_shapes(total.shape, np.shape(val)) == total.shape):
+        return ufunc(total, val, out=total)
+    return ufunc(total, val)
+
+def _normalize_axis(axis):
+    """Axes are stored as an int, a tuple or None so that they are hashable."""
+    if axis is None or isinstance(axis, int):
+        return axis
+    return tuple(axis)
+
+def _sum_to(val, shape, accumulate_dtype=None, batch_dims=0):
+    """Sum val over the axes along which an array of the given shape was broadcast to it.
+
+    The first batch_dims axes of val are kept in front of shape."""
+    batch_shape = np.shape(val)[:batch_dims]
+    val_shape = np.shape(val)[batch_dims:]
+    num_extra = len(val_shape) - len(shape)
+    if num_extra < 0 or val_shape == shape:
+        return val
+    axes = tuple(range(num_extra)) + tuple(
+        num_extra + i for i, dim in enumerate(shape) if dim == 1 and val_shape[num_extra + i] != 1)
+    if not axes:
+        return val
+    axes = tuple(batch_dims + axis for axis in axes)
+    return _reduce(np.sum, val, accumulate_dtype, axis=axes, keepdims=True).reshape(batch_shape + shape)
+
+def _sum_tangents(node, tangents, broadcast=True):
+    """Sum of the tangent contributions that are not None.
+
+    With broadcast, a sum that misses some contributions is broadcast to the
+    shape of node, which it may not have when the inputs broadcast each other.
+    """
+    tangents = [t for t in tangents if t is not None]
+    total = sum_node_list(tangents)
+    if broadcast and len(tangents) < len(node.inputs):
+        total = broadcast_to_op(total, node)
+    return total
+
+def _const_broadcast_tangent(node, tangent):
+    """Tangent of a by-const node, broadcast to its shape if the constant is an array."""
+    if np.ndim(node.const_attr) > 0:
+        return broadcast_to_op(tangent, node)
+    return tangent
+
+def _broadcast_to(val, shape, axis, mean):
+    """Read-only view of val with axis inserted, broadcast to shape; with mean,
+    scaled by the size of val over the size of shape."""
+    if axis is not None:
+        val = np.expand_dims(val, axis)
+    if mean:
+        val = val * float(np.size(val) / np.prod(shape))
+    return np.broadcast_to(val, shape)
+
+def _batched_axis(axis, ndim):
+    """Axis of a reduction over values of ndim dimensions, shifted past a leading batch axis."""
+    if axis is None:
+        return tuple(range(1, ndim + 1))
+    if isinstance(axis, int):
+        return axis + 1 if axis >= 0 else axis
+    return tuple(a + 1 if a >= 0 else a for a in axis)
+
+def _align_batched_val(val, ndim):
+    """Insert unit axes after the batch axis of val up to ndim + 1 dimensions."""
+    shape = np.shape(val)
+    if len(shape) - 1 >= ndim:
+        return val
+    return np.reshape(val, shape[:1] + (1,) * (ndim + 1 - len(shape)) + shape[1:])
+
+def _align_batched(node, input_vals, batched):
+    """Align the batched values among the inputs of an element-wise node, see Op.batched_compute."""
+    ndim = max(np.ndim(val) - b for val, b in zip(input_vals, batched))
+    if node.const_attr is not None:
+        ndim = max(ndim, np.ndim(node.const_attr))
+    return [_align_batched_val(val, ndim) if b else val for val, b in zip(input_vals, batched)]
+
+def _reduce(reduce, val, accumulate_dtype, **kwargs):
+    """reduce(val, **kwargs), accumulated in accumulate_dtype if val is a float of lower precision."""
+    dtype = np.result_type(val)
+    if accumulate_dtype is None or dtype.kind != "f" or dtype.itemsize >= np.dtype(accumulate_dtype).itemsize:
+        return reduce(val, **kwargs)
+    return reduce(val, dtype=accumulate_dtype, **kwargs).astype(dtype, copy=False)
+
+def _float_or_float64(dtype):
+    """dtype if it is a float dtype, else float64."""
+    return dtype if dtype.kind == "f" else np.dtype(np.float64)
+
+def _cast_feeds(feed_dict, dtype):
+    """Copy of feed_dict with the numeric values converted to dtype."""
+    cast = {}
+    for node, val in feed_dict.items():
+        val_dtype = np.result_type(val)
+        if val_dtype != dtype and val_dtype.kind in "biuf":
+            val = np.asarray(val, dtype=dtype)
+        cast[node] = val
+    return cast
+
+def _broadcast_shape(node, input_shapes):
+    """Broadcast shape of the inputs (and const_attr) of an element-wise node."""
+    shapes = list(input_shapes)
+    if node.const_attr is not None:
+        shapes.append(np.shape(node.const_attr))
+    try:
+        return np.broadcast_shapes(*shapes)
+    except ValueError:
+        assert False, "%s of shapes %s cannot broadcast" % (type(node.op).__name__, ", ".join(map(str, shapes)))
+
+def _promoted_dtype(node, input_dtypes):
+    """Dtype numpy promotes the inputs (and const_attr) of an element-wise node to."""
+    const = node.const_attr
+    if const is None:
+        return np.result_type(*input_dtypes)
+    if isinstance(const, (list, tuple)):
+        # result_type takes a list for a structured dtype
+        const = np.asarray(const)
+    return np.result_type(*input_dtypes, const)
+
+def _sum_dtype(dtype):
+    """Dtype of np.sum over an array of the given dtype; small integers are summed as np.int_."""
+    if dtype.kind in "biu" and dtype.itemsize < np.dtype(np.int_).itemsize:
+        return np.dtype(np.uint if dtype.kind == "u" else np.int_)
+    return dtype
+
+def _axes_tuple(axis, ndim):
+    """Non-negative axes of an array of ndim dimensions for an int, tuple or None axis.
+
+    None if an axis is out of range. NumPy still accepts some of those, e.g. np.sum of a 0-d
+    array over axis 0, so the resulting shape is left unknown rather than rejected.
+    """
+    if axis is None:
+        return tuple(range(ndim))
+    axes = axis if isinstance(axis, tuple) else (axis,)
+    if not all(-ndim <= a < ndim for a in axes):
+        return None
+    return tuple(a % ndim for a in axes)
+
+def _reduced_shape(shape, axis, keepdims):
+    """Shape of np.sum(array of shape, axis=axis, keepdims=keepdims), None if unknown."""
+    axes = _axes_tuple(axis, len(shape))
+    if axes is None:
+        return None
+    if keepdims:
+        return tuple(1 if i in axes else dim for i, dim in enumerate(shape))
+    return tuple(dim for i, dim in enumerate(shape) if i not in axes)
+
+def _expanded_shape(shape, axis):
+    """Shape of np.expand_dims(array of shape, axis), None if unknown."""
+    num_axes = 1 if isinstance(axis, int) else len(axis)
+    axes = _axes_tuple(axis, len(shape) + num_axes)
+    if axes is None:
+        return None
+    dims = iter(shape)
+    return tuple(1 if i in axes else next(dims) for i in range(len(shape) + num_axes))
+
+def _broadcasts_to(shape, target):
+    """Whether an array of shape can be broadcast to target."""
+    if len(shape) > len(target):
+        return False
+    return all(dim == 1 or dim == t for dim, t in zip(shape[::-1], target[::-1]))
+
+def _constant_compute(value, node, input_vals):
+    """Compute function of a step folded into a constant."""
+    return value
+
+def _elementwise_result_type(node, input_vals):
+    """Shape and dtype of the output of an element-wise node, or (None, None)
+    unless the output is a non-scalar float array."""
+    dtype = node.op.infer_dtype(node, [np.result_type(val) for val in input_vals])
+    if dtype.kind != "f":
+        return None, None
+    shape = node.op.infer_shape(node, [np.shape(val) for val in input_vals])
+    if shape == ():
+        return None, None
+    return shape, dtype
+
+def _allocated_nbytes(val, input_vals=()):
+    """Bytes newly allocated for val: zero for views, scalars and values passed through."""
+    if type(val) is not np.ndarray or val.base is not None or any(val is i for i in input_vals):
+        return 0
+    return val.nbytes
+
+def _feed_signature(plan, feed_dict):
+    """Shapes and dtypes of the fed values, in the order of the plan's feed slots."""
+    return tuple((np.shape(feed_dict[node]), np.result_type(feed_dict[node])) for node, _ in plan.feed_slots)
+
+def _feeds_alias_buffers(feed_dict, buffers):
+    """Whether a fed value is (a view of) one of the kept buffers, e.g. an output fed back in."""
+    buffer_ids = set(id(buf) for buf in buffers)
+    for val in feed_dict.values():
+        if id(val) in buffer_ids or id(getattr(val, "base", None)) in buffer_ids:
+            return True
+    return False
+
+def _op_type_name(op):
+    """Name of the type of op for profiles, e.g. MulOp or BatchedMatMulOp."""
+    if isinstance(op, BatchedOp):
+        return "Batched" + _op_type_name(op.op)
+    return type(op).__name__
+
+def _short_name(node, width):
+    """The name of node cut to width characters, for tables.
+
+    Unnamed nodes are shown as their op type and id; node.name would spell
+    out the whole expression, which grows exponentially on shared subgraphs.
+    """
+    name = node._name
+    if name is None:
+        name = "%s@%x" % (_op_type_name(node.op), id(node))
+    if len(name) > width:
+        name = name[:width - 3] + "..."
+    return name
+
+def _run_step(step, vals):
+    """Compute one step of an execution plan (with its out buffer, for specialized steps) into vals."""
+    compute, node, input_slots, output_slot = step[:4]
+    out = step[4] if len(step) > 4 else None
+    if out is None:
+        vals[output_slot] = compute(node, [vals[i] for i in input_slots])
+    else:
+        vals[output_slot] = compute(node, [vals[i] for i in input_slots], out=out)
+
+def _sigmoid(x, out=None):
+    """Logistic function through tanh, which cannot overflow."""
+    val = np.multiply(x, 0.5, out=out)
+    if isinstance(val, np.ndarray) and val.dtype.kind == "f":
+        np.tanh(val, out=val)
+        val += 1
+        val *= 0.5
+        return val
+    return 0.5 * (np.tanh(val) + 1)
+
+def _find_needed_topo_sort(node_list, feed_nodes):
+    """Topological sort restricted to the nodes needed to compute node_list
+    when the values of feed_nodes are given."""
+    topo_order = find_topo_sort(node_list)
+    needed = set(node_list)
+    for node in reversed(topo_order):
+        if node in needed and node not in feed_nodes:
+            needed.update(node.inputs)
+    return [node for node in topo_order if node in needed]
+
+def _replace_nodes(node_list, replacement):
+    """Rewrite the graph ending in node_list with the nodes in the replacement dict swapped for their values."""
+    replacement = dict(replacement)
+    for node in find_topo_sort(node_list):
+        if node not in replacement:
+            replacement[node] = _clone_with_inputs(node, [replacement[i] for i in node.inputs])
+    return [replacement[node] for node in node_list]
+
+def _clone_with_inputs(node, inputs):
+    """Return node if its inputs are already inputs, else a copy of node reading from inputs."""
+    if all(a is b for a, b in zip(node.inputs, inputs)):
+        return node
+    return _copy_node(node, inputs)
+
+def _copy_node(node, inputs):
+    """Return a copy of node reading from inputs."""
+    new_node = Node()
+    new_node.op = node.op
+    new_node.inputs = inputs
+    new_node.const_attr = node.const_attr
+    new_node.matmul_attr_trans_A = node.matmul_attr_trans_A
+    new_node.matmul_attr_trans_B = node.matmul_attr_trans_B
+    new_node._name = node._name
+    return new_node
+
+def _attr_key(value):
+    """Hashable key for a node attribute; unhashable values (arrays) compare by identity."""
+    try:
+        hash(value)
+    except TypeError:
+        return ("id", id(value))
+    return (type(value), value)
 
 def sum_node_list(node_list):
-    """Custom sum function in order to avoid create redundant nodes in Python sum implementation."""
-    from operator import add
-    from functools import reduce
-    return reduce(add, node_list)
+    """Custom sum function in order to avoid create redundant nodes in Python sum implementation.
+
+    Sums with a single add_n node instead of a chain of binary add nodes.
+    """
+    if len(node_list) == 1:
+        return node_list[0]
+    return add_n_op(node_list)
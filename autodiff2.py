@@ -556,6 +556,9 @@ def find_topo_sort(node_list):
     going backwards based on input edges. Since a node is added to the ordering
     after all its predecessors are traversed due to post-order DFS, we get a topological
     sort.
+
+    The traversal keeps an explicit stack instead of recursing, so it runs in
+    linear time and memory and is not bounded by the Python recursion limit.
     """
     visited = set()
     topo_order = []
@@ -564,13 +567,21 @@ def find_topo_sort(node_list):
     return topo_order
 
 def topo_sort_dfs(node, visited, topo_order):
-    """Post-order DFS"""
+    """Post-order DFS using an explicit stack of (node, iterator over its inputs)."""
     if node in visited:
         return
     visited.add(node)
-    for n in node.inputs:
-        topo_sort_dfs(n, visited, topo_order)
-    topo_order.append(node)
+    stack = [(node, iter(node.inputs))]
+    while stack:
+        current, inputs = stack[-1]
+        for n in inputs:
+            if n not in visited:
+                visited.add(n)
+                stack.append((n, iter(n.inputs)))
+                break
+        else:
+            stack.pop()
+            topo_order.append(current)
 
 def sum_node_list(node_list):
     """Custom sum function in order to avoid create redundant nodes in Python sum implementation."""
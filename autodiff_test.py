@@ -1,3 +1,6 @@
+import gc
+import json
+
 import autodiff as ad
 import numpy as np
 
@@ -189,3 +192,930 @@ def test_matmul_two_vars():
     assert np.array_equal(y_val, expected_yval)
     assert np.array_equal(grad_x2_val, expected_grad_x2_val)
     assert np.array_equal(grad_x3_val, expected_grad_x3_val)
+
+def test_executor_reuses_plan():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    y = x2 * x3 + x2
+
+    executor = ad.Executor([y])
+    x3_val = 3 * np.ones(3)
+    for i in range(3):
+        x2_val = i * np.ones(3)
+        y_val, = executor.run(feed_dict = {x2: x2_val, x3: x3_val})
+        assert np.array_equal(y_val, x2_val * x3_val + x2_val)
+    assert len(executor._plans) == 1
+
+    # every set of fed nodes gets its own plan; only the most recently used ones are kept
+    xs = [ad.Variable(name = "x%d" % i) for i in range(12)]
+    y = ad.add_n_op(xs)
+    executor = ad.Executor([y])
+    for i in range(len(xs)):
+        feed_dict = {x: np.ones(3) for x in xs}
+        feed_dict[y] = i * np.ones(3)
+        del feed_dict[xs[i]]
+        y_val, = executor.run(feed_dict = feed_dict)
+        assert np.array_equal(y_val, i * np.ones(3))
+        assert len(executor._plans) <= executor.max_plans
+    assert len(executor._plans) == executor.max_plans
+    plan = executor.compile(feed_dict)
+    executor.run(feed_dict = {x: np.ones(3) for x in xs})
+    assert executor.compile(feed_dict) is plan
+
+def test_executor_plan_invalidation():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    z = x2 * x3
+    y = z + 1
+
+    executor = ad.Executor([y])
+    x2_val = 2 * np.ones(3)
+    x3_val = 3 * np.ones(3)
+    y_val, = executor.run(feed_dict = {x2: x2_val, x3: x3_val})
+    assert np.array_equal(y_val, x2_val * x3_val + 1)
+
+    z.inputs = [x2, x2]
+    y_val, = executor.run(feed_dict = {x2: x2_val, x3: x3_val})
+    assert np.array_equal(y_val, x2_val * x2_val + 1)
+
+def test_executor_feed_intermediate_node():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    z = x2 * x3
+    y = z + x3
+
+    executor = ad.Executor([y])
+    z_val = 5 * np.ones(3)
+    x3_val = 3 * np.ones(3)
+    # x2 is never fed; it is not needed once z is supplied directly
+    y_val, = executor.run(feed_dict = {z: z_val, x3: x3_val})
+    assert np.array_equal(y_val, z_val + x3_val)
+
+def test_topo_sort_deep_chain():
+    x = ad.Variable(name = "x")
+    node = x
+    for i in range(20000):
+        node = node + 1
+
+    topo_order = ad.find_topo_sort([node])
+    assert len(topo_order) == 20001
+    assert topo_order[0] is x
+    assert topo_order[-1] is node
+
+    executor = ad.Executor([node])
+    y_val, = executor.run(feed_dict = {x: np.zeros(3)})
+    assert np.array_equal(y_val, 20000 * np.ones(3))
+
+def test_lazy_node_names():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    y = ad.exp_op(x2 * x3 + 1)
+
+    assert not hasattr(y, "__dict__")
+    assert str(y) == "exp ^ (((x2*x3)+1))"
+    y.name = "y"
+    assert str(y * 2) == "(y*2)"
+
+def test_add_n():
+    x1 = ad.Variable(name = "x1")
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    y = ad.add_n_op([x1, x2, x3, x2])
+
+    grad_x1, grad_x2, grad_x3 = ad.gradients(y, [x1, x2, x3])
+
+    executor = ad.Executor([y, grad_x1, grad_x2, grad_x3])
+    x1_val = 1 * np.ones(3)
+    x2_val = 2 * np.ones(3)
+    x3_val = 3 * np.ones(3)
+    y_val, grad_x1_val, grad_x2_val, grad_x3_val = executor.run(feed_dict = {x1 : x1_val, x2: x2_val, x3 : x3_val})
+
+    assert np.array_equal(y_val, x1_val + 2 * x2_val + x3_val)
+    assert np.array_equal(grad_x1_val, np.ones_like(x1_val))
+    assert np.array_equal(grad_x2_val, 2 * np.ones_like(x2_val))
+    assert np.array_equal(grad_x3_val, np.ones_like(x3_val))
+    # inputs are never used as the accumulation buffer
+    assert np.array_equal(x1_val, np.ones(3))
+
+def test_gradient_accumulation_uses_add_n():
+    x1 = ad.Variable(name = "x1")
+    y = x1 * 2 + x1 * 3 + x1 * 4 + x1
+
+    grad_x1, = ad.gradients(y, [x1])
+
+    assert grad_x1.op is ad.add_n_op
+    assert len(grad_x1.inputs) == 4
+    executor = ad.Executor([grad_x1])
+    grad_x1_val, = executor.run(feed_dict = {x1 : np.ones(3)})
+    assert np.array_equal(grad_x1_val, 10 * np.ones(3))
+
+def test_common_subexpression_elimination():
+    x = ad.Variable(name = "x")
+    w = ad.Variable(name = "w")
+    y = ad.exp_op(w * x) + ad.exp_op(x * w)
+
+    grad_w, = ad.gradients(y, [w])
+    exp_nodes = [n for n in ad.find_topo_sort([y, grad_w]) if n.op is ad.exp_op]
+    assert len(exp_nodes) == 4
+
+    new_y, new_grad_w = ad.eliminate_common_subexpressions([y, grad_w])
+    exp_nodes = [n for n in ad.find_topo_sort([new_y, new_grad_w]) if n.op is ad.exp_op]
+    assert len(exp_nodes) == 1
+
+    x_val = np.linspace(-1, 1, 5)
+    w_val = 2 * np.ones(5)
+    expected = ad.Executor([y, grad_w]).run(feed_dict = {x: x_val, w: w_val})
+    executor = ad.Executor([y, grad_w], optimize = [ad.eliminate_common_subexpressions])
+    y_val, grad_w_val = executor.run(feed_dict = {x: x_val, w: w_val})
+    assert np.array_equal(y_val, expected[0])
+    assert np.array_equal(grad_w_val, expected[1])
+    assert executor.optimization_report["eliminate_common_subexpressions"] > 0
+    # the user's graph is not rewritten
+    assert len([n for n in ad.find_topo_sort([y]) if n.op is ad.exp_op]) == 2
+
+def test_simplify_graph():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    y = ((x2 * 2) * 3 - 1) + 1
+    z = (-1 * x3) + 5
+    w = ad.oneslike_op(x3) * x3 + ad.zeroslike_op(x3)
+    e = ad.exp_op(x3)
+    v = ad.oneslike_op(e) * e + ad.zeroslike_op(e)
+    # exp of int8 is float16, which float64 zeros of x3 would promote
+    u = e + ad.zeroslike_op(x3)
+
+    new_y, new_z, new_w, new_v, new_u = ad.simplify_graph([y, z, w, v, u])
+    assert new_y.op is ad.mul_byconst_op and new_y.const_attr == 6 and new_y.inputs[0] is x2
+    assert new_z.op is ad.sub_op_byconst and new_z.const_attr == 5 and new_z.inputs[0] is x3
+    # x3 may be fed integers, which the ones make float
+    assert new_w.op is ad.mul_byconst_op and new_w.const_attr == 1 and new_w.inputs[0] is x3
+    assert new_v is e
+    assert new_u.op is ad.add_op
+
+def test_executor_optimize_preserves_dtype():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    x = ad.Variable(name = "x")
+    m = ad.Variable(name = "m")
+    eval_nodes = [x2 - [1, 2], ad.oneslike_op(x3) + np.array([1.0, 2.0]), (x2 * [1, 2]) * [3],
+                  ad.oneslike_op(x3) * 2 * np.array([3.0, 4.0]), x2 + ad.zeroslike_op(x2), x2 * ad.oneslike_op(x2),
+                  # the fills of a bool mask are float64
+                  ad.zeroslike_op(m) + x * m, ad.add_n_op([x * m, ad.zeroslike_op(m), x]),
+                  x / (ad.oneslike_op(x) * 3), x / 3]
+    feed_dict = {x2: np.array([5, 6]), x3: np.float64(2.0), x: np.linspace(0.1, 1, 7, dtype = np.float32),
+                 m: np.arange(7) % 2 == 0}
+
+    expected = ad.Executor(eval_nodes).run(feed_dict = feed_dict)
+    executor = ad.Executor(eval_nodes, optimize = True)
+    results = executor.run(feed_dict = feed_dict)
+    for val, expected_val in zip(results, expected):
+        assert val.shape == expected_val.shape and val.dtype == expected_val.dtype
+        # bit for bit
+        assert np.array_equal(val, expected_val)
+
+def test_executor_optimize_matches_unoptimized():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    y = ad.exp_op(x2 * x2 + x2 * x3 - 2) / 4 + 1.0 / (x3 + 1)
+
+    grad_x2, grad_x3 = ad.gradients(y, [x2, x3])
+    grad_x2_x2, grad_x2_x3 = ad.gradients(grad_x2, [x2, x3])
+    eval_nodes = [y, grad_x2, grad_x3, grad_x2_x2, grad_x2_x3]
+
+    feed_dict = {x2: np.linspace(-1, 1, 4), x3: np.linspace(0, 2, 4)}
+    expected = ad.Executor(eval_nodes).run(feed_dict = feed_dict)
+    executor = ad.Executor(eval_nodes, optimize = True)
+    for val, expected_val in zip(executor.run(feed_dict = feed_dict), expected):
+        assert np.allclose(val, expected_val)
+    assert executor.optimization_report["simplify_graph"] > 0
+
+def test_sigmoid():
+    x2 = ad.Variable(name = "x2")
+    y = ad.sigmoid_op(x2)
+
+    grad_x2, = ad.gradients(y, [x2])
+
+    executor = ad.Executor([y, grad_x2])
+    x2_val = np.array([-800.0, -3.0, 0.0, 2.0, 800.0])
+    y_val, grad_x2_val = executor.run(feed_dict = {x2: x2_val})
+
+    expected_yval = np.array([0.0, 1 / (1 + np.exp(3.0)), 0.5, 1 / (1 + np.exp(-2.0)), 1.0])
+    assert np.allclose(y_val, expected_yval)
+    assert np.allclose(grad_x2_val, expected_yval * (1 - expected_yval))
+
+def test_sigmoid_cross_entropy():
+    logits = ad.Variable(name = "logits")
+    labels = ad.Variable(name = "labels")
+    y = ad.sigmoid_cross_entropy_op(logits, labels)
+
+    grad_logits, grad_labels = ad.gradients(y, [logits, labels])
+
+    executor = ad.Executor([y, grad_logits, grad_labels])
+    logits_val = np.array([-2.0, -0.5, 0.0, 1.5, 3.0])
+    labels_val = np.array([0.0, 1.0, 1.0, 0.0, 1.0])
+    y_val, grad_logits_val, grad_labels_val = executor.run(feed_dict = {logits: logits_val, labels: labels_val})
+
+    p = 1 / (1 + np.exp(-logits_val))
+    assert np.allclose(y_val, -(labels_val * np.log(p) + (1 - labels_val) * np.log(1 - p)))
+    assert np.allclose(grad_logits_val, p - labels_val)
+    assert np.allclose(grad_labels_val, -logits_val)
+
+    # large logits neither overflow nor take log(0)
+    y_val, grad_logits_val, _ = executor.run(feed_dict = {logits: np.array([-1000.0, 1000.0]), labels: np.array([1.0, 0.0])})
+    assert np.allclose(y_val, [1000.0, 1000.0])
+    assert np.allclose(grad_logits_val, [-1.0, 1.0])
+
+def test_reduce_sum_and_mean():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    y = ad.reduce_sum_op(x2 * x3, axis = 1)
+    z = ad.reduce_mean_op(ad.reduce_mean_op(x2, axis = 0, keepdims = True) * x3)
+
+    grad_x2, grad_x3 = ad.gradients(y, [x2, x3])
+    grad_z_x2, = ad.gradients(z, [x2])
+
+    executor = ad.Executor([y, z, grad_x2, grad_x3, grad_z_x2])
+    x2_val = np.arange(6.0).reshape(2, 3)
+    x3_val = np.arange(6.0, 12.0).reshape(2, 3)
+    y_val, z_val, grad_x2_val, grad_x3_val, grad_z_x2_val = executor.run(feed_dict = {x2: x2_val, x3: x3_val})
+
+    assert np.array_equal(y_val, np.sum(x2_val * x3_val, axis = 1))
+    assert np.allclose(z_val, np.mean(np.mean(x2_val, axis = 0) * x3_val))
+    assert np.array_equal(grad_x2_val, x3_val)
+    assert np.array_equal(grad_x3_val, x2_val)
+    # d/dx2[i, j] of mean_j'(mean_i(x2)[j'] * x3[., j']) = mean_i(x3)[j] / (2 * 3)
+    assert np.allclose(grad_z_x2_val, np.broadcast_to(np.mean(x3_val, axis = 0) / 6, (2, 3)))
+
+def test_broadcasting_gradients():
+    w = ad.Variable(name = "w")
+    b = ad.Variable(name = "b")
+    x = ad.Variable(name = "x")
+    y = ad.reduce_mean_op(w * x + b - x / w)
+
+    grad_w, grad_b, grad_x = ad.gradients(y, [w, b, x])
+
+    executor = ad.Executor([grad_w, grad_b, grad_x])
+    x_val = np.linspace(-1, 1, 5)
+    grad_w_val, grad_b_val, grad_x_val = executor.run(feed_dict = {w: 2.0, b: np.ones(1), x: x_val})
+
+    assert np.shape(grad_w_val) == ()
+    assert np.shape(grad_b_val) == (1,)
+    assert np.shape(grad_x_val) == (5,)
+    assert np.allclose(grad_w_val, np.mean(x_val + x_val / 4))
+    assert np.allclose(grad_b_val, [1.0])
+    assert np.allclose(grad_x_val, (2.0 - 0.5) / 5 * np.ones(5))
+
+def test_broadcast_to_and_sum_to():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    y = ad.broadcast_to_op(x2, x3) * x3
+
+    grad_x2, = ad.gradients(y, [x2])
+
+    executor = ad.Executor([y, grad_x2])
+    x2_val = np.array([[1.0], [2.0]])
+    x3_val = np.arange(6.0).reshape(2, 3)
+    y_val, grad_x2_val = executor.run(feed_dict = {x2: x2_val, x3: x3_val})
+
+    assert np.array_equal(y_val, x2_val * x3_val)
+    assert np.array_equal(grad_x2_val, np.sum(x3_val, axis = 1, keepdims = True))
+
+def test_executor_memory_plan():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    z = ad.exp_op(x2 * 0.5 + 1) * x3
+    y = ad.add_n_op([ad.log_op(z + 2), z * z, 1.0 / (z + 3), x2 - 1])
+
+    grad_x2, grad_x3 = ad.gradients(y, [x2, x3])
+
+    x2_val = np.linspace(-1, 1, 1000)
+    x3_val = np.linspace(1, 2, 1000)
+    feed_dict = {x2: x2_val, x3: x3_val}
+    expected = ad.Executor([z, y, grad_x2, grad_x3]).run(feed_dict = feed_dict)
+
+    executor = ad.Executor([z, y, grad_x2, grad_x3], memory_plan = True)
+    for i in range(2):
+        results = executor.run(feed_dict = feed_dict)
+        for val, expected_val in zip(results, expected):
+            assert np.array_equal(val, expected_val)
+    assert np.array_equal(x2_val, np.linspace(-1, 1, 1000))
+    report = executor.memory_report
+    assert report["reused_buffers"] > 0
+    assert report["planned_peak_bytes"] < report["naive_peak_bytes"]
+
+def test_executor_memory_plan_repeated_inputs():
+    x2 = ad.Variable(name = "x2")
+    z = ad.exp_op(x2)
+    w = ad.log_op(x2 + 2)
+    y = ad.add_n_op([z, z, z])
+    u = w * w + w
+
+    x2_val = np.linspace(-1, 1, 100)
+    executor = ad.Executor([y, u], memory_plan = True)
+    for i in range(2):
+        y_val, u_val = executor.run(feed_dict = {x2: x2_val})
+        assert np.allclose(y_val, 3 * np.exp(x2_val))
+        w_val = np.log(x2_val + 2)
+        assert np.allclose(u_val, w_val * w_val + w_val)
+
+def test_executor_static_shapes():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    y = ad.exp_op(x2 * x3) + x2 * 2
+    grad_x2, grad_x3 = ad.gradients(y, [x2, x3])
+
+    for memory_plan in [False, True]:
+        executor = ad.Executor([y, grad_x2, grad_x3], memory_plan = memory_plan, static_shapes = True)
+        reference = ad.Executor([y, grad_x2, grad_x3])
+        buffers = None
+        for n in [5, 5, 5, 7, 7]:
+            feed_dict = {x2: np.linspace(0, 1, n), x3: np.linspace(1, 2, n)}
+            results = executor.run(feed_dict = feed_dict)
+            for val, expected_val in zip(results, reference.run(feed_dict = feed_dict)):
+                assert np.array_equal(val, expected_val)
+            if n == 5 and buffers is not None:
+                # the same output arrays are reused while the feed shapes stay the same
+                assert all(val is buf for val, buf in zip(results, buffers))
+            buffers = results
+
+        # feeding an output back in does not let the run overwrite its own input
+        feed_dict = {x2: results[0], x3: np.ones(7)}
+        expected = reference.run(feed_dict = {x2: results[0].copy(), x3: np.ones(7)})
+        for val, expected_val in zip(executor.run(feed_dict = feed_dict), expected):
+            assert np.array_equal(val, expected_val)
+
+def test_infer_shapes_and_dtypes():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    w = ad.Variable(name = "w")
+    h = ad.matmul_op(x2, w) + x3
+    y = ad.reduce_mean_op(ad.sigmoid_op(h), axis = 1)
+    grad_x2, grad_w, grad_x3 = ad.gradients(ad.reduce_sum_op(y), [x2, w, x3])
+
+    nodes = [h, y, grad_x2, grad_w, grad_x3]
+    shapes = ad.infer_shapes(nodes, {x2: (5, 3), w: (3, 4), x3: (4,)})
+    dtypes = ad.infer_dtypes(nodes, {x2: np.float32, w: np.float32, x3: np.int32})
+    x2_val = np.ones((5, 3), dtype = np.float32)
+    w_val = np.ones((3, 4), dtype = np.float32)
+    x3_val = np.arange(4, dtype = np.int32)
+    results = ad.Executor(nodes).run(feed_dict = {x2: x2_val, w: w_val, x3: x3_val})
+    for node, val in zip(nodes, results):
+        assert shapes[node] == val.shape
+        assert dtypes[node] == val.dtype
+
+    # nodes depending on a node that is not fed have an unknown shape
+    assert ad.infer_shapes([h], {x2: (5, 3), w: (3, 4)})[h] is None
+
+    # shape errors surface before anything is computed
+    for feed_shapes in [{x2: (5, 3), w: (4, 3), x3: (4,)}, {x2: (5, 3), w: (3, 4), x3: (3,)}]:
+        try:
+            ad.infer_shapes([y], feed_shapes)
+        except AssertionError:
+            pass
+        else:
+            assert False, "incompatible shapes were not reported"
+
+    # np.sum accepts axis 0 on a 0-d array; the shape is left unknown instead of rejected
+    v = ad.Variable(name = "v")
+    s = ad.reduce_sum_op(v, axis = 0)
+    y = ad.exp_op(s) * 2 + 1
+    assert ad.infer_shapes([s, y], {v: ()})[y] is None
+    expected = ad.Executor([s, y]).run(feed_dict = {v: np.array(0.5)})
+    for options in [dict(memory_plan = True), dict(static_shapes = True), dict(memory_plan = True, static_shapes = True)]:
+        executor = ad.Executor([s, y], **options)
+        for _ in range(2):
+            results = executor.run(feed_dict = {v: np.array(0.5)})
+            for val, expected_val in zip(results, expected):
+                assert np.allclose(val, expected_val)
+
+def test_executor_static_shapes_folds_constants():
+    x2 = ad.Variable(name = "x2")
+    y = ad.reduce_sum_op(x2 * x2)
+    grad_x2, = ad.gradients(y, [x2])
+    executor = ad.Executor([ad.oneslike_op(x2), grad_x2], static_shapes = True)
+
+    x2_val = np.arange(6.0).reshape(2, 3)
+    ones_val, grad_x2_val = executor.run(feed_dict = {x2: x2_val})
+    assert np.array_equal(ones_val, np.ones((2, 3)))
+    assert not ones_val.flags.writeable
+    assert np.array_equal(grad_x2_val, 2 * x2_val)
+
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    executor = ad.Executor([ad.exp_op(ad.matmul_op(x2, w))], static_shapes = True)
+    try:
+        executor.run(feed_dict = {x2: np.ones((2, 3)), w: np.ones((2, 3))})
+    except AssertionError:
+        pass
+    else:
+        assert False, "matmul shape mismatch was not reported"
+
+def test_executor_dtype_policy():
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    labels = ad.Variable(name = "labels")
+    logits = ad.matmul_op(x2, w) * np.float64(2.0) + np.array([0.5, 1.0])
+    loss = ad.reduce_mean_op(ad.sigmoid_cross_entropy_op(logits, labels))
+    grad_w, grad_x2 = ad.gradients(loss, [w, x2])
+
+    rng = np.random.default_rng(0)
+    feed_dict = {x2: rng.random((1000, 3)), w: rng.random((3, 2)), labels: rng.integers(0, 2, (1000, 2))}
+    expected = ad.Executor([loss, grad_w, grad_x2]).run(feed_dict = feed_dict)
+    for policy, dtype in [("float32", np.float32), ("float64", np.float64), ("mixed", np.float32)]:
+        executor = ad.Executor([loss, grad_w, grad_x2], dtype = policy)
+        results = executor.run(feed_dict = feed_dict)
+        for val, expected_val in zip(results, expected):
+            assert np.result_type(val) == dtype
+            assert np.allclose(val, expected_val, rtol = 1e-5, atol = 1e-6)
+
+    # mixed precision accumulates in float64
+    x_val = np.full(10 ** 6, 0.1, dtype = np.float32)
+    y = ad.reduce_sum_op(x2 * x2)
+    y_val, = ad.Executor([y], dtype = "mixed").run(feed_dict = {x2: x_val})
+    assert y_val.dtype == np.float32
+    assert y_val == np.float32(np.sum((x_val * x_val).astype(np.float64)))
+
+    # Parameters and the optimizer state are converted for good, updates stay in the policy dtype
+    w = ad.Parameter(name = "w", value = np.ones(3))
+    loss = ad.reduce_sum_op(w * x2) * ad.reduce_sum_op(w * x2)
+    executor = ad.Executor([loss, ad.Momentum(0.01).minimize(loss, [w])], dtype = "float32")
+    for i in range(2):
+        loss_val, _ = executor.run(feed_dict = {x2: np.array([1.0, -2.0, 3.0])})
+        assert loss_val.dtype == np.float32 and w.const_attr.dtype == np.float32
+    assert np.isclose(loss_val, (2 - 0.01 * 2 * 2 * 14) ** 2, rtol = 1e-5)
+
+def test_fuse_elementwise():
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    h = w * x2 + 1
+    y = 1 / (ad.exp_op(-1 * h) + 1)
+    loss = ad.reduce_sum_op(y * y + ad.log_op(y) * 3 - ad.sigmoid_op(h) / 2)
+    grad_x2, grad_w = ad.gradients(loss, [x2, w])
+    nodes = [loss, y, grad_x2, grad_w]
+
+    fused_nodes = ad.fuse_elementwise(nodes)
+    assert len(ad.find_topo_sort(fused_nodes)) < len(ad.find_topo_sort(nodes))
+    assert any(node.op is ad.fused_elementwise_op for node in ad.find_topo_sort(fused_nodes))
+
+    feed_dict = {x2: np.linspace(-2, 2, 12).reshape(3, 4), w: np.linspace(0, 1, 4)}
+    expected = ad.Executor(nodes).run(feed_dict = feed_dict)
+    saved_min_size = ad._numexpr_min_size
+    # numexpr kernels (if it is installed) even for these small arrays, and the numpy ones
+    ad._numexpr_min_size = 0
+    try:
+        for fuse in [True, "numexpr"]:
+            for options in [{}, {"memory_plan": True}, {"static_shapes": True}]:
+                executor = ad.Executor(nodes, fuse = fuse, **options)
+                for i in range(2):
+                    results = executor.run(feed_dict = feed_dict)
+                    for val, expected_val in zip(results, expected):
+                        assert np.allclose(val, expected_val)
+
+        # numexpr would compute in float64 what numpy computes in float16 or float32
+        y = ad.exp_op(x2) + x2
+        for x2_val in [np.arange(-8, 8, dtype = np.int8), np.linspace(-2, 2, 16).astype(np.float32)]:
+            expected_val, = ad.Executor([y]).run(feed_dict = {x2: x2_val})
+            val, = ad.Executor([y], fuse = "numexpr").run(feed_dict = {x2: x2_val})
+            assert val.dtype == expected_val.dtype and val.dtype in (np.float16, np.float32)
+            assert np.allclose(val, expected_val, rtol = 1e-3)
+
+        # scalar and integer feeds take the numpy kernels
+        y = ad.exp_op(x2 * 0.5) + 1
+        for x2_val in [np.float64(2.0), np.array(2.0), np.arange(4), np.arange(4, dtype = np.int32)]:
+            expected_val, = ad.Executor([y]).run(feed_dict = {x2: x2_val})
+            val, = ad.Executor([y], fuse = "numexpr").run(feed_dict = {x2: x2_val})
+            assert np.result_type(val) == np.result_type(expected_val)
+            assert np.allclose(val, expected_val)
+    finally:
+        ad._numexpr_min_size = saved_min_size
+
+def test_jvp():
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    b = ad.Variable(name = "b")
+    v = ad.Variable(name = "v")
+    h = ad.matmul_op(w, x2)
+    y = ad.sigmoid_op(h * 2 + b) / (ad.exp_op(h) + 1) - ad.log_op(h * h + 1)
+    loss = ad.reduce_mean_op(ad.sigmoid_cross_entropy_op(y, b)) + ad.reduce_sum_op(x2 * x2)
+    z = ad.matmul_op(ad.broadcast_to_op(x2, w), w, trans_B = True)
+    outputs = [y, loss, z, b * 2]
+
+    x2_val = np.linspace(-1, 1, 4)
+    feed_dict = {x2: x2_val, w: np.linspace(0, 2, 12).reshape(3, 4), b: np.linspace(0, 1, 3)}
+    def with_values(values):
+        new_feed_dict = dict(feed_dict)
+        new_feed_dict.update(values)
+        return new_feed_dict
+
+    evaluate = ad.Executor(outputs)
+    tangent_executor = ad.Executor(ad.jvp(outputs, x2, v))
+    eps = 1e-6
+    columns = []
+    for direction in np.eye(4):
+        tangents = tangent_executor.run(feed_dict = with_values({v: direction}))
+        plus = evaluate.run(feed_dict = with_values({x2: x2_val + eps * direction}))
+        minus = evaluate.run(feed_dict = with_values({x2: x2_val - eps * direction}))
+        for tangent, p, m in zip(tangents, plus, minus):
+            assert np.allclose(tangent, (p - m) / (2 * eps), atol = 1e-6)
+        columns.append(tangents)
+
+    # all columns of the Jacobians in one run
+    for options in [{}, {"memory_plan": True}, {"static_shapes": True}]:
+        executor = ad.Executor(ad.jvp(outputs, x2, v, vectorized = True), **options)
+        tangents = executor.run(feed_dict = with_values({v: np.eye(4)}))
+        for i in range(3):
+            assert np.allclose(tangents[i], np.stack([column[i] for column in columns]))
+        assert np.array_equal(tangents[3], np.zeros(3))
+
+def test_jacobian():
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    b = ad.Variable(name = "b")
+    v = ad.Variable(name = "v")
+    h = ad.matmul_op(x2, w) + b
+    y = ad.sigmoid_op(h) * ad.exp_op(ad.reduce_mean_op(h, axis = 0))
+    jacobian_w, jacobian_b = ad.jacobian(y, [w, b])
+
+    feed_dict = {x2: np.linspace(-1, 1, 15).reshape(5, 3), w: np.linspace(0, 1, 6).reshape(3, 2),
+                 b: np.array([0.5, -0.5])}
+    jacobian_w_val, jacobian_b_val = ad.Executor([jacobian_w, jacobian_b]).run(feed_dict = feed_dict)
+    assert jacobian_w_val.shape == (10, 3, 2)
+    assert jacobian_b_val.shape == (10, 2)
+
+    # the columns from forward mode agree
+    feed_dict[v] = np.eye(6).reshape(6, 3, 2)
+    columns_w, = ad.Executor(ad.jvp([y], w, v, vectorized = True)).run(feed_dict = feed_dict)
+    assert np.allclose(jacobian_w_val.reshape(10, 6), columns_w.reshape(6, 10).T)
+    feed_dict[v] = np.eye(2)
+    columns_b, = ad.Executor(ad.jvp([y], b, v, vectorized = True)).run(feed_dict = feed_dict)
+    assert np.allclose(jacobian_b_val, columns_b.reshape(2, 10).T)
+
+    # a node that y does not depend on has rows of zeros
+    jacobian_w, jacobian_v = ad.jacobian(y, [w, v])
+    jacobian_w_val, jacobian_v_val = ad.Executor([jacobian_w, jacobian_v]).run(feed_dict = feed_dict)
+    assert jacobian_w_val.shape == (10, 3, 2)
+    assert jacobian_v_val.shape == (10, 2, 2) and not np.any(jacobian_v_val)
+
+def test_hvp():
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    b = ad.Variable(name = "b")
+    labels = ad.Variable(name = "labels")
+    v_w = ad.Variable(name = "v_w")
+    v_b = ad.Variable(name = "v_b")
+    loss = ad.reduce_mean_op(ad.sigmoid_cross_entropy_op(ad.matmul_op(x2, w) + b, labels))
+    grad_w, grad_b = ad.gradients(loss, [w, b])
+    hvp_w, hvp_b = ad.hvp(loss, [w, b], [v_w, v_b])
+
+    w_val = np.linspace(-1, 1, 6).reshape(3, 2)
+    b_val = np.array([0.1, -0.2])
+    feed_dict = {x2: np.linspace(-2, 2, 15).reshape(5, 3), labels: np.arange(10).reshape(5, 2) % 3 == 0,
+                 w: w_val, b: b_val}
+    v_w_val = np.linspace(1, 2, 6).reshape(3, 2)
+    v_b_val = np.array([1.0, -1.0])
+    feed_dict.update({v_w: v_w_val, v_b: v_b_val})
+    hvp_w_val, hvp_b_val = ad.Executor([hvp_w, hvp_b]).run(feed_dict = feed_dict)
+
+    # central difference of the gradient along v
+    eps = 1e-5
+    gradient_executor = ad.Executor([grad_w, grad_b])
+    feed_dict.update({w: w_val + eps * v_w_val, b: b_val + eps * v_b_val})
+    plus = gradient_executor.run(feed_dict = feed_dict)
+    feed_dict.update({w: w_val - eps * v_w_val, b: b_val - eps * v_b_val})
+    minus = gradient_executor.run(feed_dict = feed_dict)
+    assert np.allclose(hvp_w_val, (plus[0] - minus[0]) / (2 * eps), atol = 1e-7)
+    assert np.allclose(hvp_b_val, (plus[1] - minus[1]) / (2 * eps), atol = 1e-7)
+
+    # the whole Hessian in one run
+    feed_dict.update({w: w_val, b: b_val, v_w: np.eye(8)[:, :6].reshape(8, 3, 2), v_b: np.eye(8)[:, 6:]})
+    hessian_w, hessian_b = ad.Executor(ad.hvp(loss, [w, b], [v_w, v_b], vectorized = True)).run(feed_dict = feed_dict)
+    hessian = np.concatenate([hessian_w.reshape(8, 6), hessian_b], axis = 1)
+    assert np.allclose(hessian, hessian.T)
+    assert np.allclose(hessian[:, :6] @ v_w_val.ravel() + hessian[:, 6:] @ v_b_val,
+                       np.concatenate([hvp_w_val.ravel(), hvp_b_val]))
+
+def test_gradient_cache():
+    x2 = ad.Variable(name = "x2")
+    x3 = ad.Variable(name = "x3")
+    y = ad.exp_op(x2) * x3 + x2
+    cache = ad.GradientCache(maxsize = 2)
+
+    grad_x2, grad_x3 = cache.gradients(y, [x2, x3])
+    assert cache.gradients(y, [x3]) == [grad_x3]
+    assert cache.gradients(y, [x3, x2]) == [grad_x3, grad_x2]
+    assert cache.stats() == {"hits": 2, "misses": 1, "evictions": 0, "size": 1}
+
+    # a new node is added to the entry, the old ones are still served
+    cache.gradients(2 * y, [x2])
+    assert cache.gradients(y, [x3]) == [grad_x3]
+    grad_y, = cache.gradients(y, [y])
+    assert cache.gradients(y, [x2, x3, y])[2] is grad_y
+    assert cache.stats() == {"hits": 4, "misses": 3, "evictions": 0, "size": 2}
+
+    # least recently used entry is evicted
+    cache.gradients(y * y, [x2])
+    assert cache.evictions == 1 and len(cache) == 2
+
+    x2_val = 2 * np.ones(3)
+    x3_val = 3 * np.ones(3)
+    grad_x2_val, grad_x3_val, grad_y_val = ad.Executor(cache.gradients(y, [x2, x3, y])).run(
+        feed_dict = {x2: x2_val, x3: x3_val})
+    assert np.allclose(grad_x2_val, np.exp(x2_val) * x3_val + 1)
+    assert np.allclose(grad_x3_val, np.exp(x2_val))
+    assert np.allclose(grad_y_val, np.ones(3))
+
+    # rewiring the graph invalidates the entry
+    misses = cache.misses
+    y.inputs = [y.inputs[0], x3]
+    grad_x2, = cache.gradients(y, [x2])
+    assert cache.misses == misses + 1
+    assert np.allclose(ad.Executor([grad_x2]).run(feed_dict = {x2: x2_val, x3: x3_val})[0], np.exp(x2_val) * x3_val)
+
+    cache.clear()
+    assert cache.stats() == {"hits": 0, "misses": 0, "evictions": 0, "size": 0}
+    assert ad.cached_gradients(y, [x3]) == ad.cached_gradients(y, [x3])
+
+def test_gradients_prune_unreached_branches():
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    z = ad.Variable(name = "z")
+    unused = ad.Variable(name = "unused")
+    exp_z = ad.exp_op(z)
+    y = ad.reduce_sum_op(x2 * w) + ad.reduce_sum_op(exp_z)
+    grad_x2, grad_unused = ad.gradients(y, [x2, unused])
+
+    # nothing is backpropagated into the branch of z
+    consumers_of_exp_z = [node for node in ad.find_topo_sort([grad_x2]) if exp_z in node.inputs]
+    assert len(consumers_of_exp_z) == 1 and consumers_of_exp_z[0].op is ad.reduce_sum_op
+
+    x2_val = np.array([1.0, 2.0])
+    w_val = np.array([3.0, 4.0])
+    grad_x2_val, grad_unused_val = ad.Executor([grad_x2, grad_unused]).run(
+        feed_dict = {x2: x2_val, w: w_val, z: np.zeros(2), unused: np.ones((2, 2))})
+    assert np.array_equal(grad_x2_val, w_val)
+    assert np.array_equal(grad_unused_val, np.zeros((2, 2)))
+
+def test_parameter():
+    w = ad.Parameter(name = "w", value = [1, 2])
+    x2 = ad.Variable(name = "x2")
+    y = ad.reduce_sum_op(w * x2)
+    grad_w, = ad.gradients(y, [w])
+    assert w.const_attr.dtype == np.float64
+
+    for executor in [ad.Executor([y, grad_w]), ad.Executor([y, grad_w], static_shapes = True, memory_plan = True)]:
+        y_val, grad_w_val = executor.run(feed_dict = {x2: np.array([3.0, 4.0])})
+        assert y_val == 11
+        assert np.array_equal(grad_w_val, [3.0, 4.0])
+
+    w.const_attr[:] = [0, 1]
+    y_val, = ad.Executor([y]).run(feed_dict = {x2: np.array([3.0, 4.0])})
+    assert y_val == 4
+
+def optimizer_reference(name, w_val, grads, learning_rate):
+    """Sequence of values of w for the gradients in grads, in plain numpy."""
+    m = np.zeros_like(w_val)
+    v = np.zeros_like(w_val)
+    values = []
+    for step, grad in enumerate(grads, 1):
+        if name == "sgd":
+            w_val = w_val - learning_rate * grad
+        elif name == "momentum":
+            m = 0.9 * m + grad
+            w_val = w_val - learning_rate * m
+        else:
+            m = 0.9 * m + 0.1 * grad
+            v = 0.999 * v + 0.001 * grad ** 2
+            w_val = w_val - learning_rate * (m / (1 - 0.9 ** step)) / (np.sqrt(v / (1 - 0.999 ** step)) + 1e-8)
+        values.append(w_val)
+    return values
+
+def test_optimizers():
+    x2 = ad.Variable(name = "x2")
+    x2_val = np.array([1.0, -2.0, 3.0])
+    for name, optimizer in [("sgd", ad.SGD(0.01)), ("momentum", ad.Momentum(0.01)), ("adam", ad.Adam(0.01))]:
+        for options in [{}, {"static_shapes": True, "memory_plan": True}, {"memory_plan": True, "optimize": True}]:
+            w = ad.Parameter(name = "w", value = np.ones(3))
+            b = ad.Parameter(name = "b", value = 0)
+            pred = ad.reduce_sum_op(w * x2) + b
+            loss = pred * pred
+            update = optimizer.minimize(loss, [w, b])
+            w_val, b_val = w.const_attr, b.const_attr
+            executor = ad.Executor([loss, update], **options)
+
+            # the loss is computed before the update
+            loss_vals = []
+            w_grads = []
+            b_grads = []
+            for i in range(5):
+                pred_val = np.sum(w_val * x2_val) + b_val
+                w_grads.append(2 * pred_val * x2_val)
+                b_grads.append(2 * pred_val)
+                loss_val, update_val = executor.run(feed_dict = {x2: x2_val})
+                assert update_val is None
+                assert np.isclose(loss_val, pred_val ** 2)
+                loss_vals.append(float(loss_val))
+            assert w.const_attr is w_val and b.const_attr is b_val
+            assert np.allclose(w_val, optimizer_reference(name, np.ones(3), w_grads, optimizer.learning_rate)[-1])
+            assert np.allclose(b_val, optimizer_reference(name, np.zeros(()), b_grads, optimizer.learning_rate)[-1])
+            assert loss_vals[-1] < loss_vals[0]
+
+def test_updates_run_last():
+    w = ad.Parameter(name = "w", value = np.ones(2))
+    x2 = ad.Variable(name = "x2")
+    out = w * x2
+    update = ad.SGD(1.0).minimize(ad.reduce_sum_op(w), [w])
+    # out does not feed the update, it still sees the value before the step
+    update_val, out_val = ad.Executor([update, out]).run(feed_dict = {x2: np.array([2.0, 3.0])})
+    assert np.array_equal(out_val, [2.0, 3.0])
+    assert np.array_equal(w.const_attr, [0.0, 0.0])
+
+def test_executor_num_workers():
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    b = ad.Parameter(name = "b", value = np.zeros(4))
+    h = ad.matmul_op(x2, w) + b
+    loss = ad.reduce_mean_op(ad.log_op(ad.sigmoid_op(h)) + ad.log_op(1 - ad.sigmoid_op(h * 2)))
+    grad_x2, grad_w = ad.gradients(loss, [x2, w])
+    update = ad.SGD(0.5).minimize(loss, [b])
+    rng = np.random.default_rng(0)
+    feed_dict = {x2: rng.standard_normal((ad._parallel_min_size, 3)), w: rng.standard_normal((3, 4))}
+
+    expected = ad.Executor([loss, grad_x2, grad_w]).run(feed_dict = feed_dict)
+    for options in [{}, {"static_shapes": True}, {"fuse": True, "optimize": True}]:
+        with ad.Executor([loss, grad_x2, grad_w], num_workers = 4, **options) as executor:
+            for i in range(2):
+                for val, expected_val in zip(executor.run(feed_dict = feed_dict), expected):
+                    assert np.allclose(val, expected_val)
+            pool = executor._pool
+            assert pool is not None
+        # the threads are stopped on exit
+        assert executor._pool is None and pool._shutdown
+
+    # the update still sees every other node computed first
+    with ad.Executor([loss, update], num_workers = 4) as executor:
+        loss_val, _ = executor.run(feed_dict = feed_dict)
+    assert np.isclose(loss_val, expected[0])
+    assert not np.array_equal(b.const_attr, np.zeros(4))
+
+    # small feeds run serially
+    with ad.Executor([loss], num_workers = 4) as executor:
+        executor.run(feed_dict = {x2: np.ones((2, 3)), w: np.ones((3, 4))})
+        assert executor._pool is None
+
+    # errors in a worker reach the caller
+    with ad.Executor([loss], num_workers = 4) as executor:
+        try:
+            executor.run(feed_dict = {x2: feed_dict[x2], w: np.ones((2, 4))})
+            assert False
+        except ValueError:
+            pass
+
+    # an executor that is not closed stops its threads when collected
+    executor = ad.Executor([loss], num_workers = 4)
+    executor.run(feed_dict = feed_dict)
+    pool = executor._pool
+    del executor
+    gc.collect()
+    assert pool._shutdown
+
+def test_vmap_ensemble():
+    w = ad.Variable(name = "w")
+    b = ad.Variable(name = "b")
+    x = ad.Variable(name = "x")
+    labels = ad.Variable(name = "labels")
+    logits = w * x + b
+    loss = ad.reduce_mean_op(ad.sigmoid_cross_entropy_op(logits, labels))
+    grad_w, grad_b = ad.gradients(loss, [w, b])
+    num_labels = ad.reduce_sum_op(labels)
+    node_list = [loss, grad_w, grad_b, ad.sigmoid_op(logits), num_labels]
+    ensemble = ad.vmap(node_list, [w, b])
+
+    x_val = np.arange(-10, 6, 0.5)
+    labels_val = (5 * x_val + 20 > 0).astype(float)
+    w_vals = np.linspace(1, 10, 4)
+    b_vals = np.linspace(0, 5, 4)
+    single = ad.Executor(node_list)
+    for options in [{}, {"optimize": True}, {"static_shapes": True, "memory_plan": True}, {"fuse": True}]:
+        results = ad.Executor(ensemble, **options).run(feed_dict = {w: w_vals, b: b_vals, x: x_val, labels: labels_val})
+        for k in range(4):
+            expected = single.run(feed_dict = {w: w_vals[k], b: b_vals[k], x: x_val, labels: labels_val})
+            for val, expected_val in zip(results, expected):
+                assert val.shape == (4,) + np.shape(expected_val)
+                assert np.allclose(val[k], expected_val)
+
+def test_vmap_matmul():
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    b = ad.Parameter(name = "b", value = np.zeros((3, 2)))
+    h = ad.matmul_op(x2, w) + b
+    loss = ad.reduce_sum_op(ad.exp_op(h), axis = 0)
+    grad_w, = ad.gradients(loss, [w])
+    batched_loss, batched_grad_w = ad.vmap([loss, grad_w], [w, b])
+
+    rng = np.random.default_rng(0)
+    x2_val = rng.standard_normal((5, 3))
+    w_vals = rng.standard_normal((6, 3, 2))
+    b_vals = rng.standard_normal((6, 5, 2))
+    b.const_attr = b_vals
+    loss_vals, grad_w_vals = ad.Executor([batched_loss, batched_grad_w]).run(feed_dict = {x2: x2_val, w: w_vals})
+    assert loss_vals.shape == (6, 2) and grad_w_vals.shape == (6, 3, 2)
+    for k in range(6):
+        h_val = x2_val @ w_vals[k] + b_vals[k]
+        assert np.allclose(loss_vals[k], np.exp(h_val).sum(axis = 0))
+        assert np.allclose(grad_w_vals[k], x2_val.T @ np.exp(h_val))
+
+def test_save_and_load_graph(tmp_path):
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    b = ad.Parameter(name = "b", value = [0.5, -0.5])
+    labels = ad.Variable(name = "labels")
+    h = ad.matmul_op(x2, w, trans_B = True) + b
+    loss = ad.reduce_mean_op(ad.sigmoid_cross_entropy_op(h, labels)) + 2 * ad.reduce_sum_op(h, axis = (0, 1))
+    y = ad.reduce_sum_op(ad.exp_op(h / 3.0) - 1, axis = 1, keepdims = True)
+    node_list = [loss, y] + ad.gradients(loss, [w, b])
+    # accumulating and batched ops are saved as well
+    node_list += ad.apply_dtype_policy([loss], [x2, w, labels], "mixed")
+    node_list += ad.vmap([y], [w])
+
+    rng = np.random.default_rng(0)
+    x2_val = rng.standard_normal((5, 3))
+    w_val = rng.standard_normal((2, 3))
+    labels_val = rng.random((5, 2)) > 0.5
+    expected = ad.Executor(node_list[:-1]).run(feed_dict = {x2: x2_val, w: w_val, labels: labels_val})
+    expected_batched, = ad.Executor(node_list[-1:]).run(feed_dict = {x2: x2_val, w: np.stack([w_val, 2 * w_val]),
+                                                                     labels: labels_val})
+
+    ad.save_graph(tmp_path / "graph.npz", node_list)
+    loaded, named_nodes = ad.load_graph(tmp_path / "graph.npz")
+    assert len(ad.find_topo_sort(loaded)) == len(ad.find_topo_sort(node_list))
+    assert set(named_nodes) == {"x2", "w", "b", "labels"}
+    assert str(loaded[1]) == str(y)
+    x2, w, labels = named_nodes["x2"], named_nodes["w"], named_nodes["labels"]
+    values = ad.Executor(loaded[:-1]).run(feed_dict = {x2: x2_val, w: w_val, labels: labels_val})
+    for val, expected_val in zip(values, expected):
+        assert np.array_equal(val, expected_val) and np.result_type(val) == np.result_type(expected_val)
+    batched, = ad.Executor(loaded[-1:]).run(feed_dict = {x2: x2_val, w: np.stack([w_val, 2 * w_val]),
+                                                         labels: labels_val})
+    assert np.array_equal(batched, expected_batched)
+
+    # numpy scalar constants keep their dtype
+    x = ad.Variable(name = "x")
+    node_list = [x * np.float64(2), x + np.float32(1) - 1.5, x * np.int64(3) + np.bool_(True)]
+    ad.save_graph(tmp_path / "scalars.npz", node_list)
+    loaded, named_nodes = ad.load_graph(tmp_path / "scalars.npz")
+    x_val = np.linspace(0, 1, 5, dtype = np.float32)
+    expected = ad.Executor(node_list).run(feed_dict = {x: x_val})
+    values = ad.Executor(loaded).run(feed_dict = {named_nodes["x"]: x_val})
+    for node, loaded_node, val, expected_val in zip(node_list, loaded, values, expected):
+        assert type(loaded_node.const_attr) is type(node.const_attr)
+        assert np.array_equal(val, expected_val) and val.dtype == expected_val.dtype
+
+def test_profiler(tmp_path):
+    x2 = ad.Variable(name = "x2")
+    w = ad.Variable(name = "w")
+    h = ad.matmul_op(x2, w)
+    h.name = "h"
+    loss = ad.reduce_sum_op(ad.exp_op(h) * 2)
+    grad_w, = ad.gradients(loss, [w])
+    feed_dict = {x2: np.ones((100, 3)), w: np.ones((3, 4))}
+    for options in [{}, {"static_shapes": True}, {"memory_plan": True}]:
+        profiler = ad.Profiler()
+        executor = ad.Executor([loss, grad_w], profiler = profiler, **options)
+        expected = ad.Executor([loss, grad_w]).run(feed_dict = feed_dict)
+        for i in range(3):
+            for val, expected_val in zip(executor.run(feed_dict = feed_dict), expected):
+                assert np.allclose(val, expected_val)
+
+        calls, nanoseconds, nbytes, shape, dtype = profiler.node_stats[h]
+        assert calls == 3 and nanoseconds > 0 and nbytes == 3 * 100 * 4 * 8
+        assert shape == (100, 4) and dtype == np.float64
+        op_stats = profiler.op_stats()
+        assert op_stats["MatMulOp"][0] == 3 * len([node for node in ad.find_topo_sort([loss, grad_w])
+                                                    if node.op is ad.matmul_op])
+        assert sum(calls for calls, _, _ in op_stats.values()) == len(profiler.events)
+        if options.get("static_shapes"):
+            # written into buffers allocated ahead of time
+            assert op_stats["ExpOp"][2] == 0
+        assert profiler.report(3).count("\n") == 3
+        assert profiler.report(by = "op").splitlines()[0].startswith("op")
+        report = profiler.report(len(profiler.node_stats))
+        assert "h " in report and "ExpOp@" in report
+
+    profiler.save_chrome_trace(tmp_path / "trace.json")
+    with open(tmp_path / "trace.json") as f:
+        trace = json.load(f)
+    assert len(trace["traceEvents"]) == len(profiler.events)
+    assert {"MatMulOp", "ExpOp", "ReduceSumOp"} <= set(event["cat"] for event in trace["traceEvents"])
+    assert "h" in set(event["name"] for event in trace["traceEvents"])
+
+    # detached, nothing more is recorded
+    executor.profiler = None
+    executor.run(feed_dict = feed_dict)
+    assert profiler.node_stats[h][0] == 3
+
+    # instrumented copies of older step lists are dropped
+    steps = next(iter(executor._plans.values())).steps
+    step_lists = [list(steps) for i in range(ad.Profiler.max_instrumented + 5)]
+    for steps in step_lists:
+        profiler.instrument(steps)
+    assert len(profiler._instrumented) == ad.Profiler.max_instrumented
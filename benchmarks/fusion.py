@@ -0,0 +1,60 @@
+"""Benchmark element-wise fusion on the logistic regression forward pass.
+
+Compares running each node as its own NumPy call against fused kernels, with
+NumPy ufuncs and (if it is installed) numexpr, Executor(fuse="numexpr").
+
+Run from the repository root:
+
+    python -m benchmarks.fusion [num_elements ...]
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import autodiff as ad
+
+
+def build_forward():
+    """sigmoid(w*x + b) written with the basic ops, as in logreg.py."""
+    x = ad.Variable(name = "x")
+    w = ad.Variable(name = "w")
+    b = ad.Variable(name = "b")
+    out = 1 / (ad.exp_op(-1 * (w * x + b)) + 1)
+    return x, w, b, out
+
+
+def measure(executor, feed_dict, repeat):
+    executor.run(feed_dict = feed_dict)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(repeat):
+        result, = executor.run(feed_dict = feed_dict)
+    elapsed = (time.perf_counter() - start) / repeat
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(*sizes):
+    x, w, b, out = build_forward()
+    configs = [("unfused", False), ("fused, numpy", True)]
+    if ad.numexpr is not None:
+        configs.append(("fused, numexpr", "numexpr"))
+    for num_elements in sizes or (10 ** 7,):
+        rng = np.random.default_rng(0)
+        feed_dict = {x: rng.standard_normal(num_elements), w: np.ones(num_elements), b: np.zeros(num_elements)}
+        print("elements=%d" % num_elements)
+        baseline = expected = None
+        for label, fuse in configs:
+            result, elapsed, peak = measure(ad.Executor([out], fuse = fuse), feed_dict, 5)
+            if expected is None:
+                baseline, expected = elapsed, result
+            assert np.allclose(result, expected)
+            print("  %-15s %8.1f ms  speedup %.2fx  peak %.0f MB"
+                  % (label, 1e3 * elapsed, baseline / elapsed, peak / 2.0 ** 20))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,41 @@
+"""Benchmark time and memory of building large graphs with the Node operators.
+
+Run from the repository root:
+
+    python -m benchmarks.graph_build [num_nodes ...]
+"""
+import sys
+import time
+import tracemalloc
+
+import autodiff as ad
+
+
+def build_chain(num_nodes):
+    """Alternate x*c and x+c so that every node depends on the previous one."""
+    node = ad.Variable(name = "x")
+    for i in range(num_nodes // 2):
+        node = node * 1.0001 + 1
+    return node
+
+
+def measure(num_nodes):
+    tracemalloc.start()
+    start = time.perf_counter()
+    root = build_chain(num_nodes)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return root, elapsed, peak
+
+
+def main(*sizes):
+    for num_nodes in sizes or (100000, 1000000):
+        root, elapsed, peak = measure(num_nodes)
+        print("nodes=%-8d build=%.3fs (%.2f us/node)  peak=%.1f MB (%d B/node)"
+              % (num_nodes, elapsed, 1e6 * elapsed / num_nodes, peak / 2.0 ** 20, peak // num_nodes))
+        del root
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
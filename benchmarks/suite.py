@@ -0,0 +1,201 @@
+"""Benchmark suite of the hot paths, with results saved as JSON for comparison across commits.
+
+Every scenario is run for a list of parameter sets. The median and minimum
+of the timed calls are reported, and the peak memory is reported for one
+more call traced with tracemalloc. Tracing slows the code down, so that call
+is not timed.
+
+Run from the repository root:
+
+    python -m benchmarks.suite [--filter NAME] [--repeat N] [--full] [--output results.json]
+    python -m benchmarks.suite --compare before.json after.json
+
+--full adds the largest sizes (10^6 node graphs, 10^7 element arrays).
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import autodiff as ad
+from benchmarks import topo_sort
+
+
+def bench_topo_sort(shape, num_nodes):
+    """find_topo_sort on a deep chain or a wide fan-in."""
+    build = topo_sort.build_chain if shape == "chain" else topo_sort.build_fan_in
+    root = build(num_nodes)
+    return lambda: ad.find_topo_sort([root])
+
+
+def bench_gradients(num_nodes):
+    """Building the gradient graph of a chain of element-wise ops."""
+    x = ad.Variable(name = "x")
+    y = x
+    for i in range(num_nodes // 3):
+        y = ad.exp_op(y * 0.5) + x
+    return lambda: ad.gradients(y, [x])
+
+
+def bench_executor_run(num_elements, options):
+    """Executor.run of the logistic regression loss and its gradients on num_elements points."""
+    x = ad.Variable(name = "x")
+    labels = ad.Variable(name = "labels")
+    w = ad.Variable(name = "w")
+    b = ad.Variable(name = "b")
+    loss = ad.reduce_mean_op(ad.sigmoid_cross_entropy_op(w * x + b, labels))
+    executor = ad.Executor([loss] + ad.gradients(loss, [w, b]), **options)
+    rng = np.random.default_rng(0)
+    feed_dict = {x: rng.standard_normal(num_elements), labels: rng.random(num_elements) > 0.5,
+                 w: np.float64(1.0), b: np.float64(0.0)}
+    executor.run(feed_dict = feed_dict)
+    return lambda: executor.run(feed_dict = feed_dict)
+
+
+def bench_matmul(m, k, n):
+    """Executor.run of a single matmul_op of (m, k) by (k, n)."""
+    a = ad.Variable(name = "a")
+    b = ad.Variable(name = "b")
+    executor = ad.Executor([ad.matmul_op(a, b)])
+    rng = np.random.default_rng(0)
+    feed_dict = {a: rng.standard_normal((m, k)), b: rng.standard_normal((k, n))}
+    executor.run(feed_dict = feed_dict)
+    return lambda: executor.run(feed_dict = feed_dict)
+
+
+def bench_logreg_training(num_iterations):
+    """The training loop of logreg.py, with in-graph SGD."""
+    x = ad.Variable(name = "x")
+    labels = ad.Variable(name = "labels")
+    x_val = np.arange(-10, 6, 0.01)
+    labels_val = (5 * x_val + 20 > 0).astype(float)
+
+    def train():
+        w = ad.Parameter(name = "w", value = 10)
+        b = ad.Parameter(name = "b", value = 1)
+        loss = ad.reduce_mean_op(ad.sigmoid_cross_entropy_op(w * x + b, labels))
+        executor = ad.Executor([loss, ad.SGD(1).minimize(loss, [w, b])], optimize = True)
+        for i in range(num_iterations):
+            executor.run(feed_dict = {x: x_val, labels: labels_val})
+    return train
+
+
+# (name, setup, parameter sets, parameter sets added by --full)
+SCENARIOS = [
+    ("find_topo_sort", bench_topo_sort,
+     [{"shape": "chain", "num_nodes": 10 ** 5}, {"shape": "fan-in", "num_nodes": 10 ** 5}],
+     [{"shape": "chain", "num_nodes": 10 ** 6}, {"shape": "fan-in", "num_nodes": 10 ** 6}]),
+    ("gradients", bench_gradients,
+     [{"num_nodes": 10 ** 3}, {"num_nodes": 10 ** 4}, {"num_nodes": 10 ** 5}],
+     [{"num_nodes": 10 ** 6}]),
+    ("executor_run", bench_executor_run,
+     [{"num_elements": 10 ** e, "options": options} for e in (1, 3, 5)
+      for options in ({}, {"optimize": True, "fuse": True}, {"static_shapes": True, "memory_plan": True})],
+     [{"num_elements": 10 ** 7, "options": options}
+      for options in ({}, {"optimize": True, "fuse": True}, {"static_shapes": True, "memory_plan": True})]),
+    ("matmul", bench_matmul,
+     [{"m": 64, "k": 64, "n": 64}, {"m": 256, "k": 256, "n": 256}, {"m": 10000, "k": 100, "n": 1}],
+     [{"m": 1024, "k": 1024, "n": 1024}]),
+    ("logreg_training", bench_logreg_training,
+     [{"num_iterations": 200}],
+     [{"num_iterations": 10000}]),
+]
+
+
+def measure(setup, params, repeat):
+    """Return a result dict for setup(**params): time of repeat calls and the peak memory of one."""
+    run = setup(**params)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"params": params, "repeat": repeat, "median_s": statistics.median(times), "min_s": min(times),
+            "peak_bytes": peak - base}
+
+
+def run_suite(name_filter=None, repeat=5, full=False):
+    """Run the scenarios whose name contains name_filter, printing each result. Returns the results."""
+    results = []
+    for name, setup, param_sets, full_param_sets in SCENARIOS:
+        if name_filter and name_filter not in name:
+            continue
+        for params in param_sets + (full_param_sets if full else []):
+            result = measure(setup, params, repeat)
+            result["scenario"] = name
+            results.append(result)
+            print("%-16s %-60s median %10.3f ms  min %10.3f ms  peak %9.1f MB"
+                  % (name, _format_params(params), 1e3 * result["median_s"], 1e3 * result["min_s"],
+                     result["peak_bytes"] / 2.0 ** 20))
+            sys.stdout.flush()
+    return results
+
+
+def metadata():
+    """Where the results come from: the commit, library versions and the machine."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit or None, "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(), "numpy": np.__version__,
+            "numexpr": None if ad.numexpr is None else ad.numexpr.__version__,
+            "machine": platform.machine(), "platform": platform.platform()}
+
+
+def compare(before, after):
+    """Print the change of the median time of every result in both files."""
+    with open(before) as f:
+        before_results = {_key(result): result for result in json.load(f)["results"]}
+    with open(after) as f:
+        after_results = json.load(f)["results"]
+    for result in after_results:
+        old = before_results.get(_key(result))
+        if old is None:
+            continue
+        ratio = result["median_s"] / old["median_s"]
+        print("%-16s %-60s %10.3f ms -> %10.3f ms  %6.2fx%s"
+              % (result["scenario"], _format_params(result["params"]), 1e3 * old["median_s"],
+                 1e3 * result["median_s"], ratio, "  slower" if ratio > 1.1 else ""))
+
+
+def _key(result):
+    return result["scenario"], json.dumps(result["params"], sort_keys=True)
+
+
+def _format_params(params):
+    return " ".join("%s=%s" % item for item in sorted(params.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--filter", help="only run scenarios whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls per parameter set")
+    parser.add_argument("--full", action="store_true", help="also run the largest sizes")
+    parser.add_argument("--output", help="JSON file to save the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two saved results")
+    args = parser.parse_args(argv)
+    if args.compare:
+        compare(*args.compare)
+        return
+    results = run_suite(args.filter, args.repeat, args.full)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"metadata": metadata(), "results": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Benchmark find_topo_sort on very deep and very wide graphs.
+
+Run from the repository root:
+
+    python -m benchmarks.topo_sort [num_nodes]
+"""
+import sys
+import time
+
+import autodiff as ad
+
+
+def build_chain(num_nodes):
+    """A chain x -> x+1 -> (x+1)+1 -> ... with num_nodes nodes in total."""
+    node = ad.Variable(name = "x")
+    for _ in range(num_nodes - 1):
+        node = node + 1
+    return node
+
+
+def build_fan_in(num_nodes):
+    """A single node fed by num_nodes - 1 independent placeholders."""
+    root = ad.Node()
+    root.op = ad.add_op
+    root.inputs = [ad.Variable(name = "x%d" % i) for i in range(num_nodes - 1)]
+    return root
+
+
+def time_sort(root):
+    start = time.perf_counter()
+    topo_order = ad.find_topo_sort([root])
+    elapsed = time.perf_counter() - start
+    return len(topo_order), elapsed
+
+
+def main(num_nodes=1000000):
+    for label, build in [("chain", build_chain), ("fan-in", build_fan_in)]:
+        root = build(num_nodes)
+        n, elapsed = time_sort(root)
+        print("%-8s nodes=%d  sort=%.3fs  (%.2f us/node)" % (label, n, elapsed, 1e6 * elapsed / n))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
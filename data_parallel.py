@@ -0,0 +1,203 @@
+"""Data-parallel execution of a graph over a pool of processes.
+
+DataParallelExecutor splits the leading (batch) axis of selected fed nodes
+into one shard per worker process. The sharded values are placed in
+multiprocessing.shared_memory blocks, which the workers map without copying;
+every worker runs the same graph with its own autodiff.Executor on its rows,
+and the outputs of the shards are combined in the parent, e.g. by summing
+per-shard gradients.
+
+Workers are forked, so they inherit the graph instead of unpickling it; this
+needs a platform with the "fork" start method (Linux, other Unixes).
+"""
+import itertools
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+import autodiff as ad
+
+# how outputs of the shards are combined into the output of a run
+reductions = ("sum", "mean", "concat")
+
+# graphs of the live DataParallelExecutors by token, inherited by forked workers
+_graphs = {}
+_tokens = itertools.count()
+
+# per worker process: the executor of its graph, the topological order of the
+# graph, its Parameter nodes, and the attached shared memory blocks by name
+_worker_executor = None
+_worker_topo_order = None
+_worker_parameter_nodes = None
+_worker_blocks = {}
+
+
+class DataParallelExecutor(object):
+    """Executor running the graph on shards of the batch in several processes."""
+    def __init__(self, eval_node_list, sharded_nodes, num_workers, reduction_list=None, **executor_options):
+        """
+        Parameters
+        ----------
+        eval_node_list: list of nodes whose values need to be computed.
+        sharded_nodes: fed nodes whose values are split along their first
+            axis; they all need the same length. Other fed values are sent
+            whole to every worker.
+        num_workers: number of worker processes (and shards).
+        reduction_list: how the shard outputs of each node of eval_node_list
+            are combined, one of reductions per node, "sum" for all if None:
+            "sum" adds them (e.g. gradients of a summed loss), "mean" is the
+            mean over the batch of per-shard means (e.g. a reduce_mean_op
+            loss and its gradients), weighting each shard by its rows, and
+            "concat" joins per-row outputs along the first axis.
+        executor_options: keyword arguments of the autodiff.Executor of
+            every worker, e.g. optimize=True.
+        """
+        assert num_workers > 0, "num_workers has to be positive"
+        if reduction_list is None:
+            reduction_list = ["sum"] * len(eval_node_list)
+        assert len(reduction_list) == len(eval_node_list), "one reduction per node of eval_node_list"
+        assert all(reduction in reductions for reduction in reduction_list), "unknown reduction"
+        topo_order = ad.find_topo_sort(eval_node_list)
+        assert not any(node.op.updates_state for node in topo_order), \
+            "parameter updates have to run in the parent process"
+        self.eval_node_list = eval_node_list
+        self.sharded_nodes = list(sharded_nodes)
+        self.num_workers = num_workers
+        self.reduction_list = reduction_list
+        # Parameter values change in the parent, they are sent with every run
+        self.parameter_nodes = [node for node in topo_order if node.op is ad.parameter_op]
+        # the positions of the nodes in the graph identify them in the workers
+        self._node_index = {node: i for i, node in enumerate(topo_order)}
+        self._sharded_index = [self._node_index[node] for node in self.sharded_nodes]
+        # shared memory block and array over it, per sharded node
+        self._blocks = {}
+
+        self._token = next(_tokens)
+        _graphs[self._token] = (eval_node_list, self.parameter_nodes, executor_options)
+        # Workers have to report to the parent's resource tracker, or the
+        # blocks they attach to would be unlinked when they exit.
+        resource_tracker.ensure_running()
+        self._pool = multiprocessing.get_context("fork").Pool(num_workers, _init_worker, (self._token,))
+
+    def shared_array(self, node, shape, dtype=np.float64):
+        """Return an array in shared memory for the values of a sharded node.
+
+        Feeding this array for node (after filling it in place) saves copying
+        it into shared memory on every run.
+        """
+        assert node in self.sharded_nodes, "only sharded nodes are kept in shared memory"
+        shape = tuple(shape)
+        dtype = np.dtype(dtype)
+        entry = self._blocks.get(node)
+        if entry is not None and entry[1].shape == shape and entry[1].dtype == dtype:
+            return entry[1]
+        if entry is not None:
+            del self._blocks[node]
+            _free_block(entry[0])
+        block = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize))
+        array = np.ndarray(shape, dtype, buffer=block.buf)
+        self._blocks[node] = (block, array)
+        return array
+
+    def run(self, feed_dict):
+        """Compute the values of eval_node_list, combined over the shards.
+
+        Returns
+        -------
+        A list of values for nodes in eval_node_list.
+        """
+        assert self._pool is not None, "executor is closed"
+        num_rows = len(feed_dict[self.sharded_nodes[0]])
+        assert all(len(feed_dict[node]) == num_rows for node in self.sharded_nodes), \
+            "sharded values differ in length"
+        sharded = []
+        for node in self.sharded_nodes:
+            val = feed_dict[node]
+            entry = self._blocks.get(node)
+            if entry is None or entry[1] is not val:
+                val = np.asarray(val)
+                array = self.shared_array(node, val.shape, val.dtype)
+                array[...] = val
+            block, array = self._blocks[node]
+            sharded.append((block.name, array.shape, array.dtype.str))
+        node_index = self._node_index
+        other_feeds = [(node_index[node], val) for node, val in feed_dict.items()
+                       if node not in self.sharded_nodes and node in node_index]
+        parameter_vals = [node.const_attr for node in self.parameter_nodes]
+
+        bounds = np.linspace(0, num_rows, min(self.num_workers, num_rows) + 1).astype(int)
+        tasks = [(self._sharded_index, sharded, start, stop, other_feeds, parameter_vals)
+                 for start, stop in zip(bounds[:-1], bounds[1:])]
+        shard_outputs = self._pool.starmap(_run_shard, tasks)
+
+        shard_rows = [stop - start for start, stop in zip(bounds[:-1], bounds[1:])]
+        results = []
+        for i, reduction in enumerate(self.reduction_list):
+            vals = [outputs[i] for outputs in shard_outputs]
+            if reduction == "sum":
+                results.append(sum(vals[1:], vals[0]))
+            elif reduction == "mean":
+                results.append(sum(val * (rows / num_rows) for val, rows in zip(vals, shard_rows)))
+            else:
+                results.append(np.concatenate(vals))
+        return results
+
+    def close(self):
+        """Stop the workers and free the shared memory."""
+        if self._pool is None:
+            return
+        self._pool.terminate()
+        self._pool.join()
+        self._pool = None
+        blocks = [block for block, _ in self._blocks.values()]
+        self._blocks.clear()
+        for block in blocks:
+            _free_block(block)
+        del _graphs[self._token]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _free_block(block):
+    """Unlink a shared memory block, closing it unless arrays over it are still around."""
+    try:
+        block.close()
+    except BufferError:
+        # the mapping goes away with the last array using it
+        pass
+    block.unlink()
+
+
+def _init_worker(token):
+    """Build the executor of the graph registered under token, in a new worker."""
+    global _worker_executor, _worker_topo_order, _worker_parameter_nodes
+    eval_node_list, _worker_parameter_nodes, executor_options = _graphs[token]
+    _worker_topo_order = ad.find_topo_sort(eval_node_list)
+    _worker_executor = ad.Executor(eval_node_list, **executor_options)
+
+
+def _run_shard(sharded_index, sharded, start, stop, other_feeds, parameter_vals):
+    """Run the worker's executor on rows start:stop of the sharded values."""
+    # the worker's copy of the graph is only read, so the parent's values can replace it
+    for node, val in zip(_worker_parameter_nodes, parameter_vals):
+        node.const_attr = val
+    feed_dict = {_worker_topo_order[i]: val for i, val in other_feeds}
+    # Every task names all current blocks, the others were freed by the parent.
+    names = set(name for name, _, _ in sharded)
+    for name in [name for name in _worker_blocks if name not in names]:
+        try:
+            _worker_blocks.pop(name).close()
+        except BufferError:
+            # an array of the executor still uses it, the mapping goes away with it
+            pass
+    for i, (name, shape, dtype) in zip(sharded_index, sharded):
+        block = _worker_blocks.get(name)
+        if block is None:
+            block = _worker_blocks[name] = shared_memory.SharedMemory(name=name)
+        feed_dict[_worker_topo_order[i]] = np.ndarray(shape, dtype, buffer=block.buf)[start:stop]
+    return [np.array(val) for val in _worker_executor.run(feed_dict = feed_dict)]
@@ -0,0 +1,65 @@
+import autodiff as ad
+import numpy as np
+
+import data_parallel
+
+def logreg_graph():
+    x = ad.Variable(name = "x")
+    labels = ad.Variable(name = "labels")
+    w = ad.Variable(name = "w")
+    b = ad.Parameter(name = "b", value = 0.5)
+    logits = ad.matmul_op(x, w) + b
+    loss = ad.reduce_mean_op(ad.sigmoid_cross_entropy_op(logits, labels))
+    grad_w, grad_b = ad.gradients(loss, [w, b])
+    return x, labels, w, b, logits, loss, grad_w, grad_b
+
+def worker_block_names():
+    return sorted(data_parallel._worker_blocks)
+
+def test_data_parallel_matches_single_process():
+    x, labels, w, b, logits, loss, grad_w, grad_b = logreg_graph()
+    rng = np.random.default_rng(0)
+    x_val = rng.standard_normal((101, 3))
+    labels_val = (rng.random((101, 1)) > 0.5).astype(float)
+    w_val = rng.standard_normal((3, 1))
+    feed_dict = {x: x_val, labels: labels_val, w: w_val}
+    eval_node_list = [loss, grad_w, grad_b, ad.reduce_sum_op(logits), logits]
+    expected = ad.Executor(eval_node_list).run(feed_dict = feed_dict)
+
+    with data_parallel.DataParallelExecutor(eval_node_list, [x, labels], 3,
+                                            ["mean", "mean", "mean", "sum", "concat"], optimize = True) as executor:
+        results = executor.run(feed_dict = feed_dict)
+        for val, expected_val in zip(results, expected):
+            assert np.shape(val) == np.shape(expected_val)
+            assert np.allclose(val, expected_val)
+
+        # arrays in shared memory are used without a copy, updated values are seen
+        shared_x = executor.shared_array(x, x_val.shape)
+        assert executor.shared_array(x, x_val.shape) is shared_x
+        shared_x[...] = 2 * x_val
+        feed_dict[x] = shared_x
+        b.const_attr[...] = -1.0
+        expected = ad.Executor(eval_node_list).run(feed_dict = feed_dict)
+        for val, expected_val in zip(executor.run(feed_dict = feed_dict), expected):
+            assert np.allclose(val, expected_val)
+
+def test_data_parallel_more_workers_than_rows():
+    x, labels, w, b, logits, loss, grad_w, grad_b = logreg_graph()
+    feed_dict = {x: np.ones((2, 3)), labels: np.ones((2, 1)), w: np.ones((3, 1))}
+    expected = ad.Executor([grad_w]).run(feed_dict = feed_dict)
+    executor = data_parallel.DataParallelExecutor([grad_w], [x, labels], 4, ["mean"])
+    try:
+        assert np.allclose(executor.run(feed_dict = feed_dict)[0], expected[0])
+    finally:
+        executor.close()
+    executor.close()
+
+def test_data_parallel_workers_drop_freed_blocks():
+    x, labels, w, b, logits, loss, grad_w, grad_b = logreg_graph()
+    with data_parallel.DataParallelExecutor([grad_w], [x, labels], 1) as executor:
+        for num_rows in [10, 20, 30]:
+            feed_dict = {x: np.ones((num_rows, 3)), labels: np.ones((num_rows, 1)), w: np.ones((3, 1))}
+            executor.run(feed_dict = feed_dict)
+            # only the blocks of the latest values stay mapped
+            names = sorted(block.name for block, _ in executor._blocks.values())
+            assert executor._pool.apply(worker_block_names) == names
@@ -1,21 +1,21 @@
 import autodiff as ad
 import numpy as np
 
-w = ad.Variable(name = "w")
+# weights our model initially starts at, stored in the graph and updated in place
+w = ad.Parameter(name = "w", value = 10)
+b = ad.Parameter(name = "b", value = 1)
 x = ad.Variable(name = "x")
-b = ad.Variable(name = "b")
 
 labels = ad.Variable(name = "lables")
 
-out = 1.0 / (1.0 + ad.exp_op((-1.0 * (w * x + b))))
+logits = w * x + b
 
-ce_loss = -1.0 * ((labels * ad.log_op(out)) + ((1.0 - labels) * ad.log_op(1.0 - out)))
+ce_loss = ad.reduce_mean_op(ad.sigmoid_cross_entropy_op(logits, labels))
 
-grad_w, grad_b = ad.gradients(ce_loss, [w,b])
+learning_rate = 1
 
-# weights our model initially starts at
-w_val = 10
-b_val = 1
+# w and b are scalars, so their gradients are reduced to scalars as well
+train_step = ad.SGD(learning_rate).minimize(ce_loss, [w,b])
 
 # weights our model should reach to 
 w_required = 5
@@ -36,22 +36,17 @@ for i,t in np.ndenumerate(labels_val):
     else:
         labels_val[i] = 0
 
-executor = ad.Executor([out,ce_loss, grad_w, grad_b])
-
-w_reached = 0
-b_reached = 0
+executor = ad.Executor([ce_loss, train_step], optimize=True)
 
 num_iterations = 10000
-learning_rate = 1
 
 for i in range(num_iterations):
-    _,loss_value, grad_w_value, grad_b_value =  executor.run(feed_dict={x:x_val, w:w_val, b:b_val, labels:labels_val})
-    w_val = w_val - learning_rate * np.mean(grad_w_value)
-    b_val = b_val - learning_rate * np.mean(grad_b_value)
+    loss_value, _ = executor.run(feed_dict={x:x_val, labels:labels_val})
     if (i%10000 == 0):
         print(loss_value)
-    w_reached = w_val
-    b_reached = b_val
+
+w_reached = float(w.const_attr)
+b_reached = float(b.const_attr)
 
 
 print(w_reached)
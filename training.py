@@ -0,0 +1,213 @@
+"""Minibatch training loop on top of autodiff.Executor.
+
+Batches come from a batch source, an iterable of tuples of arrays with one
+array per input node:
+
+    ArrayBatches: slices of in-memory arrays, optionally shuffled every epoch.
+    npy_batches: the same for .npy files, opened memory-mapped so only the
+        current batch is read from disk.
+    any other iterable, e.g. a generator reading a stream.
+
+Trainer compiles the loss and the parameter update of an autodiff.Optimizer
+once and runs them for every batch, while the next batch is loaded on a
+background thread (Prefetcher).
+"""
+import queue
+import threading
+
+import numpy as np
+
+import autodiff as ad
+
+
+class ArrayBatches(object):
+    """Batch source slicing arrays along their first axis.
+
+    Iterating again starts a new epoch (reshuffled if shuffle is set).
+    """
+    def __init__(self, arrays, batch_size, shuffle=False, seed=None, drop_last=False):
+        """
+        Parameters
+        ----------
+        arrays: list of arrays (or memory maps) with the same length, one per input node.
+        batch_size: number of rows in a batch.
+        shuffle: whether to visit the rows in a new random order every epoch.
+        seed: seed of the shuffling.
+        drop_last: whether to skip the last batch if it is smaller than batch_size.
+        """
+        assert len(arrays) > 0, "at least one array is needed"
+        assert all(len(array) == len(arrays[0]) for array in arrays), "arrays differ in length"
+        assert batch_size > 0, "batch_size has to be positive"
+        self.arrays = list(arrays)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        num_rows = len(self.arrays[0])
+        if self.drop_last:
+            return num_rows // self.batch_size
+        return -(-num_rows // self.batch_size)
+
+    def __iter__(self):
+        num_rows = len(self.arrays[0])
+        order = self._rng.permutation(num_rows) if self.shuffle else None
+        for i in range(len(self)):
+            start = i * self.batch_size
+            stop = min(start + self.batch_size, num_rows)
+            if order is None:
+                index = slice(start, stop)
+            else:
+                # sorted, so that memory-mapped files are read front to back
+                index = np.sort(order[start:stop])
+            # np.asarray reads memory-mapped rows into memory (on the prefetch thread)
+            yield tuple(np.asarray(array[index]) for array in self.arrays)
+
+
+def npy_batches(paths, batch_size, shuffle=False, seed=None, drop_last=False):
+    """Return an ArrayBatches over .npy files opened with mmap_mode="r".
+
+    The files can be larger than memory, only the rows of a batch are read.
+    """
+    return ArrayBatches([np.load(path, mmap_mode="r") for path in paths], batch_size, shuffle, seed, drop_last)
+
+
+class Prefetcher(object):
+    """Iterator running an iterable on a background thread, depth items ahead.
+
+    Exceptions raised by the iterable are raised again from next(). Use it as
+    a context manager (or call close) to stop the thread when not iterating
+    to the end.
+    """
+    _done = object()
+
+    def __init__(self, iterable, depth=1):
+        assert depth > 0, "depth has to be positive"
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(iter(iterable),), daemon=True)
+        self._thread.start()
+
+    def _produce(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+            self._put((self._done, None))
+        except BaseException as e:
+            self._put((self._done, e))
+
+    def _put(self, entry):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._stop.is_set():
+            raise StopIteration
+        item, error = self._queue.get()
+        if item is self._done:
+            self._stop.set()
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    def close(self):
+        """Stop the background thread and wait for it."""
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class Trainer(object):
+    """Minimizes a loss over minibatches with an autodiff.Optimizer.
+
+    Use it as a context manager (or call close) to stop the executor's
+    threads when it is created with num_workers.
+    """
+    def __init__(self, loss, params, input_nodes, optimizer, **executor_options):
+        """
+        Parameters
+        ----------
+        loss: scalar node to minimize.
+        params: list of autodiff.Parameter nodes to train; their values are
+            updated in place by every step.
+        input_nodes: list of nodes fed from a batch, in the order of the arrays of a batch.
+        optimizer: autodiff.Optimizer, e.g. autodiff.SGD.
+        executor_options: keyword arguments of autodiff.Executor, e.g.
+            optimize=True or static_shapes=True.
+        """
+        self.loss = loss
+        self.params = list(params)
+        self.input_nodes = list(input_nodes)
+        self.optimizer = optimizer
+        self.executor = ad.Executor([loss, optimizer.minimize(loss, self.params)], **executor_options)
+
+    def step(self, batch):
+        """Run the loss and the parameter update on one batch, return the loss."""
+        assert len(batch) == len(self.input_nodes), "a batch needs one array per input node"
+        loss_val, _ = self.executor.run(feed_dict = dict(zip(self.input_nodes, batch)))
+        # the loss is computed before the update
+        return float(loss_val)
+
+    def close(self):
+        """Stop the worker threads of the executor, see autodiff.Executor.close."""
+        self.executor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def fit(self, batches, num_epochs=1, prefetch=1, callback=None):
+        """Train on every batch of batches, num_epochs times.
+
+        Parameters
+        ----------
+        batches: batch source, iterated once per epoch. Generators can only
+            be used for a single epoch.
+        num_epochs: number of passes over batches.
+        prefetch: number of batches loaded ahead on a background thread,
+            0 to load them on the calling thread.
+        callback: optional function called as callback(epoch, step, loss) after every step.
+
+        Returns
+        -------
+        The list of mean losses, one per epoch.
+        """
+        epoch_losses = []
+        for epoch in range(num_epochs):
+            total = 0.0
+            num_steps = 0
+            if prefetch:
+                epoch_batches = Prefetcher(batches, prefetch)
+            else:
+                epoch_batches = iter(batches)
+            try:
+                for batch in epoch_batches:
+                    loss_val = self.step(batch)
+                    if callback is not None:
+                        callback(epoch, num_steps, loss_val)
+                    total += loss_val
+                    num_steps += 1
+            finally:
+                if prefetch:
+                    epoch_batches.close()
+            assert num_steps > 0, "epoch %d had no batches" % epoch
+            epoch_losses.append(total / num_steps)
+        return epoch_losses
@@ -0,0 +1,88 @@
+import threading
+
+import autodiff as ad
+import numpy as np
+
+import training
+
+def logreg_problem():
+    w = ad.Parameter(name = "w", value = 0)
+    b = ad.Parameter(name = "b", value = 0)
+    x = ad.Variable(name = "x")
+    labels = ad.Variable(name = "labels")
+    loss = ad.reduce_mean_op(ad.sigmoid_cross_entropy_op(w * x + b, labels))
+    x_val = np.linspace(-4, 4, 400)
+    labels_val = (2 * x_val + 1 > 0).astype(float)
+    return w, b, x, labels, loss, x_val, labels_val
+
+def test_array_batches():
+    x_val = np.arange(10)
+    y_val = np.arange(10) * 2
+    batches = training.ArrayBatches([x_val, y_val], 4)
+    assert len(batches) == 3
+    assert [len(x) for x, y in batches] == [4, 4, 2]
+    assert len(training.ArrayBatches([x_val], 4, drop_last = True)) == 2
+
+    shuffled = training.ArrayBatches([x_val, y_val], 4, shuffle = True, seed = 0)
+    epoch_1 = np.concatenate([x for x, y in shuffled])
+    epoch_2 = np.concatenate([x for x, y in shuffled])
+    assert sorted(epoch_1) == list(range(10)) and sorted(epoch_2) == list(range(10))
+    assert not np.array_equal(epoch_1, epoch_2)
+    assert all(np.array_equal(y, 2 * x) for x, y in shuffled)
+
+def test_npy_batches(tmp_path):
+    x_val = np.arange(20.0).reshape(10, 2)
+    np.save(tmp_path / "x.npy", x_val)
+    batches = training.npy_batches([tmp_path / "x.npy"], 3)
+    rows = [x for x, in batches]
+    assert not isinstance(rows[0], np.memmap)
+    assert np.array_equal(np.concatenate(rows), x_val)
+
+def test_prefetcher():
+    assert list(training.Prefetcher(range(5), depth = 2)) == list(range(5))
+
+    def failing():
+        yield 1
+        raise ValueError("bad batch")
+    prefetcher = training.Prefetcher(failing())
+    assert next(prefetcher) == 1
+    try:
+        next(prefetcher)
+        assert False
+    except ValueError:
+        pass
+
+    # stopping early ends the thread
+    threads = threading.active_count()
+    with training.Prefetcher(iter(range(1000))) as prefetcher:
+        assert next(prefetcher) == 0
+    assert threading.active_count() == threads
+
+def test_trainer_logreg():
+    w, b, x, labels, loss, x_val, labels_val = logreg_problem()
+    trainer = training.Trainer(loss, [w, b], [x, labels], ad.SGD(1.0), static_shapes = True)
+    w_val, b_val = w.const_attr, b.const_attr
+    losses = trainer.fit(training.ArrayBatches([x_val, labels_val], 32, shuffle = True, seed = 0), num_epochs = 20)
+    assert losses[-1] < losses[0] / 4
+    # updated in place
+    assert w.const_attr is w_val and b.const_attr is b_val
+    assert w_val > 0 and abs(b_val / w_val - 0.5) < 0.1
+
+def test_trainer_generator_batches():
+    w, b, x, labels, loss, x_val, labels_val = logreg_problem()
+    trainer = training.Trainer(loss, [w, b], [x, labels], ad.SGD(1.0), optimize = True)
+    stream = ((x_val[i:i + 50], labels_val[i:i + 50]) for i in range(0, 400, 50))
+    steps = []
+    trainer.fit(stream, prefetch = 2, callback = lambda epoch, step, loss_val: steps.append(step))
+    assert steps == list(range(8))
+    w_2, b_2, x, labels, loss, x_val, labels_val = logreg_problem()
+    unprefetched = training.Trainer(loss, [w_2, b_2], [x, labels], ad.SGD(1.0), optimize = True)
+    unprefetched.fit([(x_val[i:i + 50], labels_val[i:i + 50]) for i in range(0, 400, 50)], prefetch = 0)
+    assert np.allclose([w.const_attr, b.const_attr], [w_2.const_attr, b_2.const_attr])
+
+def test_trainer_close():
+    w, b, x, labels, loss, x_val, labels_val = logreg_problem()
+    with training.Trainer(loss, [w, b], [x, labels], ad.SGD(1.0), num_workers = 2) as trainer:
+        trainer.fit(training.ArrayBatches([np.tile(x_val, 200), np.tile(labels_val, 200)], 80000), prefetch = 0)
+        assert trainer.executor._pool is not None
+    assert trainer.executor._pool is None